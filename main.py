@@ -16,16 +16,56 @@ import numpy as np
 from modules import configurator as cfg
 from modules import const
 from modules import systems
+from modules import systems_core
+from modules import solvers
+from modules import integrators
+from modules import kernels
+from modules import checkpoint
+from modules import recorder
+from modules import statecache
+from modules.ephemeris import Ephemeris
+from modules.simulation import Simulation
+from modules.replay import Replay
+from modules.environment import Environment
 
 WIDTH, HEIGHT = 1080, 720
 
 settings = {
     'system': systems.earth_system,
+    # Each step is delta_time/TARGET_SIM_FPS long. The simulation takes them as fast as it can, or at most
+    # max_steps_per_second of them a second if that is set.
     'TARGET_SIM_FPS': 600,
+    'max_steps_per_second': None,
     'paused': False,
-    'simulation_start_time': time.time(),
+    # The start of the current day, so that the state cache finds the system again on later launches that day.
+    'simulation_start_time': time.time() // 86400 * 86400,
     'delta_time': 200000,
     'fragments': 5,
+    'solver': 'direct',
+    'solver_options': {},
+    'integrator': 'leapfrog',
+    'integrator_options': {},
+    'kernel_backend': 'auto',
+    # Swept collisions keep fast bodies from passing through each other, and are needed for shatter_factor.
+    'continuous_collisions': False,
+    'shatter_factor': None,
+    # Checkpoints are written every checkpoint_interval seconds and when the window closes.
+    'checkpoint_path': None,
+    'checkpoint_interval': 300,
+    'resume_from': None,
+    # Every record_every-th step is written to the recording directory, if there is one.
+    'record_path': None,
+    'record_every': 1,
+    'record_compress': False,
+    # A recording to play back instead of simulating.
+    'replay_path': None,
+    # Test particles around a body, e.g. {'parent': 'Sun', 'count': 100000, 'inner': 3.1e11, 'outer': 4.9e11}
+    'belt': None,
+    # Directory to keep initial states in, e.g. statecache.DEFAULT_DIRECTORY, so that opening a system again
+    # at the same simulation_start_time is instant.
+    'state_cache': None,
+    # An ephemeris of the system, from python -m modules.ephemeris build, to jump to any date in it with J.
+    'ephemeris_path': None,
 }
 
 visual_settings = {
@@ -59,39 +99,15 @@ def offset_surface(surface, offset=(0,0)):
     new_surface.blit(surface, offset)
     return new_surface
 
-class Environment:
-
-    def __init__(self, name, object_dict={}, start_time=0, delta_time=settings['delta_time'], softening=5000, G=6.6743*10**-11):
-        self.name=name
-        self.object_dict = object_dict
-        self.time = start_time
-        self.delta_time = delta_time
-        self.softening = softening
-        self.G = G
-
-    @property
-    def mass(self):
-        return sum([body.mass for body in self.objects])
-
-    @property
-    def objects(self):
-        return self.object_dict.values()
-
 from modules.ObjectClasses import Body
 
-from modules import systems_core
-
 def environment_setup(environment, system):
-    environment.name = system.name
-
     visual_settings['scale'] = system.parent.radius/2
 
-    systems_core.load_system(environment, system, np.array([0,0,0], dtype=np.float64), np.array([0,0,0], dtype=np.float64))
+    environment.load(system, statecache.StateCache(settings['state_cache']) if settings['state_cache'] else None)
 
 
-universe = Environment('Universe', start_time=settings['simulation_start_time'])
-
-environment_setup(universe, settings['system'])
+universe = Environment('Universe', start_time=settings['simulation_start_time'], delta_time=settings['delta_time'])
 
 def get_focus_position():
     focus = visual_settings['focus']
@@ -102,22 +118,22 @@ def get_focus_position():
     elif isinstance(focus, Body):
         return focus.position[:-1]
 
-def draw_body(body, surf, position):
+def draw_body(body, surf, position, radius):
     try:
         body_screen_position = position
         body_screen_position = int(body_screen_position[0]), int(body_screen_position[1])
-        body_screen_size = int(body.size(visual_settings['scale'], visual_settings['rescale_factor']))
+        body_screen_size = int(body.size(visual_settings['scale'], visual_settings['rescale_factor'], radius))
 
         gfxdraw.aacircle(surf, *body_screen_position, body_screen_size, body.color)
         gfxdraw.filled_circle(surf, *body_screen_position, body_screen_size, body.color)
     except:
         pass
 
-def draw_body_info(body, surf, name_font, info_font, position):
+def draw_body_info(body, surf, name_font, info_font, position, mass, radius):
     try:
         body_screen_position = position
         body_screen_position = int(body_screen_position[0]), int(body_screen_position[1])
-        body_screen_size = int(body.size(visual_settings['scale'], visual_settings['rescale_factor']))
+        body_screen_size = int(body.size(visual_settings['scale'], visual_settings['rescale_factor'], radius))
 
         color = COLORS['HOVERING']
 
@@ -148,8 +164,8 @@ def draw_body_info(body, surf, name_font, info_font, position):
                 surf.blit(name_font.render(body.name, True, color), (body_screen_position[0]+int(body_screen_size)+66, body_screen_position[1]-7))
 
                 body_info = [
-                    f"Mass: {np.format_float_scientific(body.mass, 4)}",
-                    f"Radius: {np.format_float_scientific(body.radius, 4)}",
+                    f"Mass: {np.format_float_scientific(mass, 4)}",
+                    f"Radius: {np.format_float_scientific(radius, 4)}",
                 ]
 
                 for n, text in enumerate(body_info):
@@ -161,8 +177,24 @@ def draw_path_line(body, surf, pos1, pos2):
     pygame.draw.aaline(surf, body.darker_color, pos1, pos2)
 
 def redraw_path(body, surf, points):
-    body.path_points.append(body.position.copy())
-    pygame.draw.aalines(surf, body.darker_color, False, points)
+    if len(points) >= 2:
+        pygame.draw.aalines(surf, body.darker_color, False, points)
+
+def undrawn_path(path, last_drawn):
+    # The points of a trail from the last one drawn on, or all of them if that one is gone.
+    for k in range(len(path) - 1, -1, -1):
+        if path[k] is last_drawn:
+            return path[k:]
+    return path
+
+def draw_test_particles(surf, color, screen_positions):
+    # A pixel each, written straight into the surface; there are far too many to draw one by one.
+    x, y = screen_positions
+    on_screen = (x >= 0) & (x < surf.get_width()) & (y >= 0) & (y < surf.get_height())
+
+    pixels = pygame.surfarray.pixels3d(surf)
+    pixels[x[on_screen].astype(int), y[on_screen].astype(int)] = color
+    del pixels
 
 def purge_dict(dict, purgees):
     for key in purgees:
@@ -184,6 +216,42 @@ def main():
     updated_settings = cfg.read_config('config.cfg')
     cfg.update_dictionaries(updated_settings, [settings, visual_settings, COLORS])
 
+    kernels.use_backend(settings['kernel_backend'])
+    universe.solver = solvers.make_solver(settings['solver'], **settings['solver_options'])
+    universe.integrator = integrators.make_integrator(settings['integrator'], **settings['integrator_options'])
+    universe.continuous_collisions = settings['continuous_collisions']
+    universe.shatter_factor = settings['shatter_factor']
+    universe.fragments = settings['fragments']
+    universe.time = settings['simulation_start_time']
+    universe.delta_time = settings['delta_time']
+
+    # Only now that config.cfg is applied, so that its state_cache and start time are used.
+    environment_setup(universe, settings['system'])
+
+    if settings['resume_from']:
+        checkpoint.load(settings['resume_from'], universe)
+        print(f"Resumed {universe.name} from {settings['resume_from']}")
+
+    if settings['belt'] and not settings['replay_path']:
+        systems_core.add_belt(universe, **settings['belt'])
+
+    replay = None
+    if settings['replay_path']:
+        replay = Replay(settings['replay_path'], universe)
+        print(f"Replaying {settings['replay_path']}")
+
+    ephemeris = None
+    if settings['ephemeris_path'] and not replay:
+        ephemeris = Ephemeris.load(settings['ephemeris_path'])
+
+    checkpoint_writer = None
+    if settings['checkpoint_path'] and not replay:
+        checkpoint_writer = checkpoint.CheckpointWriter(settings['checkpoint_path'], settings['checkpoint_interval'])
+
+    trajectory_recorder = None
+    if settings['record_path'] and not replay:
+        trajectory_recorder = recorder.Recorder(settings['record_path'], settings['record_every'], compress=settings['record_compress'])
+
     pygame.font.init()
     Courier_New = pygame.font.SysFont('Courier New', 16)
     Consolas = pygame.font.SysFont('Consolas', 16)
@@ -206,83 +274,99 @@ def main():
     path_surface_size = (WIDTH, HEIGHT)
     path_surface = pygame.Surface(path_surface_size, pygame.SRCALPHA)
 
-    k = 0
-
     # System to check if a key was just pressed
     last_key_state = pygame.key.get_pressed()
 
-    last_draw_time = time.perf_counter()
-
     tracked_keys = {
         pygame.K_x: False,
     }
 
-    running = True
-    while running:
-
-        focus_position = get_focus_position()
-        
-        if not settings['paused']:
-            
-            for body in universe.objects:
-
-                body.update_acceleration(universe, const.G)
-                body.update_velocity(settings['delta_time'], settings['TARGET_SIM_FPS'])
-
-                body.old_position = body.position.copy()
-                body.update_position(settings['delta_time'], settings['TARGET_SIM_FPS'])
-                body.new_position = body.position.copy()
-            
-            removed_bodies = []
-
-            for body in universe.objects:
+    # These run on the simulation thread, which is the only one that changes the universe; the window
+    # only draws snapshots of it.
+    def after_step(steps):
+        if checkpoint_writer:
+            checkpoint_writer.maybe_submit(universe)
 
-                if body in removed_bodies:
-                    continue
+        if trajectory_recorder:
+            trajectory_recorder.record(universe)
 
-                for body2 in universe.objects:
+        if not steps % 20:
+            bodies = list(universe.objects)
+            for body in bodies:
+                body.path_points.append(body.new_position)
+                while len(body.path_points) > 500*15/math.sqrt(len(bodies)):
+                    del body.path_points[0]
 
-                    if body2 in removed_bodies or body == body2:
-                        continue
+    def shatter(body):
+        # The body may have collided with something since it was clicked.
+        if universe.object_dict.get(body.name) is not body:
+            return
 
-                    dist = body2.position - body.position
-                    dist_norm = math.sqrt(sum((dim**2 for dim in dist))+universe.softening**2)
+        removed_bodies = []
+        new_bodies = {}
+        body.shatter(settings['fragments'], removed_bodies, new_bodies)
 
-                    if dist_norm < body.radius + body2.radius and ((body.name not in removed_bodies) and (body2.name not in removed_bodies)):
-                        smaller, larger = sorted((body, body2), key=lambda x: x.mass)
+        purge_dict(universe.object_dict, removed_bodies)
+        universe.object_dict.update(new_bodies)
 
-                        print(f"{smaller.name} collided with {larger.name}")
+    def jump_to(moment, date):
+        print(f"Moved {ephemeris.apply(universe, moment)} bodies to {date}")
+
+    # A replay plays delta_time seconds of the recording a second, by the wall clock, and has no use for
+    # more steps than there are frames.
+    if replay:
+        simulation = Simulation(
+            universe,
+            lambda dt: replay.play(dt*settings['TARGET_SIM_FPS']),
+            after_step,
+            settings['max_steps_per_second'] or visual_settings['FPS'],
+        )
+    else:
+        simulation = Simulation(
+            universe,
+            lambda dt: universe.advance(dt, const.G),
+            after_step,
+            settings['max_steps_per_second'],
+        )
+
+    # The last point of each body's trail that is on the path surface, for its path to go on from.
+    drawn_paths = {}
+    drawn_steps = 0
+    jumps = 0
 
-                        larger.mass += smaller.mass
-                        removed_bodies.append(smaller.name)
+    running = True
+    while running:
 
-                        larger.velocity = (larger.mass*larger.velocity + smaller.mass*smaller.velocity) / larger.mass
-            
-            purge_dict(universe.object_dict, removed_bodies)
+        if simulation.error:
+            break
 
-            k += 1
-            for body in universe.objects:
-                
-                if visual_settings['render_paths']:
-                    draw_path_line(body, path_surface, screen_position(body.old_position), screen_position(body.new_position))
+        simulation.dt = settings['delta_time'] / settings['TARGET_SIM_FPS']
+        simulation.paused = settings['paused']
 
-                if not k % 20:
-                    body.path_points.append(body.new_position)
-                    while len(body.path_points) > 500*15/math.sqrt(len(universe.objects)):
-                        del body.path_points[0]
+        clock.tick(visual_settings['FPS'])
 
-            universe.time += settings['delta_time'] / settings['TARGET_SIM_FPS']
+        if simulation.steps_per_second:
+            settings['TRUE_FPS'] = simulation.steps_per_second
 
-        clock.tick(settings['TARGET_SIM_FPS'])
+        snapshot = simulation.latest()
+        positions = snapshot.positions.copy()
+        focus_position = get_focus_position()
 
-        if (fps := clock.get_fps()):
-            settings['TRUE_FPS'] = fps
+        if snapshot.jumps != jumps:
+            # Nothing connects the state from before a jump with the one after it.
+            jumps = snapshot.jumps
+            drawn_paths = {}
+            drawn_steps = None
+            path_surface.fill(COLORS['EMPTY'])
+
+        # Trails are the points recorded on the simulation thread, so they follow the orbits however many
+        # steps a frame is; only the points added since the last frame are drawn.
+        if visual_settings['render_paths'] and snapshot.steps != drawn_steps:
+            for body, path in zip(snapshot.bodies, snapshot.paths):
+                redraw_path(body, path_surface, [screen_position(pos) for pos in undrawn_path(path, drawn_paths.get(body))])
+            drawn_paths = {body: path[-1] for body, path in zip(snapshot.bodies, snapshot.paths) if path}
+            drawn_steps = snapshot.steps
 
-        current_draw_time = time.perf_counter()
-        if current_draw_time-last_draw_time < 1/visual_settings['FPS']:
-            continue
-        last_draw_time = current_draw_time
-        
         mouse_pos = pygame.mouse.get_pos()
         mouse_state = pygame.mouse.get_pressed()
         current_key_state = pygame.key.get_pressed()
@@ -321,6 +405,32 @@ def main():
                 elif event.key == pygame.K_p:
                     visual_settings['render_paths'] = not visual_settings['render_paths']
 
+                elif replay and event.key in (pygame.K_HOME, pygame.K_END, pygame.K_PAGEUP, pygame.K_PAGEDOWN) + tuple(range(pygame.K_0, pygame.K_9+1)):
+                    # Seeking: to the start or end, 5% back or forward, or to a tenth of the way through.
+                    if event.key == pygame.K_HOME:
+                        fraction = 0
+                    elif event.key == pygame.K_END:
+                        fraction = 1
+                    elif event.key == pygame.K_PAGEUP:
+                        fraction = replay.progress - 0.05
+                    elif event.key == pygame.K_PAGEDOWN:
+                        fraction = replay.progress + 0.05
+                    else:
+                        fraction = (event.key - pygame.K_0) / 10
+                    simulation.submit(lambda fraction=fraction: replay.seek_fraction(fraction), jump=True)
+
+                elif ephemeris and event.key == pygame.K_j:
+                    date = input(f"Jump to a date between {datetime.date.fromtimestamp(ephemeris.start)} and {datetime.date.fromtimestamp(ephemeris.end)} (YYYY-MM-DD): ")
+                    try:
+                        moment = datetime.datetime.strptime(date.strip(), '%Y-%m-%d').timestamp()
+                    except ValueError as error:
+                        print(error)
+                    else:
+                        if ephemeris.start <= moment <= ephemeris.end:
+                            simulation.submit(lambda moment=moment, date=date.strip(): jump_to(moment, date), jump=True)
+                        else:
+                            print(f"{date.strip()} is not in the ephemeris")
+
                 elif event.key == pygame.K_v:
                     contents = cfg.read_line(input("Manually redefine a variable: "))
                     if contents == 'stop':
@@ -343,8 +453,8 @@ def main():
 
                     if visual_settings['render_paths']:
                         path_surface.fill(COLORS['EMPTY'])
-                        for body in universe.objects:
-                            redraw_path(body, path_surface, [screen_position(pos) for pos in body.path_points])
+                        for body, path in zip(snapshot.bodies, snapshot.paths):
+                            redraw_path(body, path_surface, [screen_position(pos) for pos in path])
 
                 elif event.y == -1:
                     # Zoom out
@@ -356,8 +466,8 @@ def main():
 
                     if visual_settings['render_paths']:
                         path_surface.fill(COLORS['EMPTY'])
-                        for body in universe.objects:
-                            redraw_path(body, path_surface, [screen_position(pos) for pos in body.path_points])
+                        for body, path in zip(snapshot.bodies, snapshot.paths):
+                            redraw_path(body, path_surface, [screen_position(pos) for pos in path])
 
         mouse_relative_position = pygame.mouse.get_rel()
         
@@ -374,20 +484,24 @@ def main():
 
         if visual_settings['render_paths']:
             screen.blit(path_surface, (0,0))
+            # The rest of the way from each trail to its body, which the next recorded point replaces.
+            for body, path, position in zip(snapshot.bodies, snapshot.paths, positions):
+                if path:
+                    draw_path_line(body, screen, screen_position(path[-1]), screen_position(position))
+
+        if len(snapshot.test_positions):
+            draw_test_particles(screen, universe.test_particles.color, screen_position(snapshot.test_positions.T))
 
         gui_surface.fill(COLORS['EMPTY'])
 
-        # Need seperate because they're running at different paces
-        removed_bodies = []
-        new_bodies = {}
-        
         # Mouse-body events
 
         already_hovering = False
-        for body in sorted(universe.objects, key=lambda x: x.mass, reverse=True):
-                
-            body_screen_position = screen_position(body.position)
-            body_screen_size = body.size(visual_settings['scale'], visual_settings['rescale_factor'])
+        for k in np.argsort(-snapshot.masses, kind='stable'):
+            body = snapshot.bodies[k]
+
+            body_screen_position = screen_position(positions[k])
+            body_screen_size = body.size(visual_settings['scale'], visual_settings['rescale_factor'], snapshot.radii[k])
 
             mouse_distance = math.sqrt((mouse_pos[0]-body_screen_position[0])**2+(mouse_pos[1]-body_screen_position[1])**2)
 
@@ -404,22 +518,19 @@ def main():
                 elif not mouse_state[0] and was_left_clicked:
                     was_left_clicked = False
                     
-                if tracked_keys[pygame.K_x]:
-                    body.shatter(settings['fragments'], removed_bodies, new_bodies)
+                if tracked_keys[pygame.K_x] and not replay:
+                    simulation.submit(lambda body=body: shatter(body))
                     tracked_keys[pygame.K_x] = False
                     continue
                 
             else:
                 body.mouse_hovering = False
 
-        purge_dict(universe.object_dict, removed_bodies)
-
-        universe.object_dict.update(new_bodies)
-
         # Draw bodies with low mass first to prioritize planets over moons.
-        for body in sorted(universe.objects, key=lambda x: x.mass):
-            draw_body(body, screen, screen_position(body.position))
-            draw_body_info(body, gui_surface, Consolas, Consolas_small, screen_position(body.position))
+        for k in np.argsort(snapshot.masses, kind='stable'):
+            body = snapshot.bodies[k]
+            draw_body(body, screen, screen_position(positions[k]), snapshot.radii[k])
+            draw_body_info(body, gui_surface, Consolas, Consolas_small, screen_position(positions[k]), snapshot.masses[k], snapshot.radii[k])
 
         if settings['paused']:
             gui_surface.blit(Courier_New.render('SIMULATION PAUSED', True, '#4460ff'), (WIDTH/2-92, 36))
@@ -432,16 +543,19 @@ def main():
         hovering = False
 
         if visual_settings['show_center_of_mass']:
-            center_of_mass = sum([body.mass*body.position for body in universe.objects])/universe.mass
+            center_of_mass = snapshot.masses @ positions / snapshot.masses.sum()
             
             pygame.draw.circle(screen, '#ff4400', screen_position(center_of_mass), 2)
         
         try:
-            simulation_date = datetime.date.fromtimestamp(universe.time).strftime('%Y-%m-%d')
+            simulation_date = datetime.date.fromtimestamp(snapshot.time).strftime('%Y-%m-%d')
         except OSError:
-            simulation_date = f"{int(1970+universe.time/60/60/24/365.25)}"
+            simulation_date = f"{int(1970+snapshot.time/60/60/24/365.25)}"
 
-        speed = settings['delta_time']*settings['TRUE_FPS']/settings['TARGET_SIM_FPS']
+        if replay:
+            speed = settings['delta_time']
+        else:
+            speed = settings['delta_time']*settings['TRUE_FPS']/settings['TARGET_SIM_FPS']
 
         info = [
             (f"Date: {simulation_date}", COLORS['TEXT']),
@@ -450,9 +564,14 @@ def main():
             (f"{round(speed/60/60/24/365.25,3)} years per second", COLORS['TEXT']),
             (f"{round(visual_settings['scale']/10**(int(math.log10(visual_settings['scale']))),3)}e{int(math.log10(visual_settings['scale']))} meters per pixel", COLORS['TEXT']),
             #(f"Total mass: {round(universe.mass/10**(int(math.log10(universe.mass))),6)}e{int(math.log10(universe.mass))} kg", COLORS['TEXT']),
-            (f"Number of bodies: {len(universe.objects)}", COLORS['TEXT']),
-            (f"FPS: {round(settings['TRUE_FPS'],3)}", COLORS['TEXT']),
+            (f"Number of bodies: {len(snapshot.bodies)}", COLORS['TEXT']),
+            (f"Number of test particles: {len(snapshot.test_positions)}", COLORS['TEXT']),
+            (f"Steps per second: {round(settings['TRUE_FPS'],3)}", COLORS['TEXT']),
+            (f"FPS: {round(clock.get_fps(),3)}", COLORS['TEXT']),
         ]
+
+        if replay:
+            info.append((f"Replay: {round(100*replay.progress,1)}%", COLORS['TEXT']))
         
         for n, i in enumerate(info):
             gui_surface.blit(Courier_New.render(i[0], True, i[1]), (24, 20*n+16))
@@ -461,7 +580,16 @@ def main():
 
         pygame.display.update()
 
+    simulation.stop()
+
+    if checkpoint_writer:
+        checkpoint_writer.close(universe)
+
+    if trajectory_recorder:
+        trajectory_recorder.close()
+
+# The parallel solver's worker processes import this file again, and must not load the system or close
+# pygame on the way.
 if __name__ == '__main__':
     main()
-
-pygame.quit()
+    pygame.quit()
@@ -1,12 +1,13 @@
 import math
 
-import pygame
 import numpy as np
 
 try:
     import const
+    from particles import StateField, as_vector, accelerations
 except ModuleNotFoundError:
     from modules import const
+    from modules.particles import StateField, as_vector, accelerations
 
 class RawObject:
 
@@ -48,12 +49,26 @@ class RawObject:
         else:
             self.Epoch = (Epoch-1970)*365.25*24*60*60
 
+def rgb(color):
+    # '#rrggbb' or any (r, g, b[, a]) sequence as a tuple of ints, which is all drawing needs.
+    if isinstance(color, str):
+        color = color.lstrip('#')
+        return tuple(int(color[k:k+2], 16) for k in (0, 2, 4))
+
+    return tuple(int(channel) for channel in tuple(color)[:3])
+
 class Body:
 
+    position = StateField('positions', as_vector)
+    velocity = StateField('velocities', as_vector)
+    acceleration = StateField('accelerations', as_vector)
+    mass = StateField('masses')
+    radius = StateField('radii')
+
     def __init__(
             self,
             name='Conway',
-            color=pygame.Color(200,0,0),
+            color=(200,0,0),
             mass=10**6,
             radius=0.1,
             position=None,
@@ -61,25 +76,48 @@ class Body:
             tags=[],
             ):
 
+        # Set when the body is bound to a ParticleState
+        self._state = None
+        self._index = None
+
         self.name = name
-        self.color = pygame.Color(color)
+        self.color = rgb(color)
         self.mass = mass
         self.radius = radius
-        self.tags = tags.copy()
+        self.tags = list(tags or [])
 
-        self.position = np.array(position, dtype=np.float64)
-        self.velocity = np.array(velocity, dtype=np.float64)
-        self.acceleration = np.array([0,0,0], dtype=np.float64)
+        self.position = position
+        self.velocity = velocity
+        self.acceleration = [0,0,0]
 
         self.path_points = [self.position.copy(), self.position.copy()]
         
-        self.darker_color = pygame.Color(*(int(0.5*x) for x in [self.color.r, self.color.g, self.color.b]))
+        self.darker_color = tuple(int(0.5*x) for x in self.color)
         self.mouse_hovering = False
         self.selected = False
 
-    def size(self, scale, rescale_factor):
+    @classmethod
+    def restored(cls, name, color, tags, path_points, selected=False):
+        # Body without any position, mass, etc. of its own, for when it is about to be adopted by a
+        # ParticleState that already has them; much quicker than building it up the usual way.
+        body = cls.__new__(cls)
+        body._state = None
+        body._index = None
+
+        body.name = name
+        body.color = color
+        body.tags = tags
+        body.path_points = path_points
+
+        body.darker_color = tuple(int(0.5*x) for x in color)
+        body.mouse_hovering = False
+        body.selected = selected
+
+        return body
+
+    def size(self, scale, rescale_factor, radius=None):
         # meters / meters per pixel = pixels
-        size = self.radius/scale
+        size = (self.radius if radius is None else radius)/scale
         
         if 'planet' in self.tags:
             size *= rescale_factor
@@ -90,18 +128,11 @@ class Body:
         return size
 
     def update_acceleration(self, universe, G):
-        
-        self.acceleration = np.array([0,0,0], dtype=np.float64)
-        
-        for other in universe.objects:
 
-            if self == other:
-                continue
+        universe.sync_state()
+        state = universe.state
 
-            dist = other.position - self.position
-            dist_norm = math.sqrt(sum((dim**2 for dim in dist))+universe.softening**2)
-            
-            self.acceleration += G * other.mass * dist / dist_norm**3
+        self.acceleration = accelerations(self.position[np.newaxis], state.positions, state.masses, G, universe.softening)[0]
 
     def update_velocity(self, delta_time, fps):
         
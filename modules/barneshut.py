@@ -0,0 +1,276 @@
+import numpy as np
+
+try:
+    import numba
+except ModuleNotFoundError:
+    numba = None
+
+try:
+    import kernels
+    from cells import concatenated_ranges
+except ModuleNotFoundError:
+    from modules import kernels
+    from modules.cells import concatenated_ranges
+
+OCTANT_BITS = np.array([1, 2, 4])
+
+class Octree:
+
+    def __init__(self, positions, masses, leaf_size=8, max_depth=32):
+        n = len(positions)
+
+        low = positions.min(0)
+        high = positions.max(0)
+        root_half = max((high-low).max()/2, 1.0) * (1 + 1e-9)
+
+        # Particles are sorted so that every node owns a contiguous range of `order`.
+        order = np.arange(n)
+
+        centers = [((low+high)/2)[np.newaxis]]
+        halves = [np.array([root_half])]
+        starts = [np.array([0])]
+        counts = [np.array([n])]
+        links = []
+
+        level_first = 0
+        node_total = 1
+        depth = 0
+        level_bounds = [0, 1]
+
+        while True:
+            level_centers, level_halves, level_starts, level_counts = centers[-1], halves[-1], starts[-1], counts[-1]
+
+            split = np.flatnonzero(level_counts > leaf_size) if depth < max_depth else np.array([], dtype=int)
+            if not split.size:
+                break
+
+            split_starts = level_starts[split]
+            split_counts = level_counts[split]
+
+            indices, segments = concatenated_ranges(split_starts, split_counts)
+            particles = order[indices]
+
+            octants = ((positions[particles] > level_centers[split][segments]) * OCTANT_BITS).sum(1)
+            keys = segments*8 + octants
+            order[indices] = particles[np.argsort(keys, kind='stable')]
+
+            child_counts = np.bincount(keys, minlength=split.size*8).reshape(-1, 8)
+            child_starts = split_starts[:, np.newaxis] + np.cumsum(child_counts, 1) - child_counts
+
+            parent, octant = np.nonzero(child_counts)
+            child_ids = node_total + np.arange(parent.size)
+
+            links.append((level_first + split[parent], octant, child_ids))
+
+            signs = ((octant[:, np.newaxis] >> np.arange(3)) & 1)*2 - 1
+            child_halves = level_halves[split][parent] / 2
+
+            centers.append(level_centers[split][parent] + signs*child_halves[:, np.newaxis])
+            halves.append(child_halves)
+            starts.append(child_starts[parent, octant])
+            counts.append(child_counts[parent, octant])
+
+            level_first = node_total
+            node_total += parent.size
+            depth += 1
+            level_bounds.append(node_total)
+
+        self.positions = positions
+        self.masses = masses
+        self.order = order
+
+        self.centers = np.concatenate(centers)
+        self.halves = np.concatenate(halves)
+        self.starts = np.concatenate(starts)
+        self.counts = np.concatenate(counts)
+
+        self.children = np.full((node_total, 8), -1)
+        for parents, octants, child_ids in links:
+            self.children[parents, octants] = child_ids
+
+        self.is_leaf = (self.children < 0).all(1)
+        self.level_bounds = level_bounds
+
+        self.compute_moments()
+
+    def compute_moments(self):
+        # Leaves sum their own particles, internal nodes sum their children from the deepest level up.
+        n_nodes = len(self.counts)
+        leaves = np.flatnonzero(self.is_leaf)
+
+        indices, segments = concatenated_ranges(self.starts[leaves], self.counts[leaves])
+        particles = self.order[indices]
+        owners = leaves[segments]
+
+        mass = np.bincount(owners, weights=self.masses[particles], minlength=n_nodes)
+        moment = np.stack([np.bincount(owners, weights=self.masses[particles]*self.positions[particles, k], minlength=n_nodes) for k in range(3)], 1)
+
+        # Nodes are numbered level by level, so summing the levels from the deepest up
+        # guarantees that children are complete before their parent is summed.
+        for first, last in reversed(list(zip(self.level_bounds[:-1], self.level_bounds[1:]))):
+            nodes = first + np.flatnonzero(~self.is_leaf[first:last])
+            if not nodes.size:
+                continue
+            children = self.children[nodes]
+            valid = children >= 0
+            rows = np.where(valid, children, 0)
+            mass[nodes] = np.where(valid, mass[rows], 0).sum(1)
+            moment[nodes] = np.where(valid[..., np.newaxis], moment[rows], 0).sum(1)
+
+        self.mass = mass
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.center_of_mass = np.where(mass[:, np.newaxis] > 0, moment / mass[:, np.newaxis], self.centers)
+
+    def accelerations(self, G, softening, theta, chunk=2048):
+        if kernels.backend == 'numba':
+            acceleration = np.empty((len(self.positions), 3), dtype=np.float64)
+            numba_tree_accelerations(
+                np.ascontiguousarray(self.positions), np.ascontiguousarray(self.masses), self.order, self.starts, self.counts,
+                self.children, self.is_leaf, self.centers, self.halves, self.center_of_mass, self.mass,
+                np.flatnonzero(self.is_leaf), softening, theta, acceleration,
+            )
+            return G * acceleration
+
+        return self.numpy_accelerations(G, softening, theta, chunk)
+
+    def numpy_accelerations(self, G, softening, theta, chunk=2048):
+        # Walk the tree for all leaves at once, using each leaf as a group of targets: every iteration
+        # handles the current frontier of (leaf, node) pairs, accepting nodes that are far from the whole
+        # leaf as point masses, summing leaf pairs directly and opening everything else.
+        acceleration = np.zeros((len(self.positions), 3), dtype=np.float64)
+        leaves = np.flatnonzero(self.is_leaf)
+
+        for first in range(0, len(leaves), chunk):
+            groups = leaves[first:first+chunk]
+            nodes = np.zeros(len(groups), dtype=int)
+
+            while groups.size:
+                gap = np.abs(self.center_of_mass[nodes] - self.centers[groups]) - self.halves[groups][:, np.newaxis]
+                gap_sq = (np.maximum(gap, 0)**2).sum(1)
+
+                far = (2*self.halves[nodes])**2 < theta**2 * gap_sq
+                leaf = ~far & self.is_leaf[nodes]
+                opened = ~far & ~self.is_leaf[nodes]
+
+                targets, segments = self.group_particles(groups[far])
+                self.add_interactions(acceleration, targets, self.center_of_mass[nodes[far]][segments], self.mass[nodes[far]][segments], softening)
+
+                targets, segments = self.group_particles(groups[leaf])
+                sources, source_segments = self.group_particles(nodes[leaf][segments])
+                targets = targets[source_segments]
+                self.add_interactions(acceleration, targets, self.positions[sources], self.masses[sources], softening)
+
+                children = self.children[nodes[opened]]
+                valid = children >= 0
+                groups = np.repeat(groups[opened], valid.sum(1))
+                nodes = children[valid]
+
+        return G * acceleration
+
+    def group_particles(self, nodes):
+        # Particles owned by each node, and for each of them the position of its node in `nodes`.
+        indices, segments = concatenated_ranges(self.starts[nodes], self.counts[nodes])
+        return self.order[indices], segments
+
+    def add_interactions(self, acceleration, targets, source_positions, source_masses, softening):
+        dist = source_positions - self.positions[targets]
+        dist_sq = np.einsum('ij,ij->i', dist, dist)
+
+        # Coincident pairs (a body and itself) contribute nothing.
+        with np.errstate(divide='ignore'):
+            weights = np.where(dist_sq > 0, source_masses / (dist_sq + softening**2)**1.5, 0)
+
+        for k in range(3):
+            acceleration[:, k] += np.bincount(targets, weights=weights*dist[:, k], minlength=len(acceleration))
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_tree_accelerations(positions, masses, order, starts, counts, children, is_leaf, centers, halves, center_of_mass, mass, leaves, softening, theta, out):
+        # The same walk as numpy_accelerations, with every leaf going down the tree on a stack of its own.
+        # Each particle is in exactly one leaf, so the leaves can be spread over the cores.
+        softening_sq = softening*softening
+        theta_sq = theta*theta
+        for g in numba.prange(leaves.shape[0]):
+            group = leaves[g]
+            first = starts[group]
+            last = first + counts[group]
+            for k in range(first, last):
+                out[order[k], 0] = 0.0
+                out[order[k], 1] = 0.0
+                out[order[k], 2] = 0.0
+
+            # Every level pushes at most 8 children.
+            stack = np.empty(8*64 + 1, dtype=np.int64)
+            stack[0] = 0
+            top = 1
+            while top:
+                top -= 1
+                node = stack[top]
+
+                gap_sq = 0.0
+                for axis in range(3):
+                    gap = abs(center_of_mass[node, axis] - centers[group, axis]) - halves[group]
+                    if gap > 0:
+                        gap_sq += gap*gap
+
+                size = 2*halves[node]
+                if size*size < theta_sq*gap_sq:
+                    sources_first = node
+                    sources_last = -1
+                elif is_leaf[node]:
+                    sources_first = starts[node]
+                    sources_last = starts[node] + counts[node]
+                else:
+                    for octant in range(8):
+                        if children[node, octant] >= 0:
+                            stack[top] = children[node, octant]
+                            top += 1
+                    continue
+
+                for k in range(first, last):
+                    i = order[k]
+                    ax = 0.0
+                    ay = 0.0
+                    az = 0.0
+                    if sources_last < 0:
+                        # A far node, as a point mass
+                        dx = center_of_mass[node, 0] - positions[i, 0]
+                        dy = center_of_mass[node, 1] - positions[i, 1]
+                        dz = center_of_mass[node, 2] - positions[i, 2]
+                        dist_sq = dx*dx + dy*dy + dz*dz
+                        if dist_sq > 0:
+                            inverse = 1 / np.sqrt(dist_sq + softening_sq)
+                            weight = mass[node] * inverse*inverse*inverse
+                            ax = weight*dx
+                            ay = weight*dy
+                            az = weight*dz
+                    else:
+                        for s in range(sources_first, sources_last):
+                            j = order[s]
+                            dx = positions[j, 0] - positions[i, 0]
+                            dy = positions[j, 1] - positions[i, 1]
+                            dz = positions[j, 2] - positions[i, 2]
+                            dist_sq = dx*dx + dy*dy + dz*dz
+                            if dist_sq > 0:
+                                inverse = 1 / np.sqrt(dist_sq + softening_sq)
+                                weight = masses[j] * inverse*inverse*inverse
+                                ax += weight*dx
+                                ay += weight*dy
+                                az += weight*dz
+                    out[i, 0] += ax
+                    out[i, 1] += ay
+                    out[i, 2] += az
+
+class BarnesHutSolver:
+
+    def __init__(self, theta=0.5, leaf_size=8, chunk=2048):
+        self.theta = theta
+        self.leaf_size = leaf_size
+        self.chunk = chunk
+        self.tree = None
+
+    def accelerations(self, positions, masses, G, softening):
+        # The tree is rebuilt from scratch every step.
+        self.tree = Octree(positions, masses, self.leaf_size)
+        return self.tree.accelerations(G, softening, self.theta, self.chunk)
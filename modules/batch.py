@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+try:
+    import const
+    import systems
+    import kernels
+    import solvers
+    import integrators
+    import recorder
+    import statecache
+    import systems_core
+    from systems_core import System
+    from environment import Environment
+except ModuleNotFoundError:
+    from modules import const
+    from modules import systems
+    from modules import kernels
+    from modules import solvers
+    from modules import integrators
+    from modules import recorder
+    from modules import statecache
+    from modules import systems_core
+    from modules.systems_core import System
+    from modules.environment import Environment
+
+# Runs a system to a given time as fast as it goes, with no window, and writes its state along the way:
+#
+#   python -m modules.batch solar_system --until 3.15e8 --dt 3600 --snapshot-every 8.64e6 --output runs/solar
+
+SYSTEMS = {name: system for name, system in vars(systems).items() if isinstance(system, System)}
+
+def write_snapshot(environment, path):
+    environment.sync_state()
+    state = environment.state
+
+    np.savez(
+        path,
+        time=environment.time,
+        names=np.array([body.name for body in state.bodies]),
+        masses=state.masses,
+        radii=state.radii,
+        positions=state.positions,
+        velocities=state.velocities,
+        test_positions=environment.test_particles.positions,
+        test_velocities=environment.test_particles.velocities,
+    )
+
+def make_environment(system, dt, start_time=0, softening=5000, solver='direct', solver_options=None, integrator='leapfrog', integrator_options=None, continuous_collisions=False, shatter_factor=None, fragments=5, state_cache=None):
+    environment = Environment(system.name, start_time=start_time, delta_time=dt, softening=softening)
+    environment.solver = solvers.make_solver(solver, **dict(solver_options or {}))
+    environment.integrator = integrators.make_integrator(integrator, **dict(integrator_options or {}))
+    environment.continuous_collisions = continuous_collisions
+    environment.shatter_factor = shatter_factor
+    environment.fragments = fragments
+    environment.load(system, statecache.StateCache(state_cache) if state_cache else None)
+
+    return environment
+
+def run(system, until, dt, start_time=0, snapshot_every=None, output='batch_output', record=None, record_every=1, record_compress=False, belt=None, **options):
+    os.makedirs(output, exist_ok=True)
+
+    environment = make_environment(system, dt, start_time, **options)
+    if belt:
+        systems_core.add_belt(environment, **belt)
+
+    trajectory_recorder = None
+    if record:
+        trajectory_recorder = recorder.Recorder(record, record_every, compress=record_compress)
+        trajectory_recorder.record(environment)
+
+    snapshots = 0
+    next_snapshot = start_time
+    started = time.perf_counter()
+
+    while True:
+        if snapshot_every and environment.time >= next_snapshot:
+            write_snapshot(environment, os.path.join(output, f"snapshot_{snapshots:06d}.npz"))
+            snapshots += 1
+            next_snapshot += snapshot_every
+
+        if environment.time >= until:
+            break
+
+        # The last step is shortened to end exactly on time.
+        environment.advance(min(dt, until - environment.time), const.G)
+
+        if trajectory_recorder:
+            trajectory_recorder.record(environment)
+
+    if trajectory_recorder:
+        trajectory_recorder.close()
+
+    write_snapshot(environment, os.path.join(output, 'final.npz'))
+    print(f"{system.name}: t = {environment.time:.6g} s, {len(environment.object_dict)} bodies, {snapshots} snapshots in {time.perf_counter() - started:.2f} s")
+
+    return environment
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m modules.batch', description='Run a system without a window and save its state.')
+    parser.add_argument('system', choices=sorted(SYSTEMS))
+    parser.add_argument('--until', type=float, required=True, help='simulation time to stop at, in seconds')
+    parser.add_argument('--dt', type=float, default=3600, help='time step in seconds')
+    parser.add_argument('--start-time', type=float, default=0)
+    parser.add_argument('--snapshot-every', type=float, default=None, help='simulation seconds between snapshots')
+    parser.add_argument('--output', default='batch_output', help='directory for the .npz files')
+    parser.add_argument('--solver', default='direct', choices=sorted(solvers.SOLVERS))
+    parser.add_argument('--solver-options', type=json.loads, default={}, help='JSON object of keyword arguments')
+    parser.add_argument('--integrator', default='leapfrog', choices=sorted(integrators.INTEGRATORS))
+    parser.add_argument('--integrator-options', type=json.loads, default={}, help='JSON object of keyword arguments')
+    parser.add_argument('--kernel-backend', default='auto', choices=['auto'] + sorted(kernels.BACKENDS))
+    parser.add_argument('--continuous-collisions', action='store_true', help='find collisions along the whole step, needed for --shatter-factor')
+    parser.add_argument('--shatter-factor', type=float, default=None)
+    parser.add_argument('--fragments', type=int, default=5)
+    parser.add_argument('--belt', type=json.loads, default=None, help='JSON object of add_belt arguments, e.g. {"parent": "Sun", "count": 100000, "inner": 3.1e11, "outer": 4.9e11}')
+    parser.add_argument('--record', default=None, help='directory to record the whole trajectory to')
+    parser.add_argument('--record-every', type=int, default=1, help='steps between recorded states')
+    parser.add_argument('--record-compress', action='store_true')
+    parser.add_argument('--state-cache', default=None, help='directory to cache initial states in')
+    args = parser.parse_args(arguments)
+
+    kernels.use_backend(args.kernel_backend)
+
+    run(
+        SYSTEMS[args.system],
+        args.until,
+        args.dt,
+        start_time=args.start_time,
+        snapshot_every=args.snapshot_every,
+        output=args.output,
+        record=args.record,
+        record_every=args.record_every,
+        record_compress=args.record_compress,
+        belt=args.belt,
+        solver=args.solver,
+        solver_options=args.solver_options,
+        integrator=args.integrator,
+        integrator_options=args.integrator_options,
+        continuous_collisions=args.continuous_collisions,
+        shatter_factor=args.shatter_factor,
+        fragments=args.fragments,
+        state_cache=args.state_cache,
+    )
+
+if __name__ == '__main__':
+    main()
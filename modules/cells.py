@@ -0,0 +1,70 @@
+import numpy as np
+
+NEIGHBOR_OFFSETS = np.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)])
+
+def concatenated_ranges(starts, counts):
+    # Indices of the ranges [start, start+count) laid end to end, plus the range each index came from.
+    segments = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    indices = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+    return indices, segments
+
+class CellList:
+    # Items binned into the cells of a uniform integer grid. Only occupied cells are stored,
+    # so a sparse system on a fine grid costs no more than a dense one.
+
+    def __init__(self, cells):
+        self.cells = cells
+        self.shape = cells.max(0) + 1 if len(cells) else np.ones(3, dtype=np.int64)
+
+        if np.prod(self.shape.astype(np.float64)) >= 2**62:
+            raise ValueError("Cell grid is too fine to be indexed, use larger cells")
+
+        keys = self.key(cells)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys, self.starts, self.counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+        self.occupied = cells[self.order[self.starts]]
+
+    @classmethod
+    def from_positions(cls, positions, cell_size, origin=None):
+        if origin is None:
+            origin = positions.min(0)
+        return cls(np.floor((positions - origin) / cell_size).astype(np.int64))
+
+    def key(self, cells):
+        return (cells[..., 0]*self.shape[1] + cells[..., 1])*self.shape[2] + cells[..., 2]
+
+    def find(self, cells):
+        # Index of the occupied cell at each coordinate, or -1 where that cell is empty or outside the grid.
+        inside = ((cells >= 0) & (cells < self.shape)).all(-1)
+        keys = self.key(np.where(inside[..., np.newaxis], cells, 0))
+
+        if not len(self.keys):
+            return np.full(keys.shape, -1)
+
+        found = np.searchsorted(self.keys, keys).clip(max=len(self.keys)-1)
+        return np.where(inside & (self.keys[found] == keys), found, -1)
+
+    def members(self, cell_ids):
+        # Items in each of the given occupied cells, and for each of them the position of its cell in `cell_ids`.
+        indices, segments = concatenated_ranges(self.starts[cell_ids], self.counts[cell_ids])
+        return self.order[indices], segments
+
+    def neighbor_pairs(self, offsets=NEIGHBOR_OFFSETS, max_pairs=2**22):
+        # Yields (i, j) index arrays pairing every item i with every item j in a cell at one of the
+        # offsets from the cell of i, at most about `max_pairs` at a time so that crowded cells stay in memory.
+        # With the default offsets this includes i paired with itself.
+        for offset in offsets:
+            found = self.find(self.cells + offset)
+            items = np.flatnonzero(found >= 0)
+            if not items.size:
+                continue
+
+            totals = np.cumsum(self.counts[found[items]])
+            splits = np.searchsorted(totals, np.arange(1, totals[-1] // max_pairs + 1) * max_pairs)
+
+            for chunk in np.split(items, splits):
+                if not chunk.size:
+                    continue
+                others, segments = self.members(found[chunk])
+                yield chunk[segments], others
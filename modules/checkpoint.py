@@ -0,0 +1,233 @@
+import gc
+import os
+import json
+import time
+import queue
+import threading
+import contextlib
+
+import numpy as np
+
+try:
+    import systems
+    import integrators
+    from systems_core import System
+    from ObjectClasses import Body
+    from particles import TestParticles
+    from environment import Environment
+except ModuleNotFoundError:
+    from modules import systems
+    from modules import integrators
+    from modules.systems_core import System
+    from modules.ObjectClasses import Body
+    from modules.particles import TestParticles
+    from modules.environment import Environment
+
+# Checkpoints of a whole Environment as an uncompressed .npz file: the body arrays exactly as they are,
+# their names, colors, tags and trails, the test particles, and the integrator with whatever it keeps between steps, so that
+# a resumed run carries on bit for bit as if it had never stopped. The integrator is saved as its name,
+# its options and its kept arrays, and made again from them; nothing in a checkpoint is pickled, so
+# opening one cannot run code. The solver is not saved; resuming uses whichever one the environment has.
+
+FORMAT_VERSION = 2
+
+@contextlib.contextmanager
+def paused_gc():
+    # Tens of thousands of bodies with their trails are millions of objects, which the collector would
+    # go through again and again while more of them are made.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def capture(environment):
+    with paused_gc():
+        return capture_state(environment)
+
+def capture_state(environment):
+    # Everything a checkpoint holds, copied, so that the simulation can go on while it is written.
+    environment.sync_state()
+    state = environment.state
+    bodies = state.bodies
+
+    system_name = next((name for name, system in vars(systems).items() if system is environment.system and isinstance(system, System)), '')
+
+    return {
+        'version': FORMAT_VERSION,
+        'name': environment.name,
+        'system': system_name,
+        'time': environment.time,
+        'delta_time': environment.delta_time,
+        'softening': environment.softening,
+        'G': environment.G,
+        'continuous_collisions': environment.continuous_collisions,
+        'shatter_factor': np.nan if environment.shatter_factor is None else environment.shatter_factor,
+        'fragments': environment.fragments,
+
+        'positions': state.positions.copy(),
+        'velocities': state.velocities.copy(),
+        'accelerations': state.accelerations.copy(),
+        'masses': state.masses.copy(),
+        'radii': state.radii.copy(),
+        'accelerations_current': state.accelerations_current,
+
+        'names': [body.name for body in bodies],
+        'colors': np.array([body.color for body in bodies], dtype=np.uint8).reshape(-1, 3),
+        'tags': [body.tags for body in bodies],
+        'selected': np.array([body.selected for body in bodies], dtype=bool),
+        # The points are never changed once they are in a trail, so copying the lists is enough.
+        'path_points': [list(body.path_points) for body in bodies],
+        'last_path': [(getattr(body, 'old_position', None), getattr(body, 'new_position', None)) for body in bodies],
+
+        'integrator': integrators.integrator_name(environment.integrator),
+        'integrator_options': environment.integrator.options(),
+        'integrator_state': environment.integrator.kept_state(),
+
+        'test_positions': environment.test_particles.positions.copy(),
+        'test_velocities': environment.test_particles.velocities.copy(),
+        'test_accelerations': environment.test_particles.accelerations.copy(),
+        'test_source_positions': np.empty((0, 3)) if environment.test_particles.source_positions is None else environment.test_particles.source_positions.copy(),
+        'test_color': np.array(environment.test_particles.color, dtype=np.uint8),
+    }
+
+def write(path, captured):
+    # Written next to the old checkpoint and then moved over it, so that there always is a whole one.
+    trails = captured['path_points']
+    lengths = np.array([len(trail) for trail in trails], dtype=np.int64)
+    points = np.array([point for trail in trails for point in trail], dtype=np.float64).reshape(-1, 3)
+
+    positions = captured['positions']
+    last_path = np.empty((len(positions), 2, 3), dtype=np.float64)
+    for k, (old_position, new_position) in enumerate(captured['last_path']):
+        last_path[k, 0] = positions[k] if old_position is None else old_position
+        last_path[k, 1] = positions[k] if new_position is None else new_position
+
+    # Most bodies share their tags with many others, so each different list is stored once.
+    tag_lists = {}
+    tag_indices = np.array([tag_lists.setdefault(tuple(tags), len(tag_lists)) for tags in captured['tags']], dtype=np.int64)
+
+    arrays = {key: value for key, value in captured.items() if key not in ('names', 'tags', 'path_points', 'last_path', 'integrator', 'integrator_options', 'integrator_state')}
+    arrays.update(
+        names=np.array(captured['names'], dtype=str),
+        tag_lists=np.array(json.dumps(list(tag_lists))),
+        tag_indices=tag_indices,
+        path_lengths=lengths,
+        path_points=points,
+        last_path=last_path,
+        integrator=np.array(captured['integrator']),
+        integrator_options=np.array(json.dumps(captured['integrator_options'])),
+    )
+    arrays.update((f"integrator.{name}", value) for name, value in captured['integrator_state'].items())
+
+    temporary = f"{path}.partial"
+    with open(temporary, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(temporary, path)
+
+def save(environment, path):
+    write(path, capture(environment))
+
+def load(path, environment=None):
+    # Restores the checkpoint into the given environment, replacing its bodies, or into a new one.
+    with paused_gc(), np.load(path) as checkpoint:
+        if int(checkpoint['version']) != FORMAT_VERSION:
+            raise ValueError(f"{path} is a version {int(checkpoint['version'])} checkpoint, expected version {FORMAT_VERSION}")
+
+        if environment is None:
+            environment = Environment(str(checkpoint['name']))
+
+        environment.name = str(checkpoint['name'])
+        environment.system = getattr(systems, str(checkpoint['system']), None) if str(checkpoint['system']) else None
+        environment.time = checkpoint['time'].item()
+        environment.delta_time = checkpoint['delta_time'].item()
+        environment.softening = checkpoint['softening'].item()
+        environment.G = checkpoint['G'].item()
+        environment.continuous_collisions = bool(checkpoint['continuous_collisions'])
+        shatter_factor = checkpoint['shatter_factor'].item()
+        environment.shatter_factor = None if np.isnan(shatter_factor) else shatter_factor
+        environment.fragments = int(checkpoint['fragments'])
+
+        names = checkpoint['names'].tolist()
+        colors = [tuple(color) for color in checkpoint['colors'].tolist()]
+        tag_lists = json.loads(str(checkpoint['tag_lists']))
+        tags = [list(tag_lists[index]) for index in checkpoint['tag_indices'].tolist()]
+        selected = checkpoint['selected'].tolist()
+        trails = np.split(checkpoint['path_points'], np.cumsum(checkpoint['path_lengths'])[:-1])
+        last_path = checkpoint['last_path']
+
+        bodies = [Body.restored(name, color, body_tags, list(trail), chosen) for name, color, body_tags, trail, chosen in zip(names, colors, tags, trails, selected)]
+        for body, (old_position, new_position) in zip(bodies, last_path):
+            body.old_position = old_position
+            body.new_position = new_position
+
+        environment.state.adopt(
+            bodies,
+            checkpoint['positions'],
+            checkpoint['velocities'],
+            checkpoint['accelerations'],
+            checkpoint['masses'],
+            checkpoint['radii'],
+            bool(checkpoint['accelerations_current']),
+        )
+        environment.object_dict = {body.name: body for body in bodies}
+        environment.integrator = integrators.make_integrator(str(checkpoint['integrator']), **json.loads(str(checkpoint['integrator_options'])))
+        environment.integrator.restore_state({name[len('integrator.'):]: checkpoint[name] for name in checkpoint.files if name.startswith('integrator.')})
+
+        particles = environment.test_particles = TestParticles(color=tuple(checkpoint['test_color'].tolist()))
+        particles.positions = checkpoint['test_positions']
+        particles.velocities = checkpoint['test_velocities']
+        particles.accelerations = checkpoint['test_accelerations']
+        if len(checkpoint['test_source_positions']):
+            particles.source_positions = checkpoint['test_source_positions']
+
+    return environment
+
+class CheckpointWriter:
+    # Writes checkpoints from a thread of its own. The step loop only pays for copying the state; if the
+    # last checkpoint is still waiting to be written when the next one is due, the next one is skipped.
+
+    def __init__(self, path, interval=None):
+        self.path = path
+        self.interval = interval
+        self.last_time = time.monotonic()
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            captured = self.queue.get()
+            if captured is None:
+                return
+
+            try:
+                write(self.path, captured)
+            except Exception as error:
+                self.error = error
+                print(f"Could not write checkpoint {self.path}: {error}")
+
+    def submit(self, environment):
+        if self.queue.full():
+            return False
+
+        self.queue.put(capture(environment))
+        self.last_time = time.monotonic()
+        return True
+
+    def maybe_submit(self, environment):
+        # A checkpoint every `interval` seconds of wall time.
+        if self.interval is not None and time.monotonic() - self.last_time >= self.interval:
+            return self.submit(environment)
+        return False
+
+    def close(self, environment=None):
+        # Waits for what is queued, and writes one last checkpoint of the environment if given.
+        if environment is not None:
+            self.queue.put(capture(environment))
+        self.queue.put(None)
+        self.thread.join()
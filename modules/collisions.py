@@ -0,0 +1,227 @@
+import numpy as np
+
+try:
+    import kernels
+    from cells import CellList, NEIGHBOR_OFFSETS
+except ModuleNotFoundError:
+    from modules import kernels
+    from modules.cells import CellList, NEIGHBOR_OFFSETS
+
+# Up to these numbers of bodies, comparing every pair with the kernels of each backend is quicker than
+# building the grid, which costs a few milliseconds however few bodies there are.
+BRUTE_FORCE_LIMITS = {'numpy': 512, 'numba': 4096}
+
+def candidate_pairs(positions, radii, max_pairs=2**22):
+    # Hierarchical hash grid: every body is binned in the level whose cells are at least as wide as its
+    # diameter, levels doubling in size, so that one planet does not make the cells of a thousand rocks
+    # huge. Each body looks for partners in the 27 cells around it on its own level and every coarser one,
+    # which covers every body at least as large within reach. Yields (i, j) batches of at most about
+    # `max_pairs` pairs, i != j, with the pairs on a level found from both sides.
+    if len(positions) < 2:
+        return
+
+    origin = positions.min(0)
+    extent = max((positions.max(0) - origin).max(), 1.0)
+
+    # Cells finer than the grid can index are just made coarser, which is only slower.
+    smallest = max(2*radii.min(), extent / 2**20)
+    levels = np.maximum(np.ceil(np.log2(np.maximum(2*radii, smallest) / smallest)), 0).astype(np.int64)
+
+    for level in np.unique(levels):
+        cell = smallest * 2.0**level
+        binned = np.flatnonzero(levels == level)
+        grid = CellList(np.floor((positions[binned] - origin) / cell).astype(np.int64))
+
+        searching = np.flatnonzero(levels <= level)
+        cells = np.floor((positions[searching] - origin) / cell).astype(np.int64)
+
+        # A level of few large bodies is only searched by the bodies next to one of its cells.
+        if len(NEIGHBOR_OFFSETS)*len(grid.occupied) < len(searching):
+            surroundings = CellList((grid.occupied[:, np.newaxis, :] + 1 + NEIGHBOR_OFFSETS).reshape(-1, 3))
+            near = surroundings.find(cells + 1) >= 0
+            searching, cells = searching[near], cells[near]
+
+        # Cells looked up in order are found much faster.
+        order = np.argsort(grid.key(np.maximum(cells, 0)), kind='stable')
+        searching, cells = searching[order], cells[order]
+
+        for offset in NEIGHBOR_OFFSETS:
+            found = grid.find(cells + offset)
+            items = np.flatnonzero(found >= 0)
+            if not items.size:
+                continue
+
+            totals = np.cumsum(grid.counts[found[items]])
+            splits = np.searchsorted(totals, np.arange(1, totals[-1] // max_pairs + 1) * max_pairs)
+
+            for chunk in np.split(items, splits):
+                if not chunk.size:
+                    continue
+                others, segments = grid.members(found[chunk])
+                i, j = searching[chunk[segments]], binned[others]
+                yield i[i != j], j[i != j]
+
+def contact_pairs(positions, radii, softening):
+    # Pairs (i, j), i < j, whose softened distance is less than the sum of their radii, sorted by i then j.
+    if len(positions) <= BRUTE_FORCE_LIMITS.get(kernels.backend, 0):
+        return kernels.collision_pairs(positions, radii, softening)
+    return grid_contact_pairs(positions, radii, softening)
+
+def grid_contact_pairs(positions, radii, softening):
+    found = []
+
+    for i, j in candidate_pairs(positions, radii):
+        dist = positions[j] - positions[i]
+        touching = np.einsum('ij,ij->i', dist, dist) + softening**2 < (radii[i] + radii[j])**2
+        found.append(np.sort(np.stack((i[touching], j[touching]), axis=1), axis=1))
+
+    if not found:
+        return np.empty((0, 2), dtype=np.int64)
+
+    # Pairs within a level were found from both of their bodies.
+    return np.unique(np.concatenate(found), axis=0)
+
+def impact_times(old_positions, positions, radii, softening):
+    # Swept spheres: every body moves in a straight line from its old position to its new one during the
+    # step, and each pair that touches at some point gets the earliest fraction of the step at which it
+    # does, by the same softened criterion. Returns the pairs (i, j), i < j, and their times, in order of time.
+    displacements = positions - old_positions
+    reach = radii + np.linalg.norm(displacements, axis=1) / 2
+
+    found_pairs, found_times = [], []
+    for i, j in candidate_pairs((old_positions + positions) / 2, reach):
+        i, j = np.minimum(i, j), np.maximum(i, j)
+
+        start = old_positions[j] - old_positions[i]
+        motion = displacements[j] - displacements[i]
+        limit = (radii[i] + radii[j])**2 - softening**2
+
+        # |start + motion*t|**2 = limit
+        a = np.einsum('ij,ij->i', motion, motion)
+        b = 2*np.einsum('ij,ij->i', start, motion)
+        c = np.einsum('ij,ij->i', start, start) - limit
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            times = np.where(c < 0, 0, (-b - np.sqrt(b**2 - 4*a*c)) / (2*a))
+
+        hit = (limit > 0) & (times >= 0) & (times <= 1)
+        found_pairs.append(np.stack((i[hit], j[hit]), axis=1))
+        found_times.append(times[hit])
+
+    if not found_pairs:
+        return np.empty((0, 2), dtype=np.int64), np.empty(0)
+
+    # Pairs within a level were found from both of their bodies.
+    pairs, first = np.unique(np.concatenate(found_pairs), axis=0, return_index=True)
+    times = np.concatenate(found_times)[first]
+
+    order = np.lexsort((pairs[:, 1], pairs[:, 0], times))
+    return pairs[order], times[order]
+
+def connected_groups(pairs, n):
+    # Label of the connected group of every body, the lowest index in it, found by propagating labels along
+    # the pairs and then following them to their roots.
+    labels = np.arange(n)
+    if not len(pairs):
+        return labels
+
+    while True:
+        low = np.minimum(labels[pairs[:, 0]], labels[pairs[:, 1]])
+        updated = labels.copy()
+        np.minimum.at(updated, pairs[:, 0], low)
+        np.minimum.at(updated, pairs[:, 1], low)
+        updated = updated[updated]
+
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+def merge_contacts(environment, pairs):
+    # Every group of touching bodies becomes its most massive member (the first of them on a tie), which
+    # stays where it is and takes the total mass and momentum of the group. Returns the names of the
+    # absorbed bodies.
+    state = environment.state
+    if not len(pairs):
+        return []
+
+    labels = connected_groups(pairs, len(state))
+    merging = np.flatnonzero(np.bincount(labels, minlength=len(state))[labels] > 1)
+
+    removed_bodies = []
+    for label in np.unique(labels[merging]):
+        members = merging[labels[merging] == label]
+        survivor = members[np.argmax(state.masses[members])]
+
+        masses = state.masses[members, np.newaxis]
+        mass = masses.sum()
+        velocity = (masses * state.velocities[members]).sum(0) / mass
+
+        larger = state.bodies[survivor]
+        for member in members:
+            if member != survivor:
+                print(f"{state.bodies[member].name} collided with {larger.name}")
+                removed_bodies.append(state.bodies[member].name)
+
+        larger.mass = mass
+        larger.velocity = velocity
+
+    return removed_bodies
+
+def shatter_impacts(environment, old_positions, pairs, times, dt, shatter_factor, fragments):
+    # Goes through the impacts in order of time. Where the speed of impact is more than shatter_factor times
+    # the escape speed of the pair, the smaller body shatters where it was at that moment, and the fragments
+    # move on for the rest of the step. Later impacts of a shattered body never happen, and a body that has
+    # already merged with another only merges again. Returns the pairs left to merge, the shattered bodies
+    # and the fragments.
+    state = environment.state
+    removed_bodies, new_bodies = [], {}
+    shattered = np.zeros(len(state), dtype=bool)
+    merged = np.zeros(len(state), dtype=bool)
+    merging = []
+
+    for (i, j), time in zip(pairs, times):
+        if shattered[i] or shattered[j]:
+            continue
+
+        if shatter_factor is not None and not (merged[i] or merged[j]):
+            speed = np.linalg.norm(state.velocities[j] - state.velocities[i])
+            escape_speed = np.sqrt(2*environment.G*(state.masses[i] + state.masses[j]) / (state.radii[i] + state.radii[j]))
+
+            if speed > shatter_factor*escape_speed:
+                smaller, larger = sorted((i, j), key=lambda k: (state.masses[k], k))
+                body = state.bodies[smaller]
+                print(f"{body.name} shattered on {state.bodies[larger].name}")
+
+                body.position = old_positions[smaller] + (state.positions[smaller] - old_positions[smaller])*time
+                pieces = {}
+                body.shatter(fragments, removed_bodies, pieces)
+
+                for piece in pieces.values():
+                    piece.position = piece.position + piece.velocity*(1 - time)*dt
+                new_bodies.update(pieces)
+
+                shattered[smaller] = True
+                continue
+
+        merging.append((i, j))
+        merged[[i, j]] = True
+
+    return np.array(merging, dtype=np.int64).reshape(-1, 2), removed_bodies, new_bodies
+
+def resolve_collisions(environment, old_positions=None, dt=0, shatter_factor=None, fragments=5):
+    # With the positions from the start of the step, collisions anywhere along the way are found, so that
+    # fast bodies cannot pass through each other; without them only the bodies touching now collide.
+    # Returns the names of the bodies that are gone and a dict of new bodies.
+    environment.sync_state()
+    state = environment.state
+
+    if old_positions is None:
+        pairs = state.current_contacts(environment.softening)
+        if pairs is None:
+            pairs = contact_pairs(state.positions, state.radii, environment.softening)
+        return merge_contacts(environment, pairs), {}
+
+    pairs, times = impact_times(old_positions, state.positions, state.radii, environment.softening)
+    pairs, removed_bodies, new_bodies = shatter_impacts(environment, old_positions, pairs, times, dt, shatter_factor, fragments)
+
+    return removed_bodies + merge_contacts(environment, pairs), new_bodies
@@ -0,0 +1,245 @@
+import io
+import copy
+import json
+import argparse
+import contextlib
+
+import numpy as np
+
+try:
+    import const
+    import kernels
+    import systems
+    import integrators
+    from systems_core import System
+    from environment import Environment
+except ModuleNotFoundError:
+    from modules import const
+    from modules import kernels
+    from modules import systems
+    from modules import integrators
+    from modules.systems_core import System
+    from modules.environment import Environment
+
+# Many copies of one system with slightly different orbital elements, advanced together as (K,N,3) arrays
+# by the batched force kernel, for studying how quickly nearby orbits drift apart. Member 0 is always the
+# unperturbed system and serves as the reference for the diagnostics. Bodies are never merged here.
+#
+#   python -m modules.ensemble solar_system --members 200 --until 3.15e9 --dt 86400 --record-every 3.15e7
+
+# Standard deviations of the perturbations: a relative to itself, e as is, the angles in degrees.
+PERTURBATIONS = {
+    'a': 1e-9,
+    'e': 1e-9,
+    'i': 1e-7,
+    'lon_AN': 1e-7,
+    'lon_Pe': 1e-7,
+    'ML': 1e-7,
+}
+
+def perturbed_system(system, rng, scale=1.0, perturbations=PERTURBATIONS):
+    # Copy of the system in which every orbiting object has its elements nudged by normal random amounts.
+    def perturbed(raw_object):
+        raw_object = copy.copy(raw_object)
+        for element, spread in perturbations.items():
+            value = getattr(raw_object, element)
+            if value is None:
+                continue
+
+            if element == 'a':
+                value *= 1 + scale*spread*rng.standard_normal()
+            elif element == 'e':
+                value = abs(value + scale*spread*rng.standard_normal())
+            else:
+                value += scale*spread*rng.standard_normal()
+            setattr(raw_object, element, value)
+
+        return raw_object
+
+    planets = [perturbed_system(planet, rng, scale, perturbations) if isinstance(planet, System) else perturbed(planet) for planet in system.planets]
+    return System(system.name, perturbed(system.parent), planets)
+
+def load_state(system, start_time=0):
+    # Names, masses, positions and velocities of the system as the viewer would load it.
+    environment = Environment(system.name, start_time=start_time)
+    with contextlib.redirect_stdout(io.StringIO()):
+        environment.load(system)
+
+    environment.sync_state()
+    state = environment.state
+    return [body.name for body in state.bodies], state.masses.copy(), state.positions.copy(), state.velocities.copy()
+
+class Ensemble:
+
+    def __init__(self, names, masses, positions, velocities, start_time=0, softening=5000, G=const.G, weights=integrators.Leapfrog.weights):
+        self.names = list(names)
+        self.masses = np.array(masses, dtype=np.float64)
+        self.positions = np.array(positions, dtype=np.float64)
+        self.velocities = np.array(velocities, dtype=np.float64)
+        self.accelerations = np.empty_like(self.positions)
+        self.accelerations_current = False
+
+        self.time = start_time
+        self.softening = softening
+        self.G = G
+        # Substeps of the kick-drift-kick leapfrog, as in the integrators, e.g. integrators.Yoshida4.weights.
+        self.weights = weights
+
+        self.start_time = start_time
+        self.start_energies = self.energies()
+
+        # Typical size and speed of the reference system, for putting distances and velocities on one scale.
+        reference_positions = self.positions[0] - np.average(self.positions[0], axis=0, weights=self.masses[0])
+        reference_velocities = self.velocities[0] - np.average(self.velocities[0], axis=0, weights=self.masses[0])
+        self.length_scale = np.sqrt(np.mean(np.einsum('ij,ij->i', reference_positions, reference_positions)))
+        self.speed_scale = np.sqrt(np.mean(np.einsum('ij,ij->i', reference_velocities, reference_velocities)))
+
+        self.start_divergences = self.divergences()
+        self.history = []
+        self.record()
+
+    @classmethod
+    def from_system(cls, system, members, scale=1.0, seed=None, perturbations=PERTURBATIONS, start_time=0, **options):
+        rng = np.random.default_rng(seed)
+
+        names, masses, first_positions, first_velocities = load_state(system, start_time)
+        positions = np.empty((members,) + first_positions.shape)
+        velocities = np.empty_like(positions)
+        positions[0], velocities[0] = first_positions, first_velocities
+
+        for member in range(1, members):
+            member_names, _, member_positions, member_velocities = load_state(perturbed_system(system, rng, scale, perturbations), start_time)
+            # Every load lists the bodies in the same order, but matching by name costs nothing.
+            order = [member_names.index(name) for name in names]
+            positions[member], velocities[member] = member_positions[order], member_velocities[order]
+
+        return cls(names, np.broadcast_to(masses, (members, len(names))), positions, velocities, start_time, **options)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def update_accelerations(self):
+        kernels.batched_accelerations(self.positions, self.masses, self.G, self.softening, out=self.accelerations)
+        self.accelerations_current = True
+
+    def step(self, dt):
+        if not self.accelerations_current:
+            self.update_accelerations()
+
+        for weight in self.weights:
+            self.velocities += self.accelerations * (weight*dt/2)
+            self.positions += self.velocities * (weight*dt)
+            self.update_accelerations()
+            self.velocities += self.accelerations * (weight*dt/2)
+
+        self.time += dt
+
+    def run(self, until, dt, record_every=None):
+        next_record = self.time + (record_every or np.inf)
+
+        while self.time < until:
+            self.step(min(dt, until - self.time))
+
+            if self.time >= next_record:
+                self.record()
+                next_record += record_every
+
+        if self.history[-1][0] != self.time:
+            self.record()
+
+        return self
+
+    def energies(self):
+        kinetic = 0.5 * np.einsum('kn,kni,kni->k', self.masses, self.velocities, self.velocities)
+        return kinetic + kernels.batched_potential_energy(self.positions, self.masses, self.G, self.softening)
+
+    def energy_errors(self):
+        return np.abs((self.energies() - self.start_energies) / self.start_energies)
+
+    def separations(self):
+        # Distance of every body from itself in the reference member, (K,N).
+        offsets = self.positions - self.positions[0]
+        return np.sqrt(np.einsum('kni,kni->kn', offsets, offsets))
+
+    def divergences(self):
+        # Phase-space distance of every member from the reference, with positions in units of the size of
+        # the system and velocities in units of its typical speed, (K,).
+        offsets = (self.positions - self.positions[0]) / self.length_scale
+        velocity_offsets = (self.velocities - self.velocities[0]) / self.speed_scale
+        return np.sqrt(np.einsum('kni,kni->k', offsets, offsets) + np.einsum('kni,kni->k', velocity_offsets, velocity_offsets)) / np.sqrt(len(self.names))
+
+    def record(self):
+        self.history.append((self.time, self.divergences(), self.energy_errors()))
+
+    def lyapunov_exponents(self):
+        # Finite-time Lyapunov exponent of every member, the least-squares slope of log(divergence) over the
+        # recorded times, in 1/s. Its inverse is the time over which the differences grow e-fold. The reference
+        # member, and any member with nothing recorded, gets nan.
+        times = np.array([time for time, _, _ in self.history]) - self.start_time
+        exponents = np.full(len(self), np.nan)
+        if len(times) < 2:
+            return exponents
+
+        with np.errstate(divide='ignore'):
+            logs = np.log(np.array([divergences for _, divergences, _ in self.history]))
+
+        finite = np.all(np.isfinite(logs), axis=0)
+        if finite.any():
+            exponents[finite] = np.polyfit(times, logs[:, finite], 1)[0]
+
+        return exponents
+
+    def report(self):
+        exponents = self.lyapunov_exponents()[1:]
+        divergences = self.divergences()[1:]
+        print(f"{len(self)} members of {len(self.names)} bodies at t = {self.time:.6g} s")
+        print(f"divergence from the reference: median {np.median(divergences):.3e}, max {np.max(divergences):.3e} (start {np.median(self.start_divergences[1:]):.3e})")
+        print(f"Lyapunov exponent: median {np.nanmedian(exponents):.3e} /s, max {np.nanmax(exponents):.3e} /s")
+        print(f"energy error: median {np.median(self.energy_errors()):.3e}, max {np.max(self.energy_errors()):.3e}")
+
+    def save(self, path):
+        np.savez(
+            path,
+            names=np.array(self.names),
+            times=np.array([time for time, _, _ in self.history]),
+            divergences=np.array([divergences for _, divergences, _ in self.history]),
+            energy_errors=np.array([errors for _, _, errors in self.history]),
+            lyapunov_exponents=self.lyapunov_exponents(),
+            positions=self.positions,
+            velocities=self.velocities,
+        )
+
+def main(arguments=None):
+    system_names = sorted(name for name, system in vars(systems).items() if isinstance(system, System))
+
+    parser = argparse.ArgumentParser(prog='python -m modules.ensemble', description='Run many perturbed copies of a system together.')
+    parser.add_argument('system', choices=system_names)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--until', type=float, required=True, help='simulation time to stop at, in seconds')
+    parser.add_argument('--dt', type=float, default=3600, help='time step in seconds')
+    parser.add_argument('--start-time', type=float, default=0)
+    parser.add_argument('--record-every', type=float, default=None, help='simulation seconds between diagnostics')
+    parser.add_argument('--scale', type=float, default=1.0, help='factor on all the perturbations')
+    parser.add_argument('--perturbations', type=json.loads, default=PERTURBATIONS, help='JSON object of element: spread')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--integrator', default='leapfrog', choices=['leapfrog', 'yoshida4', 'yoshida6'])
+    parser.add_argument('--output', default=None, help='.npz file for the diagnostics and final states')
+    args = parser.parse_args(arguments)
+
+    ensemble = Ensemble.from_system(
+        getattr(systems, args.system),
+        args.members,
+        scale=args.scale,
+        seed=args.seed,
+        perturbations=args.perturbations,
+        start_time=args.start_time,
+        weights=integrators.INTEGRATORS[args.integrator].weights,
+    )
+    ensemble.run(args.until, args.dt, args.record_every)
+    ensemble.report()
+
+    if args.output:
+        ensemble.save(args.output)
+
+if __name__ == '__main__':
+    main()
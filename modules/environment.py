@@ -0,0 +1,108 @@
+import numpy as np
+
+try:
+    import const
+    import solvers
+    import integrators
+    import collisions
+    import systems_core
+    from particles import ParticleState, TestParticles
+except ModuleNotFoundError:
+    from modules import const
+    from modules import solvers
+    from modules import integrators
+    from modules import collisions
+    from modules import systems_core
+    from modules.particles import ParticleState, TestParticles
+
+class Environment:
+
+    def __init__(self, name, object_dict=None, start_time=0, delta_time=200000, softening=5000, G=6.6743*10**-11, solver=None, integrator=None):
+        self.name=name
+        self.object_dict = {} if object_dict is None else object_dict
+        self.time = start_time
+        self.delta_time = delta_time
+        self.softening = softening
+        self.G = G
+        self.system = None
+        self.state = ParticleState()
+        self.test_particles = TestParticles()
+        self.solver = solver or solvers.DirectSolver()
+        self.integrator = integrator or integrators.Leapfrog()
+
+        # Swept collisions need a search of their own, while bodies that touch at the end of a step come
+        # with the forces of direct summation for free. Impacts only shatter bodies with swept collisions.
+        self.continuous_collisions = False
+        self.shatter_factor = None
+        self.fragments = 5
+
+    @property
+    def mass(self):
+        return sum([body.mass for body in self.objects])
+
+    @property
+    def objects(self):
+        return self.object_dict.values()
+
+    def load(self, system, cache=None):
+        # With a StateCache, an empty environment takes the bodies from it if they are there, and they
+        # are put there otherwise.
+        self.name = system.name
+        self.system = system
+
+        cached = cache is not None and not self.object_dict
+        if cached and cache.load(self, system):
+            return
+
+        systems_core.load_system(self, system, np.array([0,0,0], dtype=np.float64), np.array([0,0,0], dtype=np.float64))
+
+        if cached:
+            cache.store(self, system)
+
+    def sync_state(self):
+        # Rebuild the particle arrays whenever bodies have been added or removed.
+        if self.state.bodies != list(self.objects):
+            self.state.bind(self.objects)
+
+    def update_accelerations(self, G, targets=None):
+        self.sync_state()
+        self.state.update_accelerations(G, self.softening, self.solver, targets)
+
+    def advance(self, dt, G=const.G):
+        # One step of the integrator followed by collisions. Every body remembers where it was before
+        # the step, for drawing its path; bodies created by the collisions start from where they are.
+        self.sync_state()
+        old_positions = self.state.positions.copy()
+
+        particles = self.test_particles
+        if len(particles):
+            particles.kick_drift(self.state, dt, G, self.softening)
+
+        self.integrator.step(self, dt, G)
+
+        for body, old_position in zip(self.state.bodies, old_positions):
+            body.old_position = old_position
+            body.new_position = body.position.copy()
+
+        removed_bodies, new_bodies = collisions.resolve_collisions(
+            self,
+            old_positions if self.continuous_collisions else None,
+            dt,
+            self.shatter_factor,
+            self.fragments,
+        )
+
+        for name in removed_bodies:
+            self.object_dict.pop(name, None)
+
+        for body in new_bodies.values():
+            body.old_position = body.new_position = body.position.copy()
+        self.object_dict.update(new_bodies)
+
+        if len(particles):
+            self.sync_state()
+            absorbed = particles.kick(self.state, dt, G, self.softening)
+            if absorbed:
+                print(f"{absorbed} test particles fell into bodies")
+
+        self.time += dt
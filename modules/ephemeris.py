@@ -0,0 +1,334 @@
+import time
+import argparse
+
+import numpy as np
+from numpy.polynomial import chebyshev
+
+try:
+    import const
+    import integrators
+    from batch import SYSTEMS, make_environment
+except ModuleNotFoundError:
+    from modules import const
+    from modules import integrators
+    from modules.batch import SYSTEMS, make_environment
+
+# Where every body of a run is at any time, without running it again: the run is integrated once, cut
+# into segments of equal length, and within each segment every body's coordinates are Chebyshev series
+# in time, fitted to its positions at every step, and so are its velocities. Looking a time up is then
+# finding its segment and summing a dozen terms.
+#
+# The velocities get series of their own rather than being the derivatives of the positions: those of
+# the integrators are only approximately the derivatives of their positions, by tens of m/s for Io at
+# steps of an hour with leapfrog, and no fit of the positions alone can get them back.
+#
+# A segment long enough for Neptune is several orbits of Io, so each body's part of a segment is split
+# again into 2, 4, 8, ... granules of its own, as few as keep its fits within both tolerances.
+#
+# Only bodies that exist for the whole of a segment are in it, so bodies lost to collisions drop out from
+# the segment they are lost in and fragments come in from the next one.
+#
+#   python -m modules.ephemeris build solar_system --start-time 1.6e9 --until 2.3e9 --output solar_ephemeris.npz
+#   python -m modules.ephemeris query solar_ephemeris.npz --time 1.7e9 --body Earth
+
+FORMAT_VERSION = 2
+
+def chebyshev_terms(x, degree):
+    # T_0(x) ... T_degree(x) along a new last axis, for -1 <= x <= 1 where T_k(x) = cos(k arccos x); much
+    # quicker than chebvander for the few points of a lookup.
+    return np.cos(np.arccos(np.minimum(np.maximum(x, -1), 1))[..., np.newaxis] * np.arange(degree + 1))
+
+def fit_series(times, values, start, end, degree):
+    # Chebyshev coefficients (n, degree+1, c) over [start, end] of the samples (m,) (m, n, c), with the
+    # largest residual of each body in each coordinate (n, c).
+    x = 2*(times - start)/(end - start) - 1
+    m, n, c = values.shape
+
+    fitted_degree = min(degree, m - 1)
+    terms = chebyshev.chebvander(x, fitted_degree)
+    solution = np.linalg.lstsq(terms, values.reshape(m, n*c), rcond=None)[0]
+    residuals = np.abs(terms @ solution - values.reshape(m, n*c)).reshape(m, n, c).max(axis=0)
+
+    # Short segments at the end get series of lower degree, padded with zeros.
+    coefficients = np.zeros((n, degree + 1, c))
+    coefficients[:, :fitted_degree + 1] = solution.reshape(fitted_degree + 1, n, c).transpose(1, 0, 2)
+    return coefficients, residuals
+
+def fit_segment(times, positions, velocities, start, end, degree, tolerance, velocity_tolerance):
+    # Granule counts (n,), the coefficients of every granule of every body, body after body, with the
+    # positions and velocities as six coordinates, and the largest position and velocity residuals. Bodies
+    # are split further for as long as they miss either tolerance and their granules would still have
+    # degree+1 samples.
+    states = np.concatenate((positions, velocities), axis=2)
+    n = states.shape[1]
+    granules = np.ones(n, dtype=np.int64)
+    fits = [None]*n
+    worst = worst_velocity = 0
+
+    pending = np.arange(n)
+    count = 1
+    while pending.size:
+        edges = np.linspace(start, end, count + 1)
+        parts, residuals = [], np.zeros((len(pending), 6))
+        for k in range(count):
+            inside = (times >= edges[k]) & (times <= edges[k + 1])
+            coefficients, part_residuals = fit_series(times[inside], states[inside][:, pending], edges[k], edges[k + 1], degree)
+            parts.append(coefficients)
+            residuals = np.maximum(residuals, part_residuals)
+
+        position_residuals = residuals[:, :3].max(axis=1)
+        velocity_residuals = residuals[:, 3:].max(axis=1)
+        last = (len(times) - 1)/(2*count) < degree
+        done = last | ((position_residuals <= tolerance) & (velocity_residuals <= velocity_tolerance))
+        for j in np.flatnonzero(done):
+            granules[pending[j]] = count
+            fits[pending[j]] = np.stack([part[j] for part in parts])
+        worst = max(worst, position_residuals[done].max(initial=0))
+        worst_velocity = max(worst_velocity, velocity_residuals[done].max(initial=0))
+
+        pending = pending[~done]
+        count *= 2
+
+    return granules, np.concatenate(fits) if fits else np.empty((0, degree + 1, 6)), worst, worst_velocity
+
+def build(environment, until, dt, segment_length, degree=12, tolerance=1000, velocity_tolerance=0.1, G=const.G):
+    # Runs the environment from its time to `until` and returns the Ephemeris of it. The tolerances are the
+    # largest position residual (m) and velocity residual (m/s) of a fit that is not split further.
+    if int(segment_length // dt) < degree:
+        raise ValueError(f"Segments of {segment_length} s with steps of {dt} s have too few samples for degree {degree}")
+
+    names = {}
+    boundaries = [environment.time]
+    body_indices = []
+    granules = []
+    coefficients = []
+    offsets = [0]
+    worst = worst_velocity = 0
+    started = time.perf_counter()
+
+    def sample():
+        environment.sync_state()
+        state = environment.state
+        return environment.time, [body.name for body in state.bodies], state.positions.copy(), state.velocities.copy()
+
+    samples = [sample()]
+    while environment.time < until:
+        start = environment.time
+        end = min(start + segment_length, until)
+
+        while environment.time < end:
+            environment.advance(min(dt, end - environment.time), G)
+            samples.append(sample())
+
+        # Whoever is there from start to end, in the order of the first sample.
+        present = set(samples[0][1]).intersection(*(sample[1] for sample in samples[1:]))
+        segment_names = [name for name in samples[0][1] if name in present]
+
+        if all(sample_names == samples[0][1] for _, sample_names, _, _ in samples):
+            positions = np.array([sample_positions for _, _, sample_positions, _ in samples])
+            velocities = np.array([sample_velocities for _, _, _, sample_velocities in samples])
+        else:
+            rows = [[sample_names.index(name) for name in segment_names] for _, sample_names, _, _ in samples]
+            positions = np.array([sample[2][sample_rows] for sample, sample_rows in zip(samples, rows)])
+            velocities = np.array([sample[3][sample_rows] for sample, sample_rows in zip(samples, rows)])
+
+        times = np.array([sample[0] for sample in samples])
+        segment_granules, segment_coefficients, residual, velocity_residual = fit_segment(times, positions, velocities, start, environment.time, degree, tolerance, velocity_tolerance)
+        worst = max(worst, residual)
+        worst_velocity = max(worst_velocity, velocity_residual)
+
+        boundaries.append(environment.time)
+        body_indices.extend(names.setdefault(name, len(names)) for name in segment_names)
+        granules.append(segment_granules)
+        coefficients.append(segment_coefficients)
+        offsets.append(len(body_indices))
+
+        # The end of a segment is the start of the next.
+        samples = samples[-1:]
+
+    print(f"Built an ephemeris of {len(names)} bodies in {len(offsets) - 1} segments in {time.perf_counter() - started:.2f} s, largest position residual {worst:.3g} m, velocity residual {worst_velocity:.3g} m/s")
+
+    return Ephemeris(
+        list(names),
+        np.array(boundaries, dtype=np.float64),
+        np.array(offsets, dtype=np.int64),
+        np.array(body_indices, dtype=np.int64),
+        np.concatenate(granules) if granules else np.empty(0, dtype=np.int64),
+        np.concatenate(coefficients) if coefficients else np.empty((0, degree + 1, 6)),
+    )
+
+class Ephemeris:
+    # The segments are [boundaries[k], boundaries[k+1]], and the entries offsets[k]:offsets[k+1] of
+    # body_indices and granules are the bodies of segment k and how many granules each is split into.
+    # The coefficients have a row for every granule, in the order of the entries, with the positions and
+    # the velocities as six coordinates so that one sum gives both.
+
+    def __init__(self, names, boundaries, offsets, body_indices, granules, coefficients):
+        self.names = list(names)
+        self.boundaries = boundaries
+        self.offsets = offsets
+        self.body_indices = body_indices
+        self.granules = granules
+        self.coefficients = coefficients
+        self.first_rows = np.cumsum(granules) - granules
+
+        # The entry of each body in every segment, or -1 where it is missing.
+        segment_of_entry = np.repeat(np.arange(len(boundaries) - 1), np.diff(offsets))
+        self.entries = {name: np.full(len(boundaries) - 1, -1, dtype=np.int64) for name in self.names}
+        for entry, (segment, index) in enumerate(zip(segment_of_entry.tolist(), body_indices.tolist())):
+            self.entries[self.names[index]][segment] = entry
+
+    @property
+    def start(self):
+        return self.boundaries[0]
+
+    @property
+    def end(self):
+        return self.boundaries[-1]
+
+    @property
+    def degree(self):
+        return self.coefficients.shape[1] - 1
+
+    def save(self, path):
+        np.savez(
+            path,
+            version=FORMAT_VERSION,
+            names=np.array(self.names, dtype=str),
+            boundaries=self.boundaries,
+            offsets=self.offsets,
+            body_indices=self.body_indices,
+            granules=self.granules,
+            coefficients=self.coefficients,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as ephemeris:
+            if int(ephemeris['version']) != FORMAT_VERSION:
+                raise ValueError(f"{path} is a version {int(ephemeris['version'])} ephemeris, expected version {FORMAT_VERSION}")
+
+            return cls(ephemeris['names'].tolist(), ephemeris['boundaries'], ephemeris['offsets'], ephemeris['body_indices'], ephemeris['granules'], ephemeris['coefficients'])
+
+    def segments(self, times):
+        # Segment of each time and where in it the time is, from -1 at its start to 1 at its end.
+        times = np.asarray(times, dtype=np.float64)
+        if np.any((times < self.start) | (times > self.end)):
+            raise ValueError(f"Times outside of the ephemeris, which goes from {self.start} to {self.end}")
+
+        segments = np.searchsorted(self.boundaries, times, side='right') - 1
+        segments = np.minimum(segments, len(self.boundaries) - 2)
+        x = 2*(times - self.boundaries[segments]) / (self.boundaries[segments + 1] - self.boundaries[segments]) - 1
+        return segments, x
+
+    def evaluate(self, entries, x):
+        # Positions and velocities of the given entries at the given places in their segments.
+        granules = self.granules[entries]
+        granule = np.minimum(((x + 1)/2*granules).astype(np.int64), granules - 1)
+        rows = self.first_rows[entries] + granule
+
+        polynomials = chebyshev_terms((x + 1)*granules - 2*granule - 1, self.degree)
+        states = np.einsum('mk,mkc->mc', polynomials, self.coefficients[rows])
+        return states[:, :3], states[:, 3:]
+
+    def state(self, time):
+        # Names, positions and velocities of every body there is at the given time. For an array of times,
+        # the bodies there are at all of them, with positions and velocities (times, bodies, 3).
+        if np.ndim(time):
+            return self.states(time)
+
+        segment, x = self.segments(time)
+        entries = np.arange(self.offsets[segment], self.offsets[segment + 1])
+        positions, velocities = self.evaluate(entries, np.full(len(entries), x))
+
+        return [self.names[index] for index in self.body_indices[entries]], positions, velocities
+
+    def states(self, times):
+        segments, x = self.segments(times)
+        if not segments.size:
+            raise ValueError("No times to look up")
+
+        # In the order of the bodies of the first time's segment.
+        first = self.body_indices[self.offsets[segments[0]]:self.offsets[segments[0] + 1]]
+        names = [self.names[index] for index in first.tolist() if np.all(self.entries[self.names[index]][segments] >= 0)]
+        if not names:
+            raise ValueError("No body is in the ephemeris at all of the times; look them up one by one with trajectory")
+
+        entries = np.stack([self.entries[name][segments] for name in names], axis=1)
+        positions, velocities = self.evaluate(entries.ravel(), np.repeat(x, len(names)))
+        shape = entries.shape + (3,)
+        return names, positions.reshape(shape), velocities.reshape(shape)
+
+    def trajectory(self, name, times):
+        # Positions and velocities (m,3) of one body at an array of times, all in one go.
+        if name not in self.entries:
+            raise ValueError(f"{name} is not in the ephemeris")
+
+        segments, x = self.segments(np.atleast_1d(times))
+        entries = self.entries[name][segments]
+        if np.any(entries < 0):
+            raise ValueError(f"{name} is not in the ephemeris at all of the times")
+
+        return self.evaluate(entries, x)
+
+    def apply(self, environment, time):
+        # Moves the bodies of the environment that are in the ephemeris to where they are at the given time,
+        # and the environment to that time. Their trails start again from there. Returns how many were moved.
+        names, positions, velocities = self.state(time)
+        environment.sync_state()
+        state = environment.state
+
+        moved = 0
+        rows = {body.name: k for k, body in enumerate(state.bodies)}
+        for name, position, velocity in zip(names, positions, velocities):
+            if name in rows:
+                state.positions[rows[name]] = position
+                state.velocities[rows[name]] = velocity
+                moved += 1
+
+        state.accelerations_current = False
+        environment.time = float(time)
+
+        for body in state.bodies:
+            body.path_points = [body.position.copy(), body.position.copy()]
+            body.old_position = body.position.copy()
+            body.new_position = body.position.copy()
+
+        return moved
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m modules.ephemeris', description='Build Chebyshev ephemerides of systems and look positions up in them.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='integrate a system once and fit its ephemeris')
+    build_parser.add_argument('system', choices=sorted(SYSTEMS))
+    build_parser.add_argument('--start-time', type=float, default=0)
+    build_parser.add_argument('--until', type=float, required=True, help='simulation time to stop at, in seconds')
+    build_parser.add_argument('--dt', type=float, default=3600, help='time step in seconds')
+    build_parser.add_argument('--segment', type=float, default=32*86400, help='length of each segment in seconds')
+    build_parser.add_argument('--degree', type=int, default=12, help='degree of the Chebyshev series')
+    build_parser.add_argument('--tolerance', type=float, default=1000, help='largest position residual in metres before a fit is split')
+    build_parser.add_argument('--velocity-tolerance', type=float, default=0.1, help='largest velocity residual in metres per second before a fit is split')
+    build_parser.add_argument('--integrator', default='leapfrog', choices=sorted(integrators.INTEGRATORS))
+    build_parser.add_argument('--output', default='ephemeris.npz')
+
+    query_parser = subparsers.add_parser('query', help='print positions and velocities at a time')
+    query_parser.add_argument('ephemeris')
+    query_parser.add_argument('--time', type=float, required=True)
+    query_parser.add_argument('--body', default=None, help='only this body')
+
+    args = parser.parse_args(arguments)
+
+    if args.command == 'build':
+        environment = make_environment(SYSTEMS[args.system], args.dt, args.start_time, integrator=args.integrator)
+        build(environment, args.until, args.dt, args.segment, args.degree, args.tolerance, args.velocity_tolerance).save(args.output)
+
+    else:
+        ephemeris = Ephemeris.load(args.ephemeris)
+        names, positions, velocities = ephemeris.state(args.time)
+        for name, position, velocity in zip(names, positions, velocities):
+            if args.body is None or name == args.body:
+                print(name, position, velocity)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+import math
+
+import numpy as np
+
+try:
+    from cells import CellList
+    from particles import accelerations
+except ModuleNotFoundError:
+    from modules.cells import CellList
+    from modules.particles import accelerations
+
+# Offsets from a box to the boxes of its interaction list: children of its parent's neighbours
+# that are not neighbours of the box itself. Which of them apply depends on the box's position in its parent.
+INTERACTION_OFFSETS = np.array([(x, y, z) for x in range(-3, 4) for y in range(-3, 4) for z in range(-3, 4) if max(abs(x), abs(y), abs(z)) > 1])
+
+OCTANTS = np.array([(x, y, z) for x in (0, 1) for y in (0, 1) for z in (0, 1)])
+
+def multi_indices(order):
+    # All exponent triples (a, b, c) with a+b+c <= order, sorted by total degree.
+    return np.array([(a, b, n-a-b) for n in range(order+1) for a in range(n, -1, -1) for b in range(n-a, -1, -1)])
+
+def monomials(vectors, terms):
+    # x**a * y**b * z**c for every exponent triple, shape (..., len(terms)).
+    degree = terms.max()
+    powers = vectors[..., np.newaxis] ** np.arange(degree+1)
+    return powers[..., 0, terms[:, 0]] * powers[..., 1, terms[:, 1]] * powers[..., 2, terms[:, 2]]
+
+def taylor_coefficients(vectors, terms):
+    # Taylor coefficients D^n(1/|u|)/n! at every u in `vectors`, for every exponent triple n in `terms`,
+    # from the recurrence  |u|^2 |n| b_n = -(2|n|-1) sum_i u_i b_{n-e_i} - (|n|-1) sum_i b_{n-2e_i}.
+    index = {tuple(term): k for k, term in enumerate(terms)}
+    dist_sq = np.einsum('...i,...i->...', vectors, vectors)
+
+    result = np.zeros(vectors.shape[:-1] + (len(terms),), dtype=np.float64)
+    result[..., 0] = 1/np.sqrt(dist_sq)
+
+    for k, term in enumerate(terms[1:], 1):
+        n = term.sum()
+        total = 0
+        for axis in range(3):
+            if term[axis] >= 1:
+                lower = term.copy()
+                lower[axis] -= 1
+                total = total + (2*n - 1) * vectors[..., axis] * result[..., index[tuple(lower)]]
+            if term[axis] >= 2:
+                lower = term.copy()
+                lower[axis] -= 2
+                total = total + (n - 1) * result[..., index[tuple(lower)]]
+        result[..., k] = -total / (n * dist_sq)
+
+    return result
+
+class FMMSolver:
+    # Fast multipole method on an octree of uniform depth with Cartesian multipole and local expansions.
+    # The far field is unsoftened, the near field (adjacent leaf boxes) is summed directly with softening.
+
+    def __init__(self, order=4, max_level=6, check_error=False, error_samples=64):
+        self.order = order
+        self.max_level = max_level
+        self.check_error = check_error
+        self.error_samples = error_samples
+        self.error = None
+
+        self.terms = multi_indices(2*order)
+        self.n_terms = len(multi_indices(order))
+        index = {tuple(term): k for k, term in enumerate(self.terms)}
+        expansion = self.terms[:self.n_terms]
+
+        # M2L: L_l = sum_k (-1)^|k| C(k+l, k) T_{k+l}(c_L - c_M) M_k
+        self.m2l_index = np.array([[index[tuple(l+k)] for k in expansion] for l in expansion])
+        self.m2l_factor = np.array([[(-1)**k.sum() * math.prod(math.comb(a+b, b) for a, b in zip(l, k)) for k in expansion] for l in expansion], dtype=np.float64)
+
+        # Shifts: S[k, j] = C(k, j) d^(k-j) for j <= k, used for M2M (M @ S.T) and L2L (L @ S).
+        shift_valid = (expansion[:, np.newaxis, :] >= expansion[np.newaxis, :, :]).all(-1)
+        self.shift_index = np.array([[index[tuple(k-j)] if valid else 0 for j, valid in zip(expansion, row)] for k, row in zip(expansion, shift_valid)])
+        self.shift_factor = np.array([[math.prod(math.comb(a, b) for a, b in zip(k, j)) if valid else 0 for j, valid in zip(expansion, row)] for k, row in zip(expansion, shift_valid)], dtype=np.float64)
+
+        # L2P: d/dx_i of (x-c)^l = l_i (x-c)^(l-e_i)
+        self.gradient_terms = []
+        for axis in range(3):
+            terms = np.flatnonzero(expansion[:, axis] > 0)
+            lowered = expansion[terms].copy()
+            lowered[:, axis] -= 1
+            self.gradient_terms.append((terms, np.array([index[tuple(term)] for term in lowered]), expansion[terms, axis].astype(np.float64)))
+
+    def shift_matrix(self, vector):
+        return self.shift_factor * monomials(vector, self.terms)[self.shift_index]
+
+    def accelerations(self, positions, masses, G, softening):
+        low = positions.min(0)
+        size = max((positions.max(0) - low).max(), 1.0) * (1 + 1e-9)
+
+        # Work in the unit cube so that the expansions stay well conditioned.
+        scaled = (positions - low) / size
+        scaled_softening = softening / size
+
+        depth = self.choose_depth(scaled)
+        leaf_cells = np.minimum(np.floor(scaled * 2**depth).astype(np.int64), 2**depth - 1)
+
+        # Occupied boxes per level, and for every box the index of its parent one level up.
+        boxes = {depth: CellList(leaf_cells)}
+        parents = {}
+        for level in range(depth-1, 1, -1):
+            boxes[level] = CellList(boxes[level+1].occupied >> 1)
+            parents[level+1] = boxes[level].find(boxes[level+1].occupied >> 1)
+
+        leaves = boxes[depth]
+        multipoles = {depth: self.particles_to_multipoles(scaled, masses, leaves, depth)}
+
+        for level in range(depth-1, 1, -1):
+            multipoles[level] = self.multipoles_to_multipoles(multipoles[level+1], boxes[level+1], parents[level+1], len(boxes[level].occupied), level+1)
+
+        locals_ = {}
+        for level in range(2, depth+1):
+            locals_[level] = self.multipoles_to_locals(multipoles[level], boxes[level], level)
+            if level > 2:
+                locals_[level] += self.locals_to_locals(locals_[level-1], boxes[level], parents[level], level)
+
+        acceleration = self.locals_to_particles(scaled, locals_[depth], leaves, depth)
+        acceleration += self.near_field(scaled, masses, leaves, scaled_softening)
+
+        result = G / size**2 * acceleration
+
+        if self.check_error:
+            self.error = self.estimate_error(result, positions, masses, G, softening)
+
+        return result
+
+    def choose_depth(self, scaled):
+        # Clustered systems crowd a uniform tree, so pick the depth that balances the direct sum between
+        # adjacent leaves (~ sum of squared occupancies) against the translations (~ number of boxes).
+        # A box's translations cost about as much as n_terms**2 / 200 near-field pairs per interaction.
+        best_depth, best_cost = 2, math.inf
+        box_cost = len(INTERACTION_OFFSETS) * self.n_terms**2 / 200
+
+        for depth in range(2, self.max_level+1):
+            cells = np.minimum(np.floor(scaled * 2**depth).astype(np.int64), 2**depth - 1)
+            counts = np.unique((cells[:, 0]*2**depth + cells[:, 1])*2**depth + cells[:, 2], return_counts=True)[1]
+            cost = 27 * (counts**2).sum() + box_cost * len(counts)
+
+            if cost < best_cost:
+                best_depth, best_cost = depth, cost
+
+        return best_depth
+
+    def box_centers(self, cells, level):
+        return (cells + 0.5) / 2**level
+
+    def particles_to_multipoles(self, scaled, masses, leaves, level, chunk=65536):
+        # M_k = sum m (x - c)^k over the particles of every leaf box.
+        ordered = leaves.order
+        box_of = np.repeat(np.arange(len(leaves.counts)), leaves.counts)
+        centers = self.box_centers(leaves.occupied, level)
+        expansion = self.terms[:self.n_terms]
+
+        multipoles = np.zeros((len(leaves.counts), self.n_terms), dtype=np.float64)
+        for first in range(0, len(ordered), chunk):
+            particles = ordered[first:first+chunk]
+            owners = box_of[first:first+chunk]
+            weighted = masses[particles, np.newaxis] * monomials(scaled[particles] - centers[owners], expansion)
+            np.add.at(multipoles, owners, weighted)
+
+        return multipoles
+
+    def multipoles_to_multipoles(self, child_multipoles, children, parent_ids, n_parents, child_level):
+        multipoles = np.zeros((n_parents, self.n_terms), dtype=np.float64)
+        octants = children.occupied & 1
+
+        for octant in OCTANTS:
+            mask = (octants == octant).all(1)
+            if not mask.any():
+                continue
+            shift = self.shift_matrix((octant - 0.5) / 2**child_level)
+            # Each parent has at most one child per octant, so the indices are unique.
+            multipoles[parent_ids[mask]] += child_multipoles[mask] @ shift.T
+
+        return multipoles
+
+    def multipoles_to_locals(self, multipoles, boxes, level):
+        cells = boxes.occupied
+        parity = cells & 1
+        locals_ = np.zeros_like(multipoles)
+
+        coefficients = taylor_coefficients(-INTERACTION_OFFSETS / 2**level, self.terms)
+        matrices = self.m2l_factor * coefficients[:, self.m2l_index]
+
+        for offset, matrix in zip(INTERACTION_OFFSETS, matrices):
+            # An offset of +3 only reaches a child of the parent's neighbour from an even box, -3 from an odd one.
+            mask = np.ones(len(cells), dtype=bool)
+            mask &= ((offset != 3) | (parity == 0)).all(1)
+            mask &= ((offset != -3) | (parity == 1)).all(1)
+
+            targets = np.flatnonzero(mask)
+            sources = boxes.find(cells[targets] + offset)
+            hit = sources >= 0
+            if hit.any():
+                locals_[targets[hit]] += multipoles[sources[hit]] @ matrix.T
+
+        return locals_
+
+    def locals_to_locals(self, parent_locals, children, parent_ids, child_level):
+        locals_ = np.zeros((len(children.occupied), self.n_terms), dtype=np.float64)
+        octants = children.occupied & 1
+
+        for octant in OCTANTS:
+            mask = (octants == octant).all(1)
+            if not mask.any():
+                continue
+            shift = self.shift_matrix((octant - 0.5) / 2**child_level)
+            locals_[mask] = parent_locals[parent_ids[mask]] @ shift
+
+        return locals_
+
+    def locals_to_particles(self, scaled, locals_, leaves, level, chunk=65536):
+        acceleration = np.zeros((len(scaled), 3), dtype=np.float64)
+        box_of = np.empty(len(scaled), dtype=np.int64)
+        box_of[leaves.order] = np.repeat(np.arange(len(leaves.counts)), leaves.counts)
+        centers = self.box_centers(leaves.occupied, level)
+
+        for first in range(0, len(scaled), chunk):
+            owners = box_of[first:first+chunk]
+            expansion = locals_[owners]
+            powers = monomials(scaled[first:first+chunk] - centers[owners], self.terms[:self.n_terms])
+
+            for axis, (terms, lowered, factors) in enumerate(self.gradient_terms):
+                acceleration[first:first+chunk, axis] = (expansion[:, terms] * factors * powers[:, lowered]).sum(1)
+
+        return acceleration
+
+    def near_field(self, scaled, masses, leaves, softening):
+        acceleration = np.zeros((len(scaled), 3), dtype=np.float64)
+
+        for targets, sources in leaves.neighbor_pairs():
+            dist = scaled[sources] - scaled[targets]
+            dist_sq = np.einsum('ij,ij->i', dist, dist)
+
+            # Coincident pairs (a body and itself) contribute nothing.
+            with np.errstate(divide='ignore'):
+                weights = np.where(dist_sq > 0, masses[sources] / (dist_sq + softening**2)**1.5, 0)
+
+            for axis in range(3):
+                acceleration[:, axis] += np.bincount(targets, weights=weights*dist[:, axis], minlength=len(scaled))
+
+        return acceleration
+
+    def estimate_error(self, result, positions, masses, G, softening):
+        # RMS force error relative to direct summation, measured on a random sample of bodies.
+        sample = np.random.default_rng().choice(len(positions), min(self.error_samples, len(positions)), replace=False)
+        reference = accelerations(positions[sample], positions, masses, G, softening)
+
+        # A lone body, or bodies whose forces all cancel, leave nothing to be relative to.
+        if (reference**2).sum() == 0:
+            return 0.0
+
+        return math.sqrt(((result[sample] - reference)**2).sum() / (reference**2).sum())
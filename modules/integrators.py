@@ -0,0 +1,753 @@
+import math
+
+import numpy as np
+
+try:
+    import numba
+except ModuleNotFoundError:
+    numba = None
+
+try:
+    import kernels
+    from particles import accelerations
+    from solvers import DirectSolver
+    from spacemath import kepler_drift
+except ModuleNotFoundError:
+    from modules import kernels
+    from modules.particles import accelerations
+    from modules.solvers import DirectSolver
+    from modules.spacemath import kepler_drift
+
+class Integrator:
+    # What an integrator is made with and what it keeps from one step to the next, by attribute name, so
+    # that checkpoints can save both as plain values and arrays and make the integrator again from them.
+    option_names = ()
+    kept_names = ()
+
+    def options(self):
+        return {name: getattr(self, name) for name in self.option_names}
+
+    def kept_state(self):
+        # Copies of whatever is kept and set, as arrays.
+        return {name: np.array(getattr(self, name)) for name in self.kept_names if getattr(self, name, None) is not None}
+
+    def restore_state(self, kept):
+        for name, value in kept.items():
+            setattr(self, name, value.item() if value.ndim == 0 else value)
+
+class SemiImplicitEuler(Integrator):
+
+    def step(self, environment, dt, G):
+        environment.update_accelerations(G)
+        state = environment.state
+
+        state.velocities += state.accelerations * dt
+        state.positions += state.velocities * dt
+
+class Leapfrog(Integrator):
+    # Kick-drift-kick leapfrog, composed from substeps of the given weights. The accelerations at the
+    # end of one substep are reused at the start of the next.
+    weights = (1.0,)
+
+    def step(self, environment, dt, G):
+        environment.sync_state()
+
+        if not environment.state.accelerations_current:
+            environment.update_accelerations(G)
+
+        for weight in self.weights:
+            self.kick_drift_kick(environment, weight*dt, G)
+
+    def kick_drift_kick(self, environment, dt, G):
+        state = environment.state
+
+        state.velocities += state.accelerations * (dt/2)
+        state.positions += state.velocities * dt
+
+        environment.update_accelerations(G)
+
+        state.velocities += state.accelerations * (dt/2)
+
+def yoshida_weights(inner):
+    # Symmetric composition inner[-1], ..., inner[0], w0, inner[0], ..., inner[-1] with weights summing to 1.
+    middle = 1 - 2*sum(inner)
+    return tuple(reversed(inner)) + (middle,) + tuple(inner)
+
+class Yoshida4(Leapfrog):
+    weights = yoshida_weights((1 / (2 - 2**(1/3)),))
+
+class Yoshida6(Leapfrog):
+    # Yoshida (1990), solution A
+    weights = yoshida_weights((-1.17767998417887, 0.235573213359357, 0.784513610477560))
+
+class BlockTimesteps(Integrator):
+    # Kick-drift-kick leapfrog with individual power-of-two block timesteps. Each body is assigned the
+    # level k with dt/2**k close to eta*|a|/|jerk|, so that tightly bound moons take many small steps while
+    # the rest of the system does not. Only the bodies finishing a substep get new forces; everyone drifts.
+    #
+    # Levels are chosen at the start of every step, where all bodies are in step, from one pass over the
+    # pairs for the jerks and dynamical times, and kept until its end. With the direct solver and Numba the
+    # substeps run in a compiled loop, which is what makes short steps for a few bodies cheaper than short
+    # steps for all of them; only the force pass at the end of the step goes through the solver.
+    option_names = ('eta', 'max_level')
+
+    def __init__(self, eta=0.05, max_level=10):
+        self.eta = eta
+        self.max_level = max_level
+        self.levels = None
+
+    def step(self, environment, dt, G):
+        environment.sync_state()
+        state = environment.state
+
+        if not state.accelerations_current:
+            environment.update_accelerations(G)
+        self.levels = self.choose_levels(environment, dt, G)
+
+        # Time is counted in ticks of the finest level, so every step length is a whole number of ticks.
+        total = 2**self.max_level
+        tick = dt / total
+        lengths = 2**(self.max_level - self.levels)
+
+        state.velocities += state.accelerations * (lengths*tick/2)[:, np.newaxis]
+
+        if kernels.backend == 'numba' and isinstance(environment.solver, (type(None), DirectSolver)):
+            numba_block_substeps(state.positions, state.velocities, state.accelerations, state.masses, G, environment.softening, lengths, total, tick)
+        else:
+            self.substeps(environment, lengths, total, tick, G)
+
+        # Everyone ends the step together.
+        environment.update_accelerations(G)
+        state.velocities += state.accelerations * (lengths*tick/2)[:, np.newaxis]
+
+    def substeps(self, environment, lengths, total, tick, G):
+        # Every substep but the last: drift everyone to the next time a body's step ends, then give those
+        # bodies new forces and kick them through to the middle of their next step.
+        state = environment.state
+        now = 0
+        while True:
+            next_time = ((now // lengths + 1) * lengths).min()
+            state.positions += state.velocities * ((next_time - now)*tick)
+            now = next_time
+            if now == total:
+                return
+
+            ending = np.flatnonzero(now % lengths == 0)
+            environment.update_accelerations(G, ending)
+            state.velocities[ending] += state.accelerations[ending] * (lengths[ending]*tick)[:, np.newaxis]
+
+    def choose_levels(self, environment, dt, G):
+        # The step follows eta*|a|/|jerk|, but is also bounded by the shortest pairwise dynamical time
+        # sqrt(r**3/(G*(m_i+m_j))): a moon's acceleration is dominated by its star, which hides the much
+        # faster orbit around its planet from the body's total acceleration and jerk.
+        state = environment.state
+        arguments = (state.positions, state.velocities, state.accelerations, state.masses, G, environment.softening)
+        if kernels.backend == 'numba':
+            timescales = numba_block_timescales(*arguments)
+        else:
+            timescales = numpy_block_timescales(*arguments)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            levels = np.ceil(np.log2(abs(dt) / (self.eta * timescales)))
+
+        return np.clip(np.nan_to_num(levels, nan=0, neginf=0), 0, self.max_level).astype(np.int64)
+
+def numpy_block_timescales(positions, velocities, accelerations, masses, G, softening):
+    # min(|a|/|jerk|, shortest pairwise dynamical time) of every body, working through the pairs in blocks of rows.
+    jerk = np.empty((len(positions), 3), dtype=np.float64)
+    dynamical_time = np.empty(len(positions), dtype=np.float64)
+
+    rows = kernels.block_rows(len(positions))
+    for first in range(0, len(positions), rows):
+        block = slice(first, first + rows)
+        dist = positions[np.newaxis, :, :] - positions[block, np.newaxis, :]
+        relative_velocity = velocities[np.newaxis, :, :] - velocities[block, np.newaxis, :]
+
+        dist_sq = np.einsum('ijk,ijk->ij', dist, dist)
+        softened_sq = dist_sq + softening**2
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.where(dist_sq > 0, masses / softened_sq**1.5, 0)
+            radial = np.where(dist_sq > 0, 3 * weights * np.einsum('ijk,ijk->ij', dist, relative_velocity) / softened_sq, 0)
+            jerk[block] = G * (np.einsum('ij,ijk->ik', weights, relative_velocity) - np.einsum('ij,ijk->ik', radial, dist))
+            dynamical_time[block] = np.where(dist_sq > 0, np.sqrt(softened_sq**1.5 / (G*(masses + masses[block, np.newaxis]))), np.inf).min(1, initial=np.inf)
+
+    jerk_norm = np.linalg.norm(jerk, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.minimum(np.where(jerk_norm > 0, np.linalg.norm(accelerations, axis=1) / jerk_norm, np.inf), dynamical_time)
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_block_timescales(positions, velocities, accelerations, masses, G, softening):
+        n = positions.shape[0]
+        softening_sq = softening*softening
+        timescales = np.empty(n, dtype=np.float64)
+        for i in numba.prange(n):
+            jx = 0.0
+            jy = 0.0
+            jz = 0.0
+            dynamical_time = np.inf
+            for j in range(n):
+                dx = positions[j, 0] - positions[i, 0]
+                dy = positions[j, 1] - positions[i, 1]
+                dz = positions[j, 2] - positions[i, 2]
+                dist_sq = dx*dx + dy*dy + dz*dz
+                if dist_sq > 0:
+                    vx = velocities[j, 0] - velocities[i, 0]
+                    vy = velocities[j, 1] - velocities[i, 1]
+                    vz = velocities[j, 2] - velocities[i, 2]
+                    softened_sq = dist_sq + softening_sq
+                    cubed = softened_sq*np.sqrt(softened_sq)
+                    weight = masses[j] / cubed
+                    radial = 3*weight*(dx*vx + dy*vy + dz*vz) / softened_sq
+                    jx += weight*vx - radial*dx
+                    jy += weight*vy - radial*dy
+                    jz += weight*vz - radial*dz
+                    dynamical_time = min(dynamical_time, np.sqrt(cubed / (G*(masses[i] + masses[j]))))
+
+            jerk_norm = G*np.sqrt(jx*jx + jy*jy + jz*jz)
+            timescale = dynamical_time
+            if jerk_norm > 0:
+                acceleration_norm = np.sqrt(accelerations[i, 0]**2 + accelerations[i, 1]**2 + accelerations[i, 2]**2)
+                timescale = min(timescale, acceleration_norm / jerk_norm)
+            timescales[i] = timescale
+        return timescales
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_block_substeps(positions, velocities, accelerations, masses, G, softening, lengths, total, tick):
+        # BlockTimesteps.substeps, with the forces summed directly.
+        n = positions.shape[0]
+        softening_sq = softening*softening
+        ending = np.empty(n, dtype=np.int64)
+        now = 0
+        while True:
+            next_time = total
+            for i in range(n):
+                next_time = min(next_time, (now // lengths[i] + 1) * lengths[i])
+
+            drift = (next_time - now)*tick
+            for i in range(n):
+                for axis in range(3):
+                    positions[i, axis] += velocities[i, axis]*drift
+            now = next_time
+            if now == total:
+                return
+
+            count = 0
+            for i in range(n):
+                if now % lengths[i] == 0:
+                    ending[count] = i
+                    count += 1
+
+            for k in numba.prange(count):
+                i = ending[k]
+                ax = 0.0
+                ay = 0.0
+                az = 0.0
+                for j in range(n):
+                    dx = positions[j, 0] - positions[i, 0]
+                    dy = positions[j, 1] - positions[i, 1]
+                    dz = positions[j, 2] - positions[i, 2]
+                    dist_sq = dx*dx + dy*dy + dz*dz
+                    if dist_sq > 0:
+                        inverse = 1 / np.sqrt(dist_sq + softening_sq)
+                        weight = masses[j] * inverse*inverse*inverse
+                        ax += weight*dx
+                        ay += weight*dy
+                        az += weight*dz
+                accelerations[i, 0] = G*ax
+                accelerations[i, 1] = G*ay
+                accelerations[i, 2] = G*az
+
+                kick = lengths[i]*tick
+                for axis in range(3):
+                    velocities[i, axis] += accelerations[i, axis]*kick
+
+class WisdomHolman(Integrator):
+    # Mixed-variable symplectic integrator in democratic heliocentric coordinates (Duncan, Levison & Lee 1998)
+    # for systems dominated by one central mass: positions relative to the central body, barycentric velocities.
+    # Every body follows its Kepler orbit around the central body exactly, and only the much weaker
+    # interactions between the other bodies are integrated, so steps can be a sizable fraction of the
+    # innermost orbit. Moons are perturbations of the central body's field too, and need short steps.
+    #
+    # kick/2, jump/2, Kepler drift, jump/2, kick/2, where the jump moves every body by the central body's
+    # reflex motion. The central body defaults to the most massive one.
+    option_names = ('central',)
+    kept_names = ('interaction', 'last_positions')
+
+    def __init__(self, central=None):
+        self.central = central
+        self.interaction = None
+        self.last_positions = None
+
+    def step(self, environment, dt, G):
+        environment.sync_state()
+        state = environment.state
+
+        if self.central is None:
+            central = int(np.argmax(state.masses))
+        else:
+            central = [body.name for body in state.bodies].index(self.central)
+
+        others = np.arange(len(state)) != central
+        central_mass = state.masses[central]
+        masses = state.masses[others]
+        total_mass = state.masses.sum()
+
+        center_of_mass = (state.masses[:, np.newaxis] * state.positions).sum(0) / total_mass
+        center_of_mass_velocity = (state.masses[:, np.newaxis] * state.velocities).sum(0) / total_mass
+
+        positions = state.positions[others] - state.positions[central]
+        velocities = state.velocities[others] - center_of_mass_velocity
+
+        # The interactions at the end of one step are reused at the start of the next.
+        if self.last_positions is None or not np.array_equal(self.last_positions, state.positions):
+            self.interaction = self.interactions(environment, positions, masses, G)
+
+        velocities += self.interaction * (dt/2)
+        positions += (masses[:, np.newaxis] * velocities).sum(0) / central_mass * (dt/2)
+        positions, velocities = kepler_drift(G*central_mass, positions, velocities, dt)
+        positions += (masses[:, np.newaxis] * velocities).sum(0) / central_mass * (dt/2)
+
+        self.interaction = self.interactions(environment, positions, masses, G)
+        velocities += self.interaction * (dt/2)
+
+        # Back to the frame of the simulation, in which the center of mass moves uniformly.
+        center_of_mass = center_of_mass + center_of_mass_velocity * dt
+        state.positions[central] = center_of_mass - (masses[:, np.newaxis] * positions).sum(0) / total_mass
+        state.positions[others] = positions + state.positions[central]
+        state.velocities[others] = velocities + center_of_mass_velocity
+        state.velocities[central] = center_of_mass_velocity - (masses[:, np.newaxis] * velocities).sum(0) / central_mass
+
+        self.last_positions = state.positions.copy()
+
+        # The stored accelerations are left over from another integrator, if any.
+        state.accelerations_current = False
+
+    def interactions(self, environment, positions, masses, G):
+        # Mutual attraction of the non-central bodies, which only depends on their relative positions.
+        return environment.solver.accelerations(positions, masses, G, environment.softening)
+
+class FrameNode:
+    # One System in its own frame: the particles are its own bodies followed by the barycenters of its
+    # sub-systems, with positions and velocities relative to the node's barycenter (absolute for the root).
+
+    def __init__(self, bodies, children):
+        self.bodies = np.array(bodies, dtype=np.int64)
+        self.children = children
+        self.members = np.concatenate([self.bodies] + [child.members for child in children])
+
+    def load(self, positions, velocities, masses, origin, origin_velocity):
+        self.masses = np.concatenate([masses[self.bodies], [masses[child.members].sum() for child in self.children]])
+        self.positions = np.empty((len(self.masses), 3), dtype=np.float64)
+        self.velocities = np.empty((len(self.masses), 3), dtype=np.float64)
+        self.member_masses = masses[self.members]
+
+        self.positions[:len(self.bodies)] = positions[self.bodies] - origin
+        self.velocities[:len(self.bodies)] = velocities[self.bodies] - origin_velocity
+
+        for k, child in enumerate(self.children, len(self.bodies)):
+            weights = masses[child.members, np.newaxis] / self.masses[k]
+            center = (weights * positions[child.members]).sum(0)
+            center_velocity = (weights * velocities[child.members]).sum(0)
+
+            self.positions[k] = center - origin
+            self.velocities[k] = center_velocity - origin_velocity
+            child.load(positions, velocities, masses, center, center_velocity)
+
+    def store(self, positions, velocities, origin, origin_velocity):
+        positions[self.bodies] = self.positions[:len(self.bodies)] + origin
+        velocities[self.bodies] = self.velocities[:len(self.bodies)] + origin_velocity
+
+        for k, child in enumerate(self.children, len(self.bodies)):
+            child.store(positions, velocities, self.positions[k] + origin, self.velocities[k] + origin_velocity)
+
+    def nodes(self):
+        # The node and every node below it, each followed by its children in turn.
+        yield self
+        for child in self.children:
+            yield from child.nodes()
+
+    def member_positions(self, origin=0):
+        # Positions of every body in the subtree, in the order of `members`.
+        return np.concatenate([self.positions[:len(self.bodies)] + origin] + [
+            child.member_positions(self.positions[k] + origin) for k, child in enumerate(self.children, len(self.bodies))
+        ])
+
+    def shortest_period(self, G):
+        # Orbital period of the closest particle around the heaviest one in the frame.
+        if len(self.masses) < 2:
+            return math.inf
+
+        heaviest = np.argmax(self.masses)
+        dist = np.linalg.norm(self.positions - self.positions[heaviest], axis=1)
+        total_mass = self.masses + self.masses[heaviest]
+
+        with np.errstate(divide='ignore'):
+            periods = np.where(dist > 0, 2*np.pi * np.sqrt(dist**3 / (G*total_mass)), np.inf)
+
+        return periods.min()
+
+class NestedFrames(Integrator):
+    # Multi-rate kick-drift-kick leapfrog over the System tree the environment was loaded from. Every
+    # sub-system lives in the frame of its own barycenter and takes as many substeps as its shortest orbit
+    # needs (`fraction` of that period) within each drift of its parent. The barycenter moves with the
+    # mean force on the sub-system's bodies, and the bodies themselves only feel the outside world through
+    # the tidal remainder. Relative coordinates are kept between frames, so moons far from the origin
+    # lose no precision.
+    option_names = ('fraction',)
+    kept_names = ('last_positions',)
+
+    def __init__(self, fraction=0.02):
+        self.fraction = fraction
+        self.root = None
+        self.last_positions = None
+
+    def step(self, environment, dt, G):
+        environment.sync_state()
+        state = environment.state
+
+        # The frames are rebuilt from the particle arrays whenever anything else has changed them.
+        if self.root is None or self.last_positions.shape != state.positions.shape or not np.array_equal(self.last_positions, state.positions):
+            self.root = self.build(environment, G)
+
+        zero = np.zeros(3)
+        nothing = (np.empty((0, 3)), np.empty(0))
+        self.advance(environment, self.root, dt, G, lambda t: zero, lambda t: nothing)
+
+        self.root.store(state.positions, state.velocities, zero, zero)
+        self.last_positions = state.positions.copy()
+        state.accelerations_current = False
+
+    def kept_state(self):
+        # The frames are kept as well, in their own relative coordinates, since building them again from
+        # the absolute ones would not give the same numbers. Their arrays are laid end to end, node after
+        # node in the order of FrameNode.nodes.
+        kept = super().kept_state()
+        if self.root is None:
+            return kept
+
+        nodes = list(self.root.nodes())
+        kept.update(
+            frame_sizes=np.array([(len(node.bodies), len(node.children), len(node.members)) for node in nodes], dtype=np.int64),
+            frame_bodies=np.concatenate([node.bodies for node in nodes]),
+            frame_masses=np.concatenate([node.masses for node in nodes]),
+            frame_member_masses=np.concatenate([node.member_masses for node in nodes]),
+            frame_positions=np.concatenate([node.positions for node in nodes]),
+            frame_velocities=np.concatenate([node.velocities for node in nodes]),
+            frame_max_steps=np.array([node.max_step for node in nodes], dtype=np.float64),
+        )
+        return kept
+
+    def restore_state(self, kept):
+        frames = {name: value for name, value in kept.items() if name.startswith('frame_')}
+        super().restore_state({name: value for name, value in kept.items() if name not in frames})
+
+        if not frames:
+            return
+
+        sizes = frames['frame_sizes']
+        body_starts = np.cumsum(sizes[:, 0]) - sizes[:, 0]
+        row_starts = np.cumsum(sizes[:, 0] + sizes[:, 1]) - sizes[:, 0] - sizes[:, 1]
+        member_starts = np.cumsum(sizes[:, 2]) - sizes[:, 2]
+        order = iter(range(len(sizes)))
+
+        def next_node():
+            k = next(order)
+            n_bodies, n_children, n_members = sizes[k]
+            bodies = frames['frame_bodies'][body_starts[k]:body_starts[k] + n_bodies]
+            node = FrameNode(bodies, [next_node() for _ in range(n_children)])
+
+            rows = slice(row_starts[k], row_starts[k] + n_bodies + n_children)
+            node.masses = frames['frame_masses'][rows].copy()
+            node.positions = frames['frame_positions'][rows].copy()
+            node.velocities = frames['frame_velocities'][rows].copy()
+            node.member_masses = frames['frame_member_masses'][member_starts[k]:member_starts[k] + n_members].copy()
+            node.max_step = frames['frame_max_steps'][k].item()
+            return node
+
+        self.root = next_node()
+
+    def build(self, environment, G):
+        state = environment.state
+        index = {body.name: k for k, body in enumerate(state.bodies)}
+        placed = set()
+
+        def node_for(system):
+            names = [system.parent.name] + [planet.name for planet in system.planets if not hasattr(planet, 'planets')]
+            bodies = [index[name] for name in names if name in index]
+            children = [node_for(planet) for planet in system.planets if hasattr(planet, 'planets')]
+            children = [child for child in children if len(child.members)]
+            placed.update(bodies)
+            return FrameNode(bodies, children)
+
+        system = getattr(environment, 'system', None)
+        root = node_for(system) if system is not None else FrameNode([], [])
+
+        # Bodies that are not part of the tree (merged or added later) move in the root frame.
+        leftover = [k for k in range(len(state)) if k not in placed]
+        root = FrameNode(list(root.bodies) + leftover, root.children)
+
+        root.load(state.positions, state.velocities, state.masses, np.zeros(3), np.zeros(3))
+
+        def set_steps(node):
+            node.max_step = self.fraction * node.shortest_period(G)
+            for child in node.children:
+                set_steps(child)
+
+        set_steps(root)
+        return root
+
+    def advance(self, environment, node, dt, G, origin, outside):
+        # `origin(t)` is the absolute position of the node's frame and `outside(t)` the absolute positions
+        # and masses of every body outside the node, at time t into the step.
+        substeps = max(1, math.ceil(abs(dt) / node.max_step)) if node.max_step > 0 else 1
+        h = dt / substeps
+
+        for substep in range(substeps):
+            t = substep*h
+            self.kick(environment, node, h/2, G, origin(t), outside(t))
+            self.drift(environment, node, h, G, t, origin, outside)
+            self.kick(environment, node, h/2, G, origin(t+h), outside(t+h))
+
+    def kick(self, environment, node, dt, G, origin, outside):
+        n_bodies = len(node.bodies)
+
+        # Every particle is a group of points: a body is one, a sub-system all of its members.
+        points = [node.positions[:n_bodies]]
+        for k, child in enumerate(node.children, n_bodies):
+            points.append(child.member_positions(node.positions[k]))
+        points = np.concatenate(points)
+
+        groups = np.concatenate([np.arange(n_bodies)] + [np.full(len(child.members), k) for k, child in enumerate(node.children, n_bodies)])
+        masses = np.concatenate([node.masses[:n_bodies], node.member_masses[n_bodies:]])
+
+        # Attraction between points of different groups; the inside of a sub-system is its own business.
+        dist = points[np.newaxis, :, :] - points[:, np.newaxis, :]
+        dist_sq = np.einsum('ijk,ijk->ij', dist, dist)
+        weights = np.where(groups[:, np.newaxis] != groups[np.newaxis, :], masses / (dist_sq + environment.softening**2)**1.5, 0)
+        internal = G * np.einsum('ij,ijk->ik', weights, dist)
+
+        external = accelerations(points, outside[0] - origin, outside[1], G, environment.softening)
+
+        # Sub-systems move with the mass-weighted mean over their members, and so does the node as a whole.
+        total = np.empty((len(node.masses), 3), dtype=np.float64)
+        for axis in range(3):
+            total[:, axis] = np.bincount(groups, weights=masses*(internal + external)[:, axis], minlength=len(node.masses))
+        total /= node.masses[:, np.newaxis]
+        total -= (node.masses[:, np.newaxis] * total).sum(0) / node.masses.sum()
+
+        node.velocities += total * dt
+
+    def drift(self, environment, node, dt, G, t, origin, outside):
+        n_bodies = len(node.bodies)
+        positions = node.positions.copy()
+        velocities = node.velocities.copy()
+
+        # While a sub-system takes its substeps, everything around it moves in a straight line.
+        frozen = [child.member_positions() for child in node.children]
+
+        for k, child in enumerate(node.children, n_bodies):
+            def child_origin(tau, k=k):
+                return origin(t + tau) + positions[k] + velocities[k]*tau
+
+            def child_outside(tau, k=k):
+                frame = origin(t + tau)
+                around = outside(t + tau)
+                siblings = [frozen[j - n_bodies] + frame + positions[j] + velocities[j]*tau for j in range(n_bodies, len(node.masses)) if j != k]
+                sibling_masses = [node.children[j - n_bodies].member_masses for j in range(n_bodies, len(node.masses)) if j != k]
+                return (
+                    np.concatenate([around[0], frame + positions[:n_bodies] + velocities[:n_bodies]*tau] + siblings),
+                    np.concatenate([around[1], node.masses[:n_bodies]] + sibling_masses),
+                )
+
+            self.advance(environment, child, dt, G, child_origin, child_outside)
+
+        node.positions += node.velocities * dt
+
+# Gauss-Radau spacings of the substeps within a step
+RADAU_SPACINGS = np.array([
+    0.0,
+    0.0562625605369221464656521910318,
+    0.180240691736892364987579942780,
+    0.352624717113169637373907769648,
+    0.547153626330555383001448554766,
+    0.734210177215410531523210605558,
+    0.885320946839095768090359771030,
+    0.977520613561287501891174488626,
+])
+
+def radau_conversion():
+    # The acceleration over a step is a0 + sum g_k h (h-h_1)...(h-h_{k-1}) = a0 + sum b_m h**(m+1).
+    # Column k holds the power series coefficients of the k-th product, so that b = C @ g.
+    conversion = np.zeros((7, 7))
+    for k in range(7):
+        product = np.polynomial.polynomial.polyfromroots(RADAU_SPACINGS[:k+1])
+        conversion[:k+1, k] = product[1:]
+    return conversion
+
+class GaussRadau15(Integrator):
+    # 15th order implicit Gauss-Radau integrator with adaptive step size control, after IAS15
+    # (Rein & Spiegel 2015). Each step iterates a predictor-corrector over 7 substeps until the
+    # acceleration polynomial converges, then picks the next step from the shortest timescale of any
+    # body's acceleration (Pham, Rein & Spiegel 2023). Steps are rejected and retried when they shrink too much.
+
+    conversion = radau_conversion()
+    inverse_conversion = np.linalg.inv(conversion)
+
+    option_names = ('epsilon', 'safety_factor', 'max_iterations')
+    kept_names = ('dt', 'last_dt', 'b')
+
+    def __init__(self, epsilon=1e-9, safety_factor=0.25, max_iterations=12):
+        self.epsilon = epsilon
+        self.safety_factor = safety_factor
+        self.max_iterations = max_iterations
+        self.dt = None
+        self.b = None
+
+    def step(self, environment, dt, G):
+        environment.sync_state()
+        state = environment.state
+
+        if not state.accelerations_current or self.b is None or self.b.shape[1] != len(state):
+            environment.update_accelerations(G)
+            self.b = np.zeros((7, len(state), 3))
+
+        if self.dt is None or self.dt * dt <= 0:
+            self.dt = dt
+
+        remaining = dt
+        while remaining:
+            clipped = abs(self.dt) >= abs(remaining)
+            self.attempt(environment, remaining if clipped else self.dt, G, clipped)
+            remaining -= self.last_dt
+
+    def attempt(self, environment, dt, G, clipped):
+        state = environment.state
+
+        positions = state.positions.copy()
+        velocities = state.velocities.copy()
+        acceleration = state.accelerations.copy()
+
+        while True:
+            b, g = self.b, self.inverse_conversion @ self.b.reshape(7, -1)
+            g = g.reshape(self.b.shape)
+            largest_acceleration = np.abs(acceleration).max()
+
+            last_error = math.inf
+            for iteration in range(self.max_iterations):
+                for n in range(1, 8):
+                    h = RADAU_SPACINGS[n]
+                    state.positions[:] = self.position_at(h, dt, positions, velocities, acceleration, b)
+                    state.velocities[:] = self.velocity_at(h, dt, velocities, acceleration, b)
+                    environment.update_accelerations(G)
+                    largest_acceleration = max(largest_acceleration, np.abs(state.accelerations).max())
+
+                    # Newton divided differences give the new g_n
+                    difference = (state.accelerations - acceleration) / h
+                    for k in range(1, n):
+                        difference = (difference - g[k-1]) / (h - RADAU_SPACINGS[k])
+
+                    change = difference - g[n-1]
+                    g[n-1] = difference
+                    b = np.einsum('mk,k...->m...', self.conversion, g)
+
+                error = np.abs(change).max() / largest_acceleration if largest_acceleration else 0
+                if error < 1e-16 or (iteration > 2 and error >= last_error):
+                    break
+                last_error = error
+
+            dt_new = self.next_step(acceleration, b, dt)
+
+            if abs(dt_new / dt) < self.safety_factor:
+                # Rejected: retry with the smaller step, rescaling the polynomial to it.
+                ratio = dt_new / dt
+                self.b = b * ratio**np.arange(1, 8)[:, np.newaxis, np.newaxis]
+                state.positions[:] = positions
+                state.velocities[:] = velocities
+                state.accelerations[:] = acceleration
+                dt = dt_new
+                continue
+
+            break
+
+        state.positions[:] = self.position_at(1, dt, positions, velocities, acceleration, b)
+        state.velocities[:] = self.velocity_at(1, dt, velocities, acceleration, b)
+        environment.update_accelerations(G)
+
+        if clipped:
+            # A step shortened to end on the frame boundary says little about the next one.
+            dt_new = math.copysign(min(abs(dt_new), abs(self.dt)), dt)
+        elif abs(dt_new / dt) > 1 / self.safety_factor:
+            dt_new = dt / self.safety_factor
+
+        self.last_dt = dt
+        self.dt = dt_new
+        self.b = self.predict(b, dt_new / dt)
+
+    def next_step(self, acceleration, b, dt):
+        # Acceleration, jerk and snap of each body at the end of the step, in units of the step, give the
+        # timescale sqrt(2 a**2 / (j**2 + a s)); the shortest over all bodies sets the next step.
+        m = np.arange(7)
+        end = np.einsum('ij,ij->i', acceleration + b.sum(0), acceleration + b.sum(0))
+        jerk = np.tensordot(m+1, b, 1)
+        snap = np.tensordot((m+1)*m, b, 1)
+
+        jerk_sq = np.einsum('ij,ij->i', jerk, jerk)
+        snap_sq = np.einsum('ij,ij->i', snap, snap)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            timescales = np.sqrt(2*end / (jerk_sq + np.sqrt(snap_sq*end)))
+
+        timescales = timescales[np.isfinite(timescales) & (end > 0)]
+        if not timescales.size:
+            return dt / self.safety_factor
+
+        return dt * timescales.min() * (math.factorial(7) * self.epsilon)**(1/7)
+
+    @staticmethod
+    def position_at(h, dt, positions, velocities, acceleration, b):
+        powers = h**np.arange(1, 8)[:, np.newaxis, np.newaxis] / ((np.arange(1, 8) + 1) * (np.arange(1, 8) + 2))[:, np.newaxis, np.newaxis]
+        return positions + dt*h*velocities + dt**2*h**2*(acceleration/2 + (b*powers).sum(0))
+
+    @staticmethod
+    def velocity_at(h, dt, velocities, acceleration, b):
+        powers = h**np.arange(1, 8)[:, np.newaxis, np.newaxis] / (np.arange(1, 8) + 1)[:, np.newaxis, np.newaxis]
+        return velocities + dt*h*(acceleration + (b*powers).sum(0))
+
+    @staticmethod
+    def predict(b, ratio):
+        # Extend the acceleration polynomial of the finished step over the next one,
+        # b'_m = sum_{k>=m} C(k+1, m+1) ratio**(m+1) b_k
+        prediction = np.zeros_like(b)
+        for m in range(7):
+            for k in range(m, 7):
+                prediction[m] += math.comb(k+1, m+1) * ratio**(m+1) * b[k]
+        return prediction
+
+INTEGRATORS = {
+    'euler': SemiImplicitEuler,
+    'leapfrog': Leapfrog,
+    'yoshida4': Yoshida4,
+    'yoshida6': Yoshida6,
+    'block': BlockTimesteps,
+    'wh': WisdomHolman,
+    'nested': NestedFrames,
+    'ias15': GaussRadau15,
+}
+
+def integrator_name(integrator):
+    for name, integrator_class in INTEGRATORS.items():
+        if type(integrator) is integrator_class:
+            return name
+
+    raise ValueError(f"{type(integrator).__name__} is not one of the integrators {', '.join(INTEGRATORS)}")
+
+def make_integrator(name, **options):
+    try:
+        integrator_class = INTEGRATORS[name]
+    except KeyError:
+        raise ValueError(f"Unknown integrator '{name}', expected one of {', '.join(INTEGRATORS)}")
+
+    return integrator_class(**options)
@@ -0,0 +1,342 @@
+import numpy as np
+
+try:
+    import numba
+except ModuleNotFoundError:
+    numba = None
+
+# Pairwise kernels for acceleration, potential energy and collision checks, and one that gives both the
+# accelerations and the touching pairs from a single pass over the distances. The NumPy versions work through
+# the pairs in blocks of rows so that no (N,N,3) temporary is ever built; with Numba installed, compiled
+# versions loop over the pairs in place and spread the rows over all cores.
+
+BLOCK_SIZE = 2**20
+
+def block_rows(n_columns):
+    return max(1, BLOCK_SIZE // max(n_columns, 1))
+
+def numpy_accelerations(points, positions, masses, G, softening, out=None):
+    if out is None:
+        out = np.empty((len(points), 3), dtype=np.float64)
+
+    rows = block_rows(len(positions))
+    for first in range(0, len(points), rows):
+        dist = positions[np.newaxis, :, :] - points[first:first+rows, np.newaxis, :]
+        dist_sq = np.einsum('ijk,ijk->ij', dist, dist)
+
+        # Coincident pairs (a body and itself) contribute nothing.
+        with np.errstate(divide='ignore'):
+            weights = np.where(dist_sq > 0, masses / (dist_sq + softening**2)**1.5, 0)
+
+        out[first:first+rows] = G * np.einsum('ij,ijk->ik', weights, dist)
+
+    return out
+
+def numpy_accelerations_and_contacts(positions, masses, radii, G, softening):
+    # Accelerations of every body, and the pairs (i, j), i < j, that touch, from the same distances.
+    out = np.empty((len(positions), 3), dtype=np.float64)
+    found = []
+
+    rows = block_rows(len(positions))
+    for first in range(0, len(positions), rows):
+        dist = positions[np.newaxis, :, :] - positions[first:first+rows, np.newaxis, :]
+        dist_sq = np.einsum('ijk,ijk->ij', dist, dist)
+
+        with np.errstate(divide='ignore'):
+            weights = np.where(dist_sq > 0, masses / (dist_sq + softening**2)**1.5, 0)
+
+        out[first:first+rows] = G * np.einsum('ij,ijk->ik', weights, dist)
+
+        i, j = np.nonzero(dist_sq + softening**2 < (radii[first:first+rows, np.newaxis] + radii)**2)
+        i += first
+        found.append(np.stack((i[j > i], j[j > i]), axis=1))
+
+    if not found:
+        return out, np.empty((0, 2), dtype=np.int64)
+
+    return out, np.concatenate(found).astype(np.int64)
+
+def numpy_potential_energy(positions, masses, G, softening):
+    energy = 0.0
+
+    rows = block_rows(len(positions))
+    for first in range(0, len(positions), rows):
+        dist = positions[np.newaxis, :, :] - positions[first:first+rows, np.newaxis, :]
+        dist_sq = np.einsum('ijk,ijk->ij', dist, dist)
+
+        # Every pair once: only the columns after the row.
+        later = np.arange(len(positions))[np.newaxis, :] > np.arange(first, first+len(dist))[:, np.newaxis]
+        energy -= G * (masses[first:first+rows, np.newaxis] * masses / np.sqrt(dist_sq + softening**2))[later].sum()
+
+    return energy
+
+def numpy_collision_pairs(positions, radii, softening):
+    # Pairs (i, j), i < j, whose softened distance is less than the sum of their radii, sorted by i then j.
+    found = []
+
+    rows = block_rows(len(positions))
+    for first in range(0, len(positions), rows):
+        dist = positions[np.newaxis, :, :] - positions[first:first+rows, np.newaxis, :]
+        dist_sq = np.einsum('ijk,ijk->ij', dist, dist)
+
+        touching = dist_sq + softening**2 < (radii[first:first+rows, np.newaxis] + radii)**2
+        touching &= np.arange(len(positions))[np.newaxis, :] > np.arange(first, first+len(dist))[:, np.newaxis]
+
+        i, j = np.nonzero(touching)
+        found.append(np.stack((i + first, j), axis=1))
+
+    if not found:
+        return np.empty((0, 2), dtype=np.int64)
+
+    return np.concatenate(found).astype(np.int64)
+
+def numpy_test_particle_accelerations(points, positions, masses, radii, G, softening, out=None):
+    # Accelerations of massless points (M,3) from the bodies (N,3), and which points are inside a body by
+    # the softened contact criterion, (M,).
+    if out is None:
+        out = np.empty((len(points), 3), dtype=np.float64)
+    inside = np.empty(len(points), dtype=bool)
+
+    rows = block_rows(len(positions))
+    for first in range(0, len(points), rows):
+        dist = positions[np.newaxis, :, :] - points[first:first+rows, np.newaxis, :]
+        dist_sq = np.einsum('ijk,ijk->ij', dist, dist)
+
+        with np.errstate(divide='ignore'):
+            weights = np.where(dist_sq > 0, masses / (dist_sq + softening**2)**1.5, 0)
+
+        out[first:first+rows] = G * np.einsum('ij,ijk->ik', weights, dist)
+        inside[first:first+rows] = (dist_sq + softening**2 < radii**2).any(1)
+
+    return out, inside
+
+def batched_accelerations(positions, masses, G, softening, out=None):
+    # Accelerations in K independent systems of N bodies at once, positions (K,N,3) and masses (N,) or
+    # (K,N), going through the systems in blocks so that the (k,N,N,3) distances stay small.
+    count, n = positions.shape[:2]
+    masses = np.broadcast_to(masses, (count, n))
+    if out is None:
+        out = np.empty((count, n, 3), dtype=np.float64)
+
+    members = block_rows(n*n)
+    for first in range(0, count, members):
+        dist = positions[first:first+members, np.newaxis, :, :] - positions[first:first+members, :, np.newaxis, :]
+        dist_sq = np.einsum('kijl,kijl->kij', dist, dist)
+
+        with np.errstate(divide='ignore'):
+            weights = np.where(dist_sq > 0, masses[first:first+members, np.newaxis, :] / (dist_sq + softening**2)**1.5, 0)
+
+        out[first:first+members] = G * np.einsum('kij,kijl->kil', weights, dist)
+
+    return out
+
+def batched_potential_energy(positions, masses, G, softening):
+    # Potential energy of each of K systems, (K,).
+    count, n = positions.shape[:2]
+    masses = np.broadcast_to(masses, (count, n))
+    energy = np.empty(count, dtype=np.float64)
+    later = np.triu(np.ones((n, n), dtype=bool), 1)
+
+    members = block_rows(n*n)
+    for first in range(0, count, members):
+        dist = positions[first:first+members, np.newaxis, :, :] - positions[first:first+members, :, np.newaxis, :]
+        dist_sq = np.einsum('kijl,kijl->kij', dist, dist)
+
+        pair_masses = masses[first:first+members, :, np.newaxis] * masses[first:first+members, np.newaxis, :]
+        energy[first:first+members] = -G * (pair_masses / np.sqrt(dist_sq + softening**2))[:, later].sum(1)
+
+    return energy
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_accelerations_into(points, positions, masses, G, softening, out):
+        softening_sq = softening*softening
+        for i in numba.prange(points.shape[0]):
+            ax = 0.0
+            ay = 0.0
+            az = 0.0
+            for j in range(positions.shape[0]):
+                dx = positions[j, 0] - points[i, 0]
+                dy = positions[j, 1] - points[i, 1]
+                dz = positions[j, 2] - points[i, 2]
+                dist_sq = dx*dx + dy*dy + dz*dz
+                if dist_sq > 0:
+                    inverse = 1 / np.sqrt(dist_sq + softening_sq)
+                    weight = masses[j] * inverse*inverse*inverse
+                    ax += weight*dx
+                    ay += weight*dy
+                    az += weight*dz
+            out[i, 0] = G*ax
+            out[i, 1] = G*ay
+            out[i, 2] = G*az
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_potential_energy(positions, masses, G, softening):
+        softening_sq = softening*softening
+        energy = 0.0
+        for i in numba.prange(positions.shape[0]):
+            for j in range(i+1, positions.shape[0]):
+                dx = positions[j, 0] - positions[i, 0]
+                dy = positions[j, 1] - positions[i, 1]
+                dz = positions[j, 2] - positions[i, 2]
+                energy += -G * masses[i] * masses[j] / np.sqrt(dx*dx + dy*dy + dz*dz + softening_sq)
+        return energy
+
+    @numba.njit(cache=True)
+    def numba_touching(positions, radii, softening, i, counts, pairs):
+        # With pairs empty, counts the partners of row i; otherwise writes them from its offset in counts.
+        softening_sq = softening*softening
+        found = 0
+        for j in range(i+1, positions.shape[0]):
+            dx = positions[j, 0] - positions[i, 0]
+            dy = positions[j, 1] - positions[i, 1]
+            dz = positions[j, 2] - positions[i, 2]
+            reach = radii[i] + radii[j]
+            if dx*dx + dy*dy + dz*dz + softening_sq < reach*reach:
+                if pairs.shape[0]:
+                    pairs[counts[i] + found, 0] = i
+                    pairs[counts[i] + found, 1] = j
+                found += 1
+        return found
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_collision_pairs(positions, radii, softening):
+        n = positions.shape[0]
+        counts = np.zeros(n, dtype=np.int64)
+        nothing = np.empty((0, 2), dtype=np.int64)
+
+        # Count first, then every row writes its pairs into its own slice, so the order is deterministic.
+        for i in numba.prange(n):
+            counts[i] = numba_touching(positions, radii, softening, i, counts, nothing)
+
+        offsets = np.zeros(n, dtype=np.int64)
+        for i in range(1, n):
+            offsets[i] = offsets[i-1] + counts[i-1]
+
+        pairs = np.empty((offsets[-1] + counts[-1] if n else 0, 2), dtype=np.int64)
+        for i in numba.prange(n):
+            numba_touching(positions, radii, softening, i, offsets, pairs)
+
+        return pairs
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_accelerations_counting_contacts(positions, masses, radii, G, softening, out, counts):
+        softening_sq = softening*softening
+        for i in numba.prange(positions.shape[0]):
+            ax = 0.0
+            ay = 0.0
+            az = 0.0
+            touching = 0
+            for j in range(positions.shape[0]):
+                dx = positions[j, 0] - positions[i, 0]
+                dy = positions[j, 1] - positions[i, 1]
+                dz = positions[j, 2] - positions[i, 2]
+                dist_sq = dx*dx + dy*dy + dz*dz
+                if dist_sq > 0:
+                    inverse = 1 / np.sqrt(dist_sq + softening_sq)
+                    weight = masses[j] * inverse*inverse*inverse
+                    ax += weight*dx
+                    ay += weight*dy
+                    az += weight*dz
+                reach = radii[i] + radii[j]
+                if j > i and dist_sq + softening_sq < reach*reach:
+                    touching += 1
+            out[i, 0] = G*ax
+            out[i, 1] = G*ay
+            out[i, 2] = G*az
+            counts[i] = touching
+
+    @numba.njit(cache=True)
+    def numba_contacts_of_rows(positions, radii, softening, rows, counts):
+        # Only the few rows that touch anything are gone through again to list their partners.
+        offsets = np.zeros(positions.shape[0], dtype=np.int64)
+        total = 0
+        for i in rows:
+            offsets[i] = total
+            total += counts[i]
+
+        pairs = np.empty((total, 2), dtype=np.int64)
+        for i in rows:
+            numba_touching(positions, radii, softening, i, offsets, pairs)
+
+        return pairs
+
+    def numba_accelerations_and_contacts(positions, masses, radii, G, softening):
+        positions = np.ascontiguousarray(positions)
+        out = np.empty((len(positions), 3), dtype=np.float64)
+        counts = np.empty(len(positions), dtype=np.int64)
+
+        numba_accelerations_counting_contacts(positions, np.ascontiguousarray(masses), np.ascontiguousarray(radii), G, softening, out, counts)
+        return out, numba_contacts_of_rows(positions, np.ascontiguousarray(radii), softening, np.flatnonzero(counts), counts)
+
+    def numba_accelerations(points, positions, masses, G, softening, out=None):
+        if out is None:
+            out = np.empty((len(points), 3), dtype=np.float64)
+        numba_accelerations_into(np.ascontiguousarray(points), np.ascontiguousarray(positions), np.ascontiguousarray(masses), G, softening, out)
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_test_particle_accelerations_into(points, positions, masses, radii, G, softening, out, inside):
+        softening_sq = softening*softening
+        for i in numba.prange(points.shape[0]):
+            ax = 0.0
+            ay = 0.0
+            az = 0.0
+            hit = False
+            for j in range(positions.shape[0]):
+                dx = positions[j, 0] - points[i, 0]
+                dy = positions[j, 1] - points[i, 1]
+                dz = positions[j, 2] - points[i, 2]
+                dist_sq = dx*dx + dy*dy + dz*dz
+                if dist_sq + softening_sq < radii[j]*radii[j]:
+                    hit = True
+                if dist_sq > 0:
+                    inverse = 1 / np.sqrt(dist_sq + softening_sq)
+                    weight = masses[j] * inverse*inverse*inverse
+                    ax += weight*dx
+                    ay += weight*dy
+                    az += weight*dz
+            out[i, 0] = G*ax
+            out[i, 1] = G*ay
+            out[i, 2] = G*az
+            inside[i] = hit
+
+    def numba_test_particle_accelerations(points, positions, masses, radii, G, softening, out=None):
+        if out is None:
+            out = np.empty((len(points), 3), dtype=np.float64)
+        inside = np.empty(len(points), dtype=np.bool_)
+        numba_test_particle_accelerations_into(np.ascontiguousarray(points), np.ascontiguousarray(positions), np.ascontiguousarray(masses), np.ascontiguousarray(radii), G, softening, out, inside)
+        return out, inside
+
+BACKENDS = {
+    'numpy': (numpy_accelerations, numpy_accelerations_and_contacts, numpy_potential_energy, numpy_collision_pairs, numpy_test_particle_accelerations),
+}
+
+if numba is not None:
+    BACKENDS['numba'] = (numba_accelerations, numba_accelerations_and_contacts, numba_potential_energy, numba_collision_pairs, numba_test_particle_accelerations)
+
+backend = 'numpy'
+
+def use_backend(name):
+    # 'auto' takes Numba when it is installed. Asking for Numba without it falls back to NumPy.
+    global backend, accelerations, accelerations_and_contacts, potential_energy, collision_pairs, test_particle_accelerations
+
+    if name == 'auto':
+        name = 'numba' if numba is not None else 'numpy'
+    elif name == 'numba' and numba is None:
+        print("Numba is not installed, using the NumPy kernels")
+        name = 'numpy'
+    elif name not in BACKENDS:
+        raise ValueError(f"Unknown kernel backend '{name}', expected one of auto, numba, numpy")
+
+    backend = name
+    accelerations, accelerations_and_contacts, potential_energy, collision_pairs, test_particle_accelerations = BACKENDS[name]
+
+def start_threads():
+    # Starts the threads Numba runs parallel loops on, from the calling thread. With the TBB threading layer,
+    # a pool that is first started from any thread but the main one keeps the interpreter from exiting.
+    if backend == 'numba':
+        numba_accelerations_into(np.zeros((1, 3)), np.zeros((1, 3)), np.ones(1), 1.0, 1.0, np.empty((1, 3)))
+
+use_backend('auto')
@@ -0,0 +1,172 @@
+import os
+import time
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+try:
+    import kernels
+except ModuleNotFoundError:
+    from modules import kernels
+
+# Workers keep the shared blocks they have attached, by name, for as long as they are in use.
+attached = {}
+
+def attach(names):
+    # Blocks that are not among the current ones have been replaced and unlinked by the parent since, and
+    # are closed here too, or their memory would stay mapped for as long as the worker lives.
+    for name in list(attached):
+        if name not in names:
+            attached.pop(name).close()
+
+    for name in names:
+        if name not in attached:
+            attached[name] = shared_memory.SharedMemory(name=name)
+
+    return [attached[name] for name in names]
+
+def start_worker(backend):
+    kernels.use_backend(backend)
+
+    # The pool already uses every core, so each worker computes on one thread.
+    if kernels.numba is not None:
+        kernels.numba.set_num_threads(1)
+
+def compute_rows(task):
+    names, capacity, n, targeted, first, last, G, softening = task
+    blocks = attach(names)
+
+    positions = np.ndarray((capacity, 3), dtype=np.float64, buffer=blocks[0].buf)[:n]
+    masses = np.ndarray(capacity, dtype=np.float64, buffer=blocks[1].buf)[:n]
+    result = np.ndarray((capacity, 3), dtype=np.float64, buffer=blocks[2].buf)
+
+    if not targeted:
+        points = positions[first:last]
+    else:
+        points = positions[np.ndarray(capacity, dtype=np.int64, buffer=blocks[3].buf)[first:last]]
+
+    kernels.accelerations(points, positions, masses, G, softening, out=result[first:last])
+
+class ParallelSolver:
+    # Direct summation split over a persistent pool of worker processes. The positions, masses and
+    # accelerations live in shared memory, so a step only sends each worker its range of rows.
+
+    def __init__(self, workers=None, chunks_per_worker=4):
+        self.workers = workers or os.cpu_count()
+        self.chunks_per_worker = chunks_per_worker
+        self.pool = None
+        self.blocks = []
+        self.capacity = 0
+
+        # Until it is closed, the solver is kept alive so that it can be closed at exit.
+        atexit.register(self.close)
+
+    def accelerations(self, positions, masses, G, softening):
+        return self.compute(positions, masses, G, softening)
+
+    def target_accelerations(self, targets, positions, masses, G, softening):
+        return self.compute(positions, masses, G, softening, np.asarray(targets, dtype=np.int64))
+
+    def compute(self, positions, masses, G, softening, targets=None):
+        n = len(positions)
+        self.reserve(n)
+
+        self.positions[:n] = positions
+        self.masses[:n] = masses
+
+        rows = n if targets is None else len(targets)
+        if targets is not None:
+            self.targets[:rows] = targets
+
+        names = tuple(block.name for block in self.blocks)
+        bounds = np.linspace(0, rows, min(rows, self.workers*self.chunks_per_worker) + 1).astype(np.int64)
+        tasks = [
+            (names, self.capacity, n, targets is not None, first, last, G, softening)
+            for first, last in zip(bounds[:-1], bounds[1:]) if last > first
+        ]
+
+        self.pool.map(compute_rows, tasks)
+
+        return self.result[:rows].copy()
+
+    def reserve(self, n):
+        # Blocks grow to the next power of two, so bodies merging or shattering rarely reallocate them.
+        if n > self.capacity:
+            self.allocate(n)
+
+        # The pool starts after the first blocks exist, so that the workers share the resource tracker
+        # that was started for them instead of each starting their own, which would unlink them on exit.
+        # Spawned workers import the script that started them again, which is why main.py only sets up
+        # the universe and the window under its __main__ guard.
+        if self.pool is None:
+            self.pool = multiprocessing.get_context('spawn').Pool(self.workers, initializer=start_worker, initargs=(kernels.backend,))
+
+    def allocate(self, n):
+        self.release_blocks()
+        self.capacity = 1 << max(n - 1, 1).bit_length()
+
+        sizes = (self.capacity*3*8, self.capacity*8, self.capacity*3*8, self.capacity*8)
+        self.blocks = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+
+        self.positions = np.ndarray((self.capacity, 3), dtype=np.float64, buffer=self.blocks[0].buf)
+        self.masses = np.ndarray(self.capacity, dtype=np.float64, buffer=self.blocks[1].buf)
+        self.result = np.ndarray((self.capacity, 3), dtype=np.float64, buffer=self.blocks[2].buf)
+        self.targets = np.ndarray(self.capacity, dtype=np.int64, buffer=self.blocks[3].buf)
+
+    def release_blocks(self):
+        self.positions = self.masses = self.result = self.targets = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        self.capacity = 0
+
+    def close(self):
+        atexit.unregister(self.close)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.release_blocks()
+
+def scaling_report(n=20000, worker_counts=None, repeats=3, seed=0):
+    # Times a full force evaluation of n random bodies for each number of workers, against the serial kernels.
+    if worker_counts is None:
+        worker_counts = [1]
+        while worker_counts[-1]*2 <= os.cpu_count():
+            worker_counts.append(worker_counts[-1]*2)
+
+    rng = np.random.default_rng(seed)
+    positions = rng.normal(size=(n, 3)) * 1.5e11
+    masses = rng.random(n) * 1e24
+    G, softening = 6.6743e-11, 5000
+
+    def best_time(compute):
+        compute()
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            compute()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    serial = best_time(lambda: kernels.accelerations(positions, positions, masses, G, softening))
+    print(f"{n} bodies, {kernels.backend} kernels, serial: {serial:.3f} s")
+
+    report = []
+    for workers in worker_counts:
+        solver = ParallelSolver(workers)
+        try:
+            elapsed = best_time(lambda: solver.accelerations(positions, masses, G, softening))
+        finally:
+            solver.close()
+
+        report.append((workers, elapsed, serial / elapsed))
+        print(f"{workers:>4} workers: {elapsed:.3f} s, speedup {serial / elapsed:.2f}")
+
+    return report
+
+if __name__ == '__main__':
+    scaling_report()
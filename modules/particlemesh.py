@@ -0,0 +1,123 @@
+import math
+
+import numpy as np
+from scipy.special import erf
+
+try:
+    from cells import CellList
+except ModuleNotFoundError:
+    from modules.cells import CellList
+
+CORNERS = np.array([(x, y, z) for x in (0, 1) for y in (0, 1) for z in (0, 1)])
+
+class ParticleMeshSolver:
+    # Mass is deposited onto a cubic grid with cloud-in-cell weights, Poisson's equation is solved by FFT
+    # convolution on a grid padded to twice the size (isolated boundaries, nothing wraps around), and the
+    # mesh forces are interpolated back with the same weights.
+    #
+    # With p3m the Green's function only carries the long-range part of a Gaussian split of scale
+    # `split` cells, and the short-range remainder is summed directly over pairs closer than `cutoff`
+    # split scales. Both parts are softened, so that they add up to the softened force whatever the
+    # softening is; the mesh takes the softening rounded to two digits in cells, and the short-range
+    # part takes away exactly what the mesh carries, so the rounding only moves the split.
+
+    def __init__(self, grid=64, p3m=False, split=1.25, cutoff=4.5):
+        self.grid = grid
+        self.p3m = p3m
+        self.split = split
+        self.cutoff = cutoff
+        self.greens_cache = {}
+
+    def accelerations(self, positions, masses, G, softening):
+        low = positions.min(0)
+        extent = max((positions.max(0) - low).max(), 1.0)
+
+        # One empty cell of margin on each side keeps every cloud inside the grid.
+        cell = extent / (self.grid - 3)
+        origin = low - cell
+        scaled = (positions - origin) / cell
+
+        corners, weights = self.cloud_in_cell(scaled)
+
+        density = np.bincount(corners.ravel(), weights=(weights*masses[:, np.newaxis]).ravel(), minlength=self.grid**3)
+        mesh_softening = self.mesh_softening(softening, cell)
+        potential = self.solve_poisson(density.reshape((self.grid,)*3), cell, mesh_softening) * G
+
+        acceleration = np.empty((len(positions), 3), dtype=np.float64)
+        for axis, field in enumerate(np.gradient(-potential, cell)):
+            acceleration[:, axis] = (field.ravel()[corners] * weights).sum(1)
+
+        if self.p3m:
+            acceleration += self.short_range(positions, masses, G, softening, mesh_softening*cell, self.split*cell)
+
+        return acceleration
+
+    def mesh_softening(self, softening, cell):
+        # Softening of the mesh in cells. For p3m it is rounded so that the Green's function is not made
+        # again for every small change of the cell size, and left out where it is far below the split.
+        ratio = softening / cell
+        if not self.p3m:
+            return round(max(ratio, 1.0), 6)
+        if ratio < 1e-3*self.split:
+            return 0.0
+        return float(f"{ratio:.2g}")
+
+    def cloud_in_cell(self, scaled):
+        # Flat indices of the 8 grid nodes around every particle and their weights.
+        base = np.floor(scaled).astype(np.int64)
+        fraction = scaled - base
+
+        nodes = base[:, np.newaxis, :] + CORNERS
+        weights = np.where(CORNERS, fraction[:, np.newaxis, :], 1 - fraction[:, np.newaxis, :]).prod(2)
+
+        return (nodes[..., 0]*self.grid + nodes[..., 1])*self.grid + nodes[..., 2], weights
+
+    def solve_poisson(self, density, cell, mesh_softening):
+        padded = 2*self.grid
+        transform = np.fft.rfftn(density, (padded,)*3, axes=(0, 1, 2))
+        return np.fft.irfftn(transform * self.greens_function(cell, mesh_softening), (padded,)*3, axes=(0, 1, 2))[:self.grid, :self.grid, :self.grid]
+
+    def greens_function(self, cell, mesh_softening):
+        # The kernel is computed in units of the cell size and scaled by 1/cell, so it only has to be
+        # transformed again when the softening changes relative to the cell.
+        key = ('p3m' if self.p3m else 'pm', self.split, mesh_softening)
+
+        if key not in self.greens_cache:
+            padded = 2*self.grid
+            index = np.arange(padded)
+            index = np.minimum(index, padded - index)
+            dist = np.sqrt(index[:, None, None]**2 + index[None, :, None]**2 + index[None, None, :]**2)
+
+            softened = np.sqrt(dist**2 + mesh_softening**2)
+            if self.p3m:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    kernel = np.where(softened > 0, -erf(softened / (2*self.split)) / softened, -1 / (math.sqrt(math.pi)*self.split))
+            else:
+                kernel = -1 / softened
+
+            self.greens_cache = {key: np.fft.rfftn(kernel)}
+
+        return self.greens_cache[key] / cell
+
+    def short_range(self, positions, masses, G, softening, mesh_softening, scale):
+        # Softened Newtonian force minus the part already carried by the mesh, with the mesh's softening,
+        # for every pair within the cutoff.
+        cutoff = self.cutoff * scale
+        acceleration = np.zeros((len(positions), 3), dtype=np.float64)
+
+        for targets, sources in CellList.from_positions(positions, cutoff).neighbor_pairs():
+            dist = positions[sources] - positions[targets]
+            dist_sq = np.einsum('ij,ij->i', dist, dist)
+
+            close = (dist_sq > 0) & (dist_sq < cutoff**2)
+            targets, sources, dist, dist_sq = targets[close], sources[close], dist[close], dist_sq[close]
+
+            r_sq = dist_sq + mesh_softening**2
+            r = np.sqrt(r_sq)
+            long_range = (erf(r / (2*scale)) - r / (scale*math.sqrt(math.pi)) * np.exp(-r_sq / (4*scale**2))) / r**3
+            weights = G * masses[sources] * (1 / (dist_sq + softening**2)**1.5 - long_range)
+
+            for axis in range(3):
+                acceleration[:, axis] += np.bincount(targets, weights=weights*dist[:, axis], minlength=len(positions))
+
+        return acceleration
@@ -0,0 +1,204 @@
+import numpy as np
+
+try:
+    import kernels
+except ModuleNotFoundError:
+    from modules import kernels
+
+class StateField:
+    # Body attribute that lives in a row of a ParticleState array once the body is bound,
+    # and in a private attribute on the body before that.
+
+    def __init__(self, array_name, convert=None):
+        self.array_name = array_name
+        self.convert = convert
+
+    def __set_name__(self, owner, name):
+        self.private_name = '_' + name
+
+    def __get__(self, body, owner=None):
+        if body is None:
+            return self
+
+        if body._state is None:
+            return getattr(body, self.private_name)
+
+        return getattr(body._state, self.array_name)[body._index]
+
+    def __set__(self, body, value):
+        if body._state is None:
+            if self.convert is not None:
+                value = self.convert(value)
+            setattr(body, self.private_name, value)
+        else:
+            getattr(body._state, self.array_name)[body._index] = value
+
+def as_vector(value):
+    return np.array(value, dtype=np.float64)
+
+def accelerations(points, positions, masses, G, softening, out=None):
+    # Acceleration at each point (M,3) caused by every particle (N,3), from whichever kernels are in use.
+    return kernels.accelerations(points, positions, masses, G, softening, out=out)
+
+def direct_accelerations(positions, masses, G, softening, out=None):
+    return accelerations(positions, positions, masses, G, softening, out=out)
+
+class ParticleState:
+
+    def __init__(self, bodies=()):
+        self.bind(bodies)
+
+    def __len__(self):
+        return len(self.bodies)
+
+    def bind(self, bodies):
+        # Copy the current values of the bodies into fresh contiguous arrays and turn the bodies into views of them.
+        bodies = list(bodies)
+        n = len(bodies)
+
+        positions = np.empty((n, 3), dtype=np.float64)
+        velocities = np.empty((n, 3), dtype=np.float64)
+        accelerations = np.empty((n, 3), dtype=np.float64)
+        masses = np.empty(n, dtype=np.float64)
+        radii = np.empty(n, dtype=np.float64)
+
+        for k, body in enumerate(bodies):
+            positions[k] = body.position
+            velocities[k] = body.velocity
+            accelerations[k] = body.acceleration
+            masses[k] = body.mass
+            radii[k] = body.radius
+
+        self.positions = positions
+        self.velocities = velocities
+        self.accelerations = accelerations
+        self.masses = masses
+        self.radii = radii
+
+        for k, body in enumerate(bodies):
+            body._state = self
+            body._index = k
+
+        self.bodies = bodies
+        self.accelerations_current = False
+        self.contacts = None
+        self.contact_positions = None
+        self.contact_radii = None
+        self.contact_softening = None
+
+    def adopt(self, bodies, positions, velocities, accelerations, masses, radii, accelerations_current=False):
+        # Like bind, but the arrays are taken over as they are instead of being filled from the bodies.
+        bodies = list(bodies)
+
+        self.positions = positions
+        self.velocities = velocities
+        self.accelerations = accelerations
+        self.masses = masses
+        self.radii = radii
+
+        for k, body in enumerate(bodies):
+            body._state = self
+            body._index = k
+
+        self.bodies = bodies
+        self.accelerations_current = accelerations_current
+        self.contacts = None
+        self.contact_positions = None
+        self.contact_radii = None
+        self.contact_softening = None
+
+    def update_accelerations(self, G, softening, solver=None, targets=None):
+        if targets is not None:
+            # Only some rows are refreshed, the others are left as they were.
+            if solver is None:
+                self.accelerations[targets] = accelerations(self.positions[targets], self.positions, self.masses, G, softening)
+            elif hasattr(solver, 'target_accelerations'):
+                self.accelerations[targets] = solver.target_accelerations(targets, self.positions, self.masses, G, softening)
+            else:
+                self.accelerations[targets] = solver.accelerations(self.positions, self.masses, G, softening)[targets]
+
+            self.accelerations_current = False
+            return
+
+        if solver is None:
+            direct_accelerations(self.positions, self.masses, G, softening, out=self.accelerations)
+        elif hasattr(solver, 'accelerations_and_contacts'):
+            # Solvers that go through every pair anyway also report which of them touch.
+            self.accelerations[:], self.contacts = solver.accelerations_and_contacts(self.positions, self.masses, self.radii, G, softening)
+            self.contact_positions = self.positions.copy()
+            self.contact_radii = self.radii.copy()
+            self.contact_softening = softening
+        else:
+            self.accelerations[:] = solver.accelerations(self.positions, self.masses, G, softening)
+
+        self.accelerations_current = True
+
+    def current_contacts(self, softening):
+        # Touching pairs from the last force evaluation, as long as nothing has moved, grown or shrunk since
+        # and the softening is the same.
+        if self.contacts is None or softening != self.contact_softening:
+            return None
+        if not np.array_equal(self.contact_positions, self.positions) or not np.array_equal(self.contact_radii, self.radii):
+            return None
+
+        return self.contacts
+
+class TestParticles:
+    # Massless particles, for belts, dust and debris: pulled by the bodies of a ParticleState and pulling
+    # nothing themselves, so that each step costs (bodies x particles) instead of (bodies + particles)**2.
+    # They move by their own kick-drift-kick leapfrog around whatever the bodies do during the step, and
+    # are gone once they fall inside a body.
+
+    def __init__(self, positions=None, velocities=None, color=(110,110,120)):
+        self.positions = np.empty((0, 3), dtype=np.float64)
+        self.velocities = np.empty((0, 3), dtype=np.float64)
+        self.accelerations = np.empty((0, 3), dtype=np.float64)
+        self.color = color
+        self.source_positions = None
+
+        if positions is not None:
+            self.add(positions, velocities)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, positions, velocities):
+        positions = np.array(positions, dtype=np.float64).reshape(-1, 3)
+        velocities = np.array(velocities, dtype=np.float64).reshape(-1, 3)
+
+        self.positions = np.concatenate((self.positions, positions))
+        self.velocities = np.concatenate((self.velocities, velocities))
+        self.accelerations = np.concatenate((self.accelerations, np.zeros_like(positions)))
+        self.source_positions = None
+
+    def remove(self, mask):
+        keep = ~mask
+        self.positions = self.positions[keep]
+        self.velocities = self.velocities[keep]
+        self.accelerations = self.accelerations[keep]
+
+    def update_accelerations(self, state, G, softening):
+        # Returns which particles are inside a body.
+        _, inside = kernels.test_particle_accelerations(self.positions, state.positions, state.masses, state.radii, G, softening, out=self.accelerations)
+        self.source_positions = state.positions.copy()
+        return inside
+
+    def kick_drift(self, state, dt, G, softening):
+        # First half of the step, with the bodies where they are at its start. The accelerations from the end
+        # of the last step are used again unless the bodies have been moved or changed since.
+        if self.source_positions is None or not np.array_equal(self.source_positions, state.positions):
+            self.update_accelerations(state, G, softening)
+
+        self.velocities += self.accelerations * (dt/2)
+        self.positions += self.velocities * dt
+
+    def kick(self, state, dt, G, softening):
+        # Second half, with the bodies where they are at the end of the step. Particles that ended up inside
+        # a body are removed, and their number returned.
+        inside = self.update_accelerations(state, G, softening)
+        self.velocities += self.accelerations * (dt/2)
+
+        count = int(inside.sum())
+        if count:
+            self.remove(inside)
+        return count
@@ -0,0 +1,264 @@
+import os
+import json
+import queue
+import threading
+
+import numpy as np
+
+# Full trajectories on disk. Every k-th state goes into chunks of memory-mapped .npy arrays, one set
+# per chunk, written by a thread of its own; a chunk ends when it is full or when the bodies change
+# (a collision, a shattering), so within a chunk every frame has the same bodies in the same order.
+# Finished chunks can be compressed into .npz files, which are smaller but have to be read whole.
+#
+# An index.jsonl next to the chunks lists them with their time spans, so that a Recording only opens the
+# chunks a time range touches. It is only ever appended to, a line per finished chunk, and the bodies are
+# written to it once for every time they change, as a numbered table of their names, colors and tags that
+# the chunks refer to. Time does
+# not have to go forward: the viewer can run it backwards, so frames are picked by their times and not
+# by position.
+
+FIELDS = ('positions', 'velocities')
+INDEX = 'index.jsonl'
+
+def read_index(path):
+    # The entries of an index, without a last line that was cut short, and how long the whole ones are.
+    entries, length = [], 0
+    if not os.path.exists(path):
+        return entries, length
+
+    with open(path, 'rb') as index:
+        for line in index:
+            if not line.endswith(b'\n'):
+                break
+            entries.append(json.loads(line))
+            length += len(line)
+
+    return entries, length
+
+class Recorder:
+
+    def __init__(self, path, every=1, chunk_frames=256, compress=False, fields=FIELDS, max_pending=256):
+        self.path = path
+        self.every = every
+        self.chunk_frames = chunk_frames
+        self.compress = compress
+        self.fields = tuple(fields)
+
+        # Recording into a directory that has one goes on after what is there.
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, INDEX)
+        entries, length = read_index(index_path)
+        if os.path.exists(index_path):
+            os.truncate(index_path, length)
+        self.index = open(index_path, 'a')
+        self.chunks = sum(entry['type'] == 'chunk' for entry in entries)
+        self.tables = sum(entry['type'] == 'bodies' for entry in entries)
+        self.table = None
+
+        self.steps = 0
+        self.bodies = None
+
+        # The step loop only ever waits here if the writer is a whole `max_pending` frames behind.
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def record(self, environment):
+        # Called after every step; keeps every `every`-th state.
+        self.steps += 1
+        if (self.steps - 1) % self.every:
+            return
+
+        environment.sync_state()
+        state = environment.state
+
+        if state.bodies is not self.bodies:
+            self.bodies = state.bodies
+            self.queue.put(('bodies', [body.name for body in state.bodies], [list(body.color) for body in state.bodies], [list(body.tags) for body in state.bodies], state.masses.copy(), state.radii.copy()))
+
+        self.queue.put(('frame', environment.time, [getattr(state, field).copy() for field in self.fields]))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.index.close()
+
+    def run(self):
+        chunk = None
+
+        while True:
+            message = self.queue.get()
+            try:
+                if message is None:
+                    if chunk is not None:
+                        self.finish(chunk)
+                    return
+
+                if message[0] == 'bodies':
+                    if chunk is not None:
+                        self.finish(chunk)
+                    chunk = None
+                    bodies = message[1:]
+                    continue
+
+                _, time, values = message
+                if chunk is None:
+                    chunk = self.start(*bodies)
+
+                chunk['times'][chunk['frames']] = time
+                for field, value in zip(self.fields, values):
+                    chunk[field][chunk['frames']] = value
+                chunk['frames'] += 1
+
+                if chunk['frames'] == self.chunk_frames:
+                    self.finish(chunk)
+                    chunk = None
+
+            except Exception as error:
+                # Nothing more can be written, but the simulation does not have to stop for it.
+                if self.error is None:
+                    print(f"Recording to {self.path} failed: {error}")
+                self.error = error
+
+    def start(self, names, colors, tags, masses, radii):
+        if self.table is None or self.table[1] != (names, colors, tags):
+            self.table = (self.tables, (names, colors, tags))
+            self.tables += 1
+            self.append({'type': 'bodies', 'id': self.table[0], 'names': names, 'colors': colors, 'tags': tags})
+
+        number = self.chunks
+        self.chunks += 1
+        prefix = os.path.join(self.path, f"chunk_{number:06d}")
+        n = len(names)
+
+        chunk = {
+            'number': number,
+            'bodies': self.table[0],
+            'frames': 0,
+            'times': np.lib.format.open_memmap(f"{prefix}_times.npy", mode='w+', dtype=np.float64, shape=(self.chunk_frames,)),
+        }
+        for field in self.fields:
+            chunk[field] = np.lib.format.open_memmap(f"{prefix}_{field}.npy", mode='w+', dtype=np.float64, shape=(self.chunk_frames, n, 3))
+
+        np.save(f"{prefix}_masses.npy", masses)
+        np.save(f"{prefix}_radii.npy", radii)
+        return chunk
+
+    def finish(self, chunk):
+        prefix = os.path.join(self.path, f"chunk_{chunk['number']:06d}")
+        frames = chunk['frames']
+        times = chunk['times'][:frames]
+
+        entry = {
+            'type': 'chunk',
+            'number': chunk['number'],
+            'bodies': chunk['bodies'],
+            'frames': frames,
+            'start': float(times.min()),
+            'end': float(times.max()),
+            'fields': list(self.fields),
+            'compressed': self.compress,
+        }
+
+        arrays = ('times',) + self.fields
+        for name in arrays:
+            chunk[name].flush()
+
+        if self.compress:
+            np.savez_compressed(
+                f"{prefix}.npz",
+                masses=np.load(f"{prefix}_masses.npy"),
+                radii=np.load(f"{prefix}_radii.npy"),
+                **{name: chunk[name][:frames] for name in arrays},
+            )
+            for name in arrays + ('masses', 'radii'):
+                chunk.pop(name, None)
+                os.remove(f"{prefix}_{name}.npy")
+        else:
+            for name in arrays:
+                del chunk[name]
+
+        self.append(entry)
+
+    def append(self, entry):
+        self.index.write(json.dumps(entry) + '\n')
+        self.index.flush()
+
+class Recording:
+    # Lazy view of a recording. Nothing is read until asked for, and then only the chunks in the time
+    # range; uncompressed chunks are memory-mapped, so only the frames used are read from disk.
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}
+        self.chunks = []
+
+        # Every chunk gets the names of its table, the same list for all chunks of one table.
+        for entry in read_index(os.path.join(path, INDEX))[0]:
+            if entry['type'] == 'bodies':
+                self.tables[entry['id']] = entry
+            else:
+                entry['names'] = self.tables[entry['bodies']]['names']
+                self.chunks.append(entry)
+
+    def __len__(self):
+        return sum(chunk['frames'] for chunk in self.chunks)
+
+    @property
+    def start(self):
+        return min(chunk['start'] for chunk in self.chunks)
+
+    @property
+    def end(self):
+        return max(chunk['end'] for chunk in self.chunks)
+
+    @property
+    def names(self):
+        # Every body that appears anywhere, in order of first appearance.
+        return list(dict.fromkeys(name for table in self.tables.values() for name in table['names']))
+
+    def open_chunk(self, chunk):
+        prefix = os.path.join(self.path, f"chunk_{chunk['number']:06d}")
+        arrays = ('times', 'masses', 'radii') + tuple(chunk['fields'])
+
+        if chunk['compressed']:
+            with np.load(f"{prefix}.npz") as file:
+                return {name: file[name] for name in arrays}
+
+        opened = {name: np.load(f"{prefix}_{name}.npy", mmap_mode='r') for name in arrays}
+        for name in ('times',) + tuple(chunk['fields']):
+            opened[name] = opened[name][:chunk['frames']]
+        return opened
+
+    def segments(self, start=-np.inf, end=np.inf):
+        # The frames with start <= time <= end, a chunk at a time, as dicts of names, masses, radii, times
+        # and the recorded fields.
+        for chunk in self.chunks:
+            if chunk['end'] < start or chunk['start'] > end:
+                continue
+
+            arrays = self.open_chunk(chunk)
+            frames = np.flatnonzero((arrays['times'] >= start) & (arrays['times'] <= end))
+            if not frames.size:
+                continue
+
+            segment = {'names': chunk['names'], 'masses': np.asarray(arrays['masses']), 'radii': np.asarray(arrays['radii'])}
+            for name in ('times',) + tuple(chunk['fields']):
+                segment[name] = np.asarray(arrays[name][frames])
+            yield segment
+
+    def trajectory(self, name, start=-np.inf, end=np.inf, field='positions'):
+        # Times and values of one body, over the frames where it exists.
+        times, values = [np.empty(0)], [np.empty((0, 3))]
+
+        for chunk in self.chunks:
+            if name not in chunk['names'] or chunk['end'] < start or chunk['start'] > end:
+                continue
+
+            arrays = self.open_chunk(chunk)
+            frames = np.flatnonzero((arrays['times'] >= start) & (arrays['times'] <= end))
+            times.append(np.asarray(arrays['times'][frames]))
+            values.append(np.asarray(arrays[field][frames, chunk['names'].index(name)]))
+
+        return np.concatenate(times), np.concatenate(values)
@@ -0,0 +1,147 @@
+import time
+
+import numpy as np
+
+try:
+    from recorder import Recording
+    from ObjectClasses import Body
+except ModuleNotFoundError:
+    from modules.recorder import Recording
+    from modules.ObjectClasses import Body
+
+# Plays a recording back into an Environment instead of integrating it, so that the viewer can draw it
+# with everything it draws a simulation with. Only the chunk being shown is open, and of that only the
+# frames shown are read, so even very large recordings open at once and seeking costs next to nothing.
+#
+# The replay has a time of its own and shows the frame nearest to it; moving that time forwards or
+# backwards, by a step or by a jump, is all that playing, rewinding and seeking are. Played back, it moves
+# on by the wall time that has passed, so that it plays at the same speed however fast the frames are shown.
+
+DEFAULT_COLOR = (200, 0, 0)
+
+# Longer gaps between two calls to play, like a pause, count as this many seconds of wall time.
+MAX_WALL_STEP = 0.1
+
+class Replay:
+
+    def __init__(self, path, environment):
+        self.recording = Recording(path)
+        self.environment = environment
+        if not self.recording.chunks:
+            raise ValueError(f"{path} has no recorded frames")
+
+        self.starts = np.array([chunk['start'] for chunk in self.recording.chunks])
+        self.ends = np.array([chunk['end'] for chunk in self.recording.chunks])
+        self.start = self.starts.min()
+        self.end = self.ends.max()
+
+        # Bodies are kept by name for as long as the replay runs, so that they stay selected and keep
+        # their trails from one chunk to the next.
+        self.bodies = {}
+        self.chunk = None
+        self.arrays = None
+        self.frame = None
+        self.played_at = None
+
+        environment.object_dict = {}
+        self.seek(self.start)
+
+    @property
+    def progress(self):
+        if self.end == self.start:
+            return 1.0
+        return (self.time - self.start) / (self.end - self.start)
+
+    def advance(self, dt):
+        self.show(self.time + dt, jump=False)
+
+    def play(self, rate):
+        # Moves on by rate seconds of the recording for every second of wall time since the last call.
+        now = time.perf_counter()
+        elapsed = 0 if self.played_at is None else min(now - self.played_at, MAX_WALL_STEP)
+        self.played_at = now
+        self.advance(rate*elapsed)
+
+    def seek(self, time):
+        self.show(time, jump=True)
+
+    def seek_fraction(self, fraction):
+        self.seek(self.start + fraction*(self.end - self.start))
+
+    def show(self, time, jump):
+        self.time = min(max(time, self.start), self.end)
+
+        number = self.find_chunk(self.time)
+        if number != self.chunk:
+            self.open(number)
+
+        times = self.arrays['times']
+        frame = int(np.argmin(np.abs(times - self.time)))
+        if frame == self.frame and not jump:
+            return
+        self.frame = frame
+
+        state = self.environment.state
+        old_positions = state.positions.copy()
+        state.positions[:] = self.arrays['positions'][frame]
+        if 'velocities' in self.arrays:
+            state.velocities[:] = self.arrays['velocities'][frame]
+        self.environment.time = float(times[frame])
+
+        for body, old_position in zip(state.bodies, old_positions):
+            if jump:
+                # No path across a jump; the trail starts again from here.
+                body.path_points = [body.position.copy(), body.position.copy()]
+                old_position = body.position
+            body.old_position = old_position.copy()
+            body.new_position = body.position.copy()
+
+    def find_chunk(self, time):
+        if self.chunk is not None and self.starts[self.chunk] <= time <= self.ends[self.chunk]:
+            return self.chunk
+
+        containing = np.flatnonzero((self.starts <= time) & (self.ends >= time))
+        if containing.size:
+            return int(containing[0])
+
+        # Between two chunks: whichever is nearer.
+        return int(np.argmin(np.minimum(np.abs(self.starts - time), np.abs(self.ends - time))))
+
+    def open(self, number):
+        chunk = self.recording.chunks[number]
+        self.chunk = number
+        self.arrays = self.recording.open_chunk(chunk)
+        self.frame = None
+
+        n = len(chunk['names'])
+        table = self.recording.tables[chunk['bodies']]
+        colors = table.get('colors', [DEFAULT_COLOR]*n)
+        tags = table.get('tags', [[]]*n)
+
+        bodies, appearing = [], []
+        for name, color, body_tags in zip(chunk['names'], colors, tags):
+            if name not in self.bodies:
+                self.bodies[name] = Body.restored(name, tuple(color), list(body_tags), [])
+                appearing.append(self.bodies[name])
+            bodies.append(self.bodies[name])
+
+        # Bodies that are already showing carry on from where they were.
+        old_positions = {body.name: body.position.copy() for body in self.environment.objects}
+        positions = np.array(self.arrays['positions'][0], dtype=np.float64)
+        for k, body in enumerate(bodies):
+            if body.name in old_positions:
+                positions[k] = old_positions[body.name]
+
+        self.environment.state.adopt(
+            bodies,
+            positions,
+            np.zeros((n, 3), dtype=np.float64),
+            np.zeros((n, 3), dtype=np.float64),
+            np.array(self.arrays['masses'], dtype=np.float64),
+            np.array(self.arrays['radii'], dtype=np.float64),
+        )
+        self.environment.object_dict = {body.name: body for body in bodies}
+
+        for body in appearing:
+            body.path_points = [body.position.copy(), body.position.copy()]
+            body.old_position = body.new_position = body.position.copy()
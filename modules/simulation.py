@@ -0,0 +1,164 @@
+import time
+import queue
+import threading
+import traceback
+
+import numpy as np
+
+try:
+    import kernels
+except ModuleNotFoundError:
+    from modules import kernels
+
+# Runs an Environment on a thread of its own, step after step as fast as it goes, so that a slow frame
+# does not slow the physics and a heavy step does not freeze the window. The window never looks at the
+# environment itself, only at snapshots of it: there are two, one that the window is drawing and one that
+# the simulation fills in between two steps, and they swap places once the window asks for the newest.
+# A snapshot is only filled after the window has taken the last one, so copying the state costs no more
+# than the window draws, however many steps are taken in between.
+#
+# Anything else that changes the environment, like shattering a body or seeking in a replay, is handed to
+# the thread as a function and run between two steps.
+
+def copy_into(buffer, values):
+    # Reuses the buffer if the shape is still the same.
+    if buffer.shape != values.shape:
+        return values.copy()
+
+    np.copyto(buffer, values)
+    return buffer
+
+class Snapshot:
+
+    def __init__(self):
+        self.time = 0
+        self.steps = 0
+        self.jumps = 0
+        self.bodies = []
+        self.paths = []
+        self.positions = np.empty((0, 3), dtype=np.float64)
+        self.masses = np.empty(0, dtype=np.float64)
+        self.radii = np.empty(0, dtype=np.float64)
+        self.test_positions = np.empty((0, 3), dtype=np.float64)
+
+    def fill(self, environment, steps, jumps):
+        environment.sync_state()
+        state = environment.state
+
+        self.time = environment.time
+        self.steps = steps
+        self.jumps = jumps
+        self.bodies = list(state.bodies)
+        # Points are never changed once they are in a trail, so copying the lists is enough.
+        self.paths = [list(body.path_points) for body in state.bodies]
+        self.positions = copy_into(self.positions, state.positions)
+        self.masses = copy_into(self.masses, state.masses)
+        self.radii = copy_into(self.radii, state.radii)
+        self.test_positions = copy_into(self.test_positions, environment.test_particles.positions)
+
+class Simulation:
+    # `advance(dt)` takes a step, and `after_step(steps)` is called after each. The window sets dt and
+    # paused as it likes; they are read before every step.
+
+    def __init__(self, environment, advance, after_step=None, max_steps_per_second=None):
+        self.environment = environment
+        self.advance = advance
+        self.after_step = after_step
+        self.max_steps_per_second = max_steps_per_second
+
+        self.dt = environment.delta_time
+        self.paused = False
+        self.steps = 0
+        self.steps_per_second = 0
+        self.error = None
+
+        # Functions to run between steps, and how many of them so far broke the continuity of the state.
+        self.commands = queue.Queue()
+        self.jumps = 0
+
+        self.lock = threading.Lock()
+        self.snapshots = [Snapshot(), Snapshot()]
+        self.snapshots[0].fill(environment, 0, 0)
+        self.front = 0
+        self.wanted = True
+
+        kernels.start_threads()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def latest(self):
+        # The newest snapshot, which stays as it is until the next call.
+        with self.lock:
+            self.wanted = True
+            return self.snapshots[self.front]
+
+    def publish(self):
+        with self.lock:
+            if not self.wanted:
+                return
+            back = self.snapshots[1 - self.front]
+
+        # Nobody reads the back snapshot, so it is filled without holding the lock.
+        back.fill(self.environment, self.steps, self.jumps)
+
+        with self.lock:
+            self.front = 1 - self.front
+            self.wanted = False
+
+    def submit(self, function, jump=False):
+        # Runs function() on the simulation thread. Jumps, like seeking, tell the window not to connect
+        # what it shows next to what it showed before.
+        self.commands.put((function, jump))
+
+    def run_command(self, command):
+        function, jump = command
+        function()
+        if jump:
+            self.jumps += 1
+
+    def run(self):
+        counted_steps = 0
+        counted_since = time.perf_counter()
+
+        try:
+            while self.running:
+                while not self.commands.empty():
+                    self.run_command(self.commands.get())
+
+                if self.paused:
+                    self.publish()
+                    try:
+                        self.run_command(self.commands.get(timeout=0.05))
+                    except queue.Empty:
+                        pass
+                    continue
+
+                started = time.perf_counter()
+                self.advance(self.dt)
+                self.steps += 1
+                if self.after_step:
+                    self.after_step(self.steps)
+                self.publish()
+
+                counted_steps += 1
+                now = time.perf_counter()
+                if now - counted_since >= 0.5:
+                    self.steps_per_second = counted_steps / (now - counted_since)
+                    counted_steps = 0
+                    counted_since = now
+
+                if self.max_steps_per_second:
+                    time.sleep(max(0, 1/self.max_steps_per_second - (now - started)))
+                else:
+                    # Lets the window have the interpreter as soon as it wants it, instead of after the
+                    # usual switch interval.
+                    time.sleep(0)
+
+        except Exception as error:
+            self.error = error
+            traceback.print_exc()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
@@ -0,0 +1,41 @@
+try:
+    import kernels
+    from barneshut import BarnesHutSolver
+    from fmm import FMMSolver
+    from particlemesh import ParticleMeshSolver
+    from parallel import ParallelSolver
+except ModuleNotFoundError:
+    from modules import kernels
+    from modules.barneshut import BarnesHutSolver
+    from modules.fmm import FMMSolver
+    from modules.particlemesh import ParticleMeshSolver
+    from modules.parallel import ParallelSolver
+
+class DirectSolver:
+    # Pairwise sum through the kernels of the selected backend.
+
+    def accelerations(self, positions, masses, G, softening):
+        return kernels.accelerations(positions, positions, masses, G, softening)
+
+    def target_accelerations(self, targets, positions, masses, G, softening):
+        return kernels.accelerations(positions[targets], positions, masses, G, softening)
+
+    def accelerations_and_contacts(self, positions, masses, radii, G, softening):
+        return kernels.accelerations_and_contacts(positions, masses, radii, G, softening)
+
+# Every solver returns an (N,3) array of accelerations in the order of the particle arrays.
+SOLVERS = {
+    'direct': DirectSolver,
+    'tree': BarnesHutSolver,
+    'fmm': FMMSolver,
+    'pm': ParticleMeshSolver,
+    'parallel': ParallelSolver,
+}
+
+def make_solver(name, **options):
+    try:
+        solver_class = SOLVERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown solver '{name}', expected one of {', '.join(SOLVERS)}")
+
+    return solver_class(**options)
@@ -1,4 +1,3 @@
-from scipy.special import jv
 import numpy as np
 
 import time
@@ -6,36 +5,168 @@ import time
 # Current Time
 t = time.time()
 
+def eccentric_anomaly(M, e, tolerance=1e-15, max_iterations=20):
+    # Solves Kepler's equation E - e sin E = M for elliptic orbits by Halley's method, from Danby's starting
+    # guess, for which it converges at every eccentricity below 1. Works on arrays of any shape.
+    M = np.remainder(np.asarray(M, dtype=np.float64) + np.pi, 2*np.pi) - np.pi
+    e = np.asarray(e, dtype=np.float64)
+
+    E = M + 0.85*e*np.sign(np.sin(M))
+    for _ in range(max_iterations):
+        sin_E, cos_E = np.sin(E), np.cos(E)
+        f = E - e*sin_E - M
+        df = 1 - e*cos_E
+        delta = f / (df - f*e*sin_E/(2*df))
+        E = E - delta
+
+        if np.all(np.abs(delta) <= tolerance):
+            break
+
+    return E
+
+def orbit_axes(i, lon_AN, arg_Pe):
+    # Unit vectors towards periapsis (P) and 90 degrees ahead of it along the orbit (Q), (...,3) each.
+    cos_Om, sin_Om = np.cos(lon_AN), np.sin(lon_AN)
+    cos_w, sin_w = np.cos(arg_Pe), np.sin(arg_Pe)
+    cos_i, sin_i = np.cos(i), np.sin(i)
+
+    P = np.stack((cos_Om*cos_w - sin_Om*sin_w*cos_i, sin_Om*cos_w + cos_Om*sin_w*cos_i, sin_w*sin_i), axis=-1)
+    Q = np.stack((-cos_Om*sin_w - sin_Om*cos_w*cos_i, -sin_Om*sin_w + cos_Om*cos_w*cos_i, cos_w*sin_i), axis=-1)
+    return P, Q
+
 def kep_to_cart(mu,a,e,i,lon_AN,lon_Pe,ML,t=time.time(),Epoch=60*60*24*365.25*30):
-    
-    arg_Pe = lon_Pe - lon_AN
-    
+    # Position and velocity from orbital elements (angles in radians). Every argument may be an array, and
+    # the results are (...,3) arrays for whatever shape they broadcast to.
+    mu, a, e, i, lon_AN, lon_Pe, ML, t, Epoch = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (mu, a, e, i, lon_AN, lon_Pe, ML, t, Epoch)))
+
     n = np.sqrt(mu/(a**3))
     M = ML - lon_Pe + n*(t-Epoch)
-    
-    # EA: eccentric anomaly
-    EA = M
-    for k in range(1,24):
-        EA += 2/k*jv(k,k*e)*np.sin(k*M)
-    
-    # nu: true anomaly
-    nu = 2*np.arctan(np.sqrt((1+e)/(1-e)) * np.tan(EA/2))
-    
-    r = a*(1 - e*np.cos(EA))
-    
-    p = a*(1-e**2)
-    
-    h = np.sqrt(mu*p)
-
-    Om = lon_AN
-    w =  arg_Pe
-
-    X = r*(np.cos(Om)*np.cos(w+nu) - np.sin(Om)*np.sin(w+nu)*np.cos(i))
-    Y = r*(np.sin(Om)*np.cos(w+nu) + np.cos(Om)*np.sin(w+nu)*np.cos(i))
-    Z = r*(np.sin(i)*np.sin(w+nu))
-
-    V_X = (X*h*e/(r*p))*np.sin(nu) - (h/r)*(np.cos(Om)*np.sin(w+nu) + np.sin(Om)*np.cos(w+nu)*np.cos(i))
-    V_Y = (Y*h*e/(r*p))*np.sin(nu) - (h/r)*(np.sin(Om)*np.sin(w+nu) - np.cos(Om)*np.cos(w+nu)*np.cos(i))
-    V_Z = (Z*h*e/(r*p))*np.sin(nu) + (h/r)*(np.cos(w+nu)*np.sin(i))
-
-    return [X,Y,Z],[V_X,V_Y,V_Z]
+    E = eccentric_anomaly(M, e)
+
+    # In the plane of the orbit, along P and Q
+    sin_E, cos_E = np.sin(E), np.cos(E)
+    b = np.sqrt(1 - e**2)
+    r = a*(1 - e*cos_E)
+
+    x, y = a*(cos_E - e), a*b*sin_E
+    speed = np.sqrt(mu*a)/r
+    vx, vy = -speed*sin_E, speed*b*cos_E
+
+    P, Q = orbit_axes(i, lon_AN, lon_Pe - lon_AN)
+    positions = x[..., np.newaxis]*P + y[..., np.newaxis]*Q
+    velocities = vx[..., np.newaxis]*P + vy[..., np.newaxis]*Q
+
+    return positions, velocities
+
+def cart_to_kep(mu, positions, velocities):
+    # Orbital elements a, e, i, lon_AN, lon_Pe, ML (angles in radians) of (...,3) positions and velocities
+    # relative to a mass of parameter mu, with the state's own time as the epoch; the inverse of kep_to_cart.
+    # The node of an orbit in the reference plane is put at 0, and so is the periapsis of a circular one.
+    # Unbound orbits get a negative a and the hyperbolic mean anomaly.
+    positions = np.asarray(positions, dtype=np.float64)
+    velocities = np.asarray(velocities, dtype=np.float64)
+    mu = np.asarray(mu, dtype=np.float64)
+
+    r = np.linalg.norm(positions, axis=-1)
+    v_sq = np.einsum('...i,...i->...', velocities, velocities)
+    radial = np.einsum('...i,...i->...', positions, velocities)
+
+    h = np.cross(positions, velocities)
+    h_norm = np.linalg.norm(h, axis=-1)
+    normal = h / h_norm[..., np.newaxis]
+
+    a = 1 / (2/r - v_sq/mu)
+    eccentricity_vector = ((v_sq - mu/r)[..., np.newaxis]*positions - radial[..., np.newaxis]*velocities) / mu[..., np.newaxis]
+    e = np.linalg.norm(eccentricity_vector, axis=-1)
+    i = np.arccos(np.clip(normal[..., 2], -1, 1))
+
+    # Ascending node, or the x axis for orbits in the reference plane
+    node = np.stack((-h[..., 1], h[..., 0], np.zeros_like(h_norm)), axis=-1)
+    node_norm = np.linalg.norm(node, axis=-1)
+    equatorial = node_norm <= 1e-12*h_norm
+    node = np.where(equatorial[..., np.newaxis], [1.0, 0.0, 0.0], node / np.where(equatorial, 1, node_norm)[..., np.newaxis])
+    lon_AN = np.where(equatorial, 0.0, np.arctan2(node[..., 1], node[..., 0]))
+
+    def angle_from(start, end):
+        # Angle from start to end about the orbit normal
+        return np.arctan2(np.einsum('...i,...i->...', np.cross(start, end), normal), np.einsum('...i,...i->...', start, end))
+
+    # Periapsis, or the node for circular orbits
+    circular = e <= 1e-12
+    periapsis = np.where(circular[..., np.newaxis], node, eccentricity_vector)
+    arg_Pe = np.where(circular, 0.0, angle_from(node, periapsis))
+    nu = angle_from(periapsis, positions)
+
+    with np.errstate(invalid='ignore'):
+        E = 2*np.arctan2(np.sqrt(np.abs(1 - e))*np.sin(nu/2), np.sqrt(1 + e)*np.cos(nu/2))
+        H = 2*np.arctanh(np.sqrt(np.abs(e - 1)/(e + 1))*np.tan(nu/2))
+    M = np.where(e < 1, E - e*np.sin(E), e*np.sinh(H) - H)
+
+    lon_Pe = lon_AN + arg_Pe
+    ML = lon_Pe + M
+    return a, e, i, lon_AN, lon_Pe, ML
+
+def stumpff(z):
+    # Stumpff functions C(z) and S(z), with series near zero where the closed forms lose precision.
+    z = np.asarray(z, dtype=np.float64)
+    small = np.abs(z) < 1e-4
+    root = np.sqrt(np.abs(np.where(small, 1, z)))
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        C = np.where(z > 0, (1 - np.cos(root)) / z, (np.cosh(root) - 1) / -z)
+        S = np.where(z > 0, (root - np.sin(root)) / root**3, (np.sinh(root) - root) / root**3)
+
+    C = np.where(small, 1/2 - z/24 + z**2/720, C)
+    S = np.where(small, 1/6 - z/120 + z**2/5040, S)
+    return C, S
+
+def kepler_drift(mu, positions, velocities, dt, tolerance=1e-14, max_iterations=50):
+    # Advances every (N,3) position and velocity along its two-body orbit around a mass of parameter mu
+    # by dt, using universal variables so that elliptic, parabolic and hyperbolic orbits are all handled.
+    r0 = np.linalg.norm(positions, axis=1)
+    v0_sq = np.einsum('ij,ij->i', velocities, velocities)
+    radial = np.einsum('ij,ij->i', positions, velocities) / np.sqrt(mu)
+    alpha = 2/r0 - v0_sq/mu
+
+    # Whole orbits of bound bodies change nothing, so only the remainder of dt is solved for.
+    dt = np.full(len(positions), dt, dtype=np.float64)
+    bound = alpha > 0
+    period = 2*np.pi / np.sqrt(mu * np.where(bound, alpha, 1)**3)
+    dt = np.where(bound, np.fmod(dt, period), dt)
+
+    # Starting guesses after Vallado, from which Laguerre's method converges for every kind of orbit.
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        semi_major = 1 / alpha
+        hyperbolic = np.sign(dt) * np.sqrt(-semi_major) * np.log(-2*mu*alpha*dt / (radial*np.sqrt(mu) + np.sign(dt)*np.sqrt(-mu*semi_major)*(1 - alpha*r0)))
+
+    chi = np.where(bound, np.sqrt(mu)*alpha*dt, np.sqrt(mu)*dt/r0)
+    chi = np.where(~bound & np.isfinite(hyperbolic), hyperbolic, chi)
+
+    for _ in range(max_iterations):
+        z = alpha * chi**2
+        C, S = stumpff(z)
+
+        F = radial*chi**2*C + (1 - alpha*r0)*chi**3*S + r0*chi - np.sqrt(mu)*dt
+        dF = radial*chi*(1 - z*S) + (1 - alpha*r0)*chi**2*C + r0
+        ddF = radial*(1 - z*C) + (1 - alpha*r0)*chi*(1 - z*S)
+
+        root = np.sqrt(np.abs(16*dF**2 - 20*F*ddF))
+        delta = 5*F / (dF + np.copysign(root, dF))
+        chi = chi - delta
+
+        if (np.abs(delta) <= tolerance * np.maximum(np.abs(chi), 1e-300)).all():
+            break
+
+    z = alpha * chi**2
+    C, S = stumpff(z)
+
+    f = 1 - chi**2/r0 * C
+    g = dt - chi**3/np.sqrt(mu) * S
+    new_positions = f[:, np.newaxis]*positions + g[:, np.newaxis]*velocities
+
+    r = np.linalg.norm(new_positions, axis=1)
+    f_dot = np.sqrt(mu) / (r*r0) * (z*chi*S - chi)
+    g_dot = 1 - chi**2/r * C
+    new_velocities = f_dot[:, np.newaxis]*positions + g_dot[:, np.newaxis]*velocities
+
+    return new_positions, new_velocities
@@ -0,0 +1,143 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+try:
+    import const
+    from systems_core import System
+    from ObjectClasses import Body
+    from checkpoint import paused_gc
+except ModuleNotFoundError:
+    from modules import const
+    from modules.systems_core import System
+    from modules.ObjectClasses import Body
+    from modules.checkpoint import paused_gc
+
+# Cartesian states of systems as load_system leaves them, so that opening the same system at the same
+# time again skips the orbital elements, Kepler's equation and the momentum balancing altogether. Each
+# entry is an .npz file named after a hash of everything the result depends on: every object in the
+# system tree with all its elements, the start time and G. Changing any of them makes a new entry, and
+# the old ones are evicted, least recently used first, once there are more than max_entries of them or
+# they take up more than max_bytes.
+#
+# FORMAT_VERSION is part of the hash, and has to be raised whenever load_system starts placing bodies
+# differently, so that no entry from before is used.
+
+FORMAT_VERSION = 1
+DEFAULT_DIRECTORY = 'state_cache'
+
+def describe(system):
+    # Everything about a system tree that load_system looks at, as nested tuples with exact reprs.
+    def describe_object(item):
+        return tuple(sorted((name, repr(value)) for name, value in vars(item).items()))
+
+    return (
+        system.name,
+        describe_object(system.parent),
+        tuple(describe(planet) if isinstance(planet, System) else describe_object(planet) for planet in system.planets),
+    )
+
+def system_key(system, start_time, G=const.G):
+    description = repr((FORMAT_VERSION, describe(system), repr(float(start_time)), repr(float(G))))
+    return hashlib.sha256(description.encode()).hexdigest()
+
+class StateCache:
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_entries=32, max_bytes=256*2**20):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    def path(self, system, start_time):
+        return os.path.join(self.directory, f"{system_key(system, start_time)}.npz")
+
+    def load(self, environment, system):
+        # Puts the cached bodies of the system into the environment, at its current time. Returns False,
+        # leaving the environment as it was, if there are none.
+        path = self.path(system, environment.time)
+        if not os.path.exists(path):
+            return False
+
+        try:
+            with paused_gc(), np.load(path) as cached:
+                names = cached['names'].tolist()
+                colors = [tuple(color) for color in cached['colors'].tolist()]
+                tag_lists = json.loads(str(cached['tag_lists']))
+                tags = [list(tag_lists[index]) for index in cached['tag_indices'].tolist()]
+                positions = cached['positions']
+                velocities = cached['velocities']
+                masses = cached['masses']
+                radii = cached['radii']
+        except Exception as error:
+            # A broken entry is as good as none, and would only be found broken again next time.
+            print(f"Ignoring unreadable cached state {path}: {error}")
+            os.remove(path)
+            return False
+
+        bodies = [Body.restored(name, color, body_tags, [position.copy(), position.copy()]) for name, color, body_tags, position in zip(names, colors, tags, positions)]
+        environment.state.adopt(bodies, positions, velocities, np.zeros_like(positions), masses, radii)
+        environment.object_dict = {body.name: body for body in bodies}
+
+        # Most recently used is most recently modified, which is what eviction goes by.
+        os.utime(path)
+        print(f"Loaded {system.name} from {path}")
+        return True
+
+    def store(self, environment, system):
+        environment.sync_state()
+        state = environment.state
+        bodies = state.bodies
+
+        tag_lists = {}
+        tag_indices = np.array([tag_lists.setdefault(tuple(body.tags), len(tag_lists)) for body in bodies], dtype=np.int64)
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(system, environment.time)
+        temporary = f"{path}.partial"
+        with open(temporary, 'wb') as file:
+            np.savez(
+                file,
+                version=FORMAT_VERSION,
+                names=np.array([body.name for body in bodies], dtype=str),
+                colors=np.array([body.color for body in bodies], dtype=np.uint8).reshape(-1, 3),
+                tag_lists=np.array(json.dumps(list(tag_lists))),
+                tag_indices=tag_indices,
+                positions=state.positions,
+                velocities=state.velocities,
+                masses=state.masses,
+                radii=state.radii,
+            )
+        os.replace(temporary, path)
+
+        self.evict()
+        return path
+
+    def entries(self):
+        # (path, size, last used) of every entry, least recently used first.
+        if not os.path.isdir(self.directory):
+            return []
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                status = os.stat(path)
+                entries.append((path, status.st_size, status.st_mtime))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+
+        # The newest entry stays even if it is bigger than max_bytes on its own.
+        while len(entries) > 1 and (len(entries) > self.max_entries or total > self.max_bytes):
+            path, size, _ = entries.pop(0)
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            os.remove(path)
@@ -0,0 +1,451 @@
+import os
+import sys
+import copy
+import json
+import time
+import socket
+import argparse
+import itertools
+import threading
+import subprocess
+import socketserver
+import collections
+
+import numpy as np
+
+try:
+    import const
+    import kernels
+    from systems_core import System
+    from ensemble import perturbed_system
+    from batch import SYSTEMS, make_environment
+except ModuleNotFoundError:
+    from modules import const
+    from modules import kernels
+    from modules.systems_core import System
+    from modules.ensemble import perturbed_system
+    from modules.batch import SYSTEMS, make_environment
+
+# Parameter sweeps spread over worker processes. A coordinator holds the list of tasks and hands them out
+# in chunks over TCP, one JSON message per line; workers run each task to the end and send back a short
+# summary. Everything that finishes goes into an append-only journal, so an interrupted sweep picks up
+# where it stopped. Workers only need to reach the coordinator's port, so they can run on other machines.
+#
+#   python -m modules.sweep run sweep.json --journal sweep.journal --workers 4
+#   python -m modules.sweep serve sweep.json --journal sweep.journal --host 0.0.0.0 --port 5577
+#   python -m modules.sweep worker --host coordinator --port 5577
+#
+# A sweep file gives the values every task starts from and a grid of values to try, all combinations of
+# which become tasks:
+#
+#   {"base": {"system": "solar_system", "until": 3.15e8},
+#    "grid": {"delta_time": [3600, 7200], "softening": [0, 5000], "masses": [{}, {"Jupiter": 1.1}], "seed": [0, 1]}}
+
+TASK_DEFAULTS = {
+    'system': 'solar_system',
+    'until': 3.15e7,
+    'start_time': 0,
+    'delta_time': 3600,
+    'softening': 5000,
+    # Factors on the masses of the named bodies.
+    'masses': {},
+    # With a seed, the orbital elements are perturbed as in modules.ensemble, by `scale` times the usual amounts.
+    'seed': None,
+    'scale': 1.0,
+    'solver': 'direct',
+    'solver_options': {},
+    'integrator': 'leapfrog',
+    'integrator_options': {},
+    'continuous_collisions': False,
+    'shatter_factor': None,
+    'fragments': 5,
+}
+
+def expand_tasks(spec):
+    base = dict(TASK_DEFAULTS, **spec.get('base', {}))
+    grid = spec.get('grid', {})
+
+    unknown = (set(base) | set(grid)) - set(TASK_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters {', '.join(sorted(unknown))}, expected some of {', '.join(TASK_DEFAULTS)}")
+
+    tasks = []
+    for values in itertools.product(*grid.values()):
+        task = dict(base, **dict(zip(grid, values)))
+        task['id'] = len(tasks)
+        tasks.append(task)
+
+    return tasks
+
+def scaled_masses(system, factors):
+    # Copy of the system with the masses of the named objects multiplied.
+    def scaled(raw_object):
+        if raw_object.name not in factors:
+            return raw_object
+
+        raw_object = copy.copy(raw_object)
+        raw_object.mass *= factors[raw_object.name]
+        raw_object.density = raw_object.mass/raw_object.volume
+        return raw_object
+
+    planets = [scaled_masses(planet, factors) if isinstance(planet, System) else scaled(planet) for planet in system.planets]
+    return System(system.name, scaled(system.parent), planets)
+
+def total_energy(environment):
+    environment.sync_state()
+    state = environment.state
+
+    kinetic = 0.5 * np.einsum('i,ij,ij->', state.masses, state.velocities, state.velocities)
+    return kinetic + kernels.potential_energy(state.positions, state.masses, const.G, environment.softening)
+
+def run_task(task):
+    # Runs one task to its end and returns what is worth keeping of it.
+    started = time.perf_counter()
+
+    system = SYSTEMS[task['system']]
+    if task['masses']:
+        system = scaled_masses(system, task['masses'])
+    if task['seed'] is not None:
+        system = perturbed_system(system, np.random.default_rng(task['seed']), task['scale'])
+
+    environment = make_environment(
+        system,
+        task['delta_time'],
+        task['start_time'],
+        softening=task['softening'],
+        solver=task['solver'],
+        solver_options=task['solver_options'],
+        integrator=task['integrator'],
+        integrator_options=task['integrator_options'],
+        continuous_collisions=task['continuous_collisions'],
+        shatter_factor=task['shatter_factor'],
+        fragments=task['fragments'],
+    )
+
+    names = set(environment.object_dict)
+    start_energy = total_energy(environment)
+    steps = 0
+
+    while environment.time < task['until']:
+        environment.advance(min(task['delta_time'], task['until'] - environment.time), const.G)
+        steps += 1
+
+    # Distance of every body from the barycenter, to spot anything thrown out of the system.
+    state = environment.state
+    barycenter = np.average(state.positions, axis=0, weights=state.masses)
+
+    return {
+        'time': environment.time,
+        'steps': steps,
+        'bodies': len(environment.object_dict),
+        'lost': sorted(names - set(environment.object_dict)),
+        'energy_error': abs((total_energy(environment) - start_energy) / start_energy),
+        'max_distance': float(np.linalg.norm(state.positions - barycenter, axis=1).max()),
+        'seconds': time.perf_counter() - started,
+    }
+
+def send(stream, message):
+    stream.write((json.dumps(message) + '\n').encode())
+    stream.flush()
+
+def receive(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError('Connection closed')
+    return json.loads(line)
+
+class Coordinator:
+    # Keeps track of which tasks are waiting, which are out with a worker and which are done, and writes
+    # every change worth remembering to the journal. A task that fails, or is out when its worker goes
+    # away or longer than `lease` seconds, goes back in line until it has been tried `max_attempts` times.
+
+    def __init__(self, tasks, journal, chunk=1, max_attempts=3, lease=None):
+        self.journal_path = journal
+        self.chunk = chunk
+        self.max_attempts = max_attempts
+        self.lease = lease
+
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.results = {}
+        self.failures = {}
+        self.attempts = collections.Counter()
+
+        if os.path.exists(journal):
+            tasks = self.resume(tasks)
+        else:
+            if tasks is None:
+                raise ValueError(f"No tasks given and no journal at {journal} to resume from")
+            self.journal = open(journal, 'a')
+            self.write({'type': 'sweep', 'tasks': tasks})
+
+        self.tasks = {task['id']: task for task in tasks}
+        self.waiting = collections.deque(id for id in self.tasks if id not in self.results and id not in self.failures)
+        self.out = {}
+
+        if not self.waiting:
+            self.finished.set()
+
+    def resume(self, tasks):
+        with open(self.journal_path) as journal:
+            entries = [json.loads(line) for line in journal if line.endswith('\n')]
+
+        if not entries or entries[0]['type'] != 'sweep':
+            raise ValueError(f"{self.journal_path} is not a sweep journal")
+        if tasks is not None and tasks != entries[0]['tasks']:
+            raise ValueError(f"{self.journal_path} belongs to a different sweep")
+
+        for entry in entries[1:]:
+            if entry['type'] == 'result':
+                self.results[entry['id']] = entry['summary']
+            elif entry['type'] == 'attempt':
+                self.attempts[entry['id']] += 1
+            elif entry['type'] == 'failed':
+                self.failures[entry['id']] = entry['error']
+
+        print(f"Resuming sweep: {len(self.results)} done, {len(self.failures)} failed, {len(entries[0]['tasks']) - len(self.results) - len(self.failures)} to go")
+
+        # A line cut short by the interruption is dropped from the file as well. The journal is written anew
+        # next to the old one and then moved over it, so that a crash meanwhile leaves the old one whole.
+        temporary = self.journal_path + '.tmp'
+        with open(temporary, 'w') as journal:
+            journal.writelines(json.dumps(entry) + '\n' for entry in entries)
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temporary, self.journal_path)
+
+        self.journal = open(self.journal_path, 'a')
+        return entries[0]['tasks']
+
+    def write(self, entry):
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def next_chunk(self, worker):
+        with self.lock:
+            if self.lease is not None:
+                now = time.monotonic()
+                for id, (holder, since) in list(self.out.items()):
+                    if now - since > self.lease:
+                        self.retry(id, f"no result from {holder} within {self.lease} s")
+
+            chunk = []
+            while self.waiting and len(chunk) < self.chunk:
+                id = self.waiting.popleft()
+                self.out[id] = (worker, time.monotonic())
+                chunk.append(self.tasks[id])
+
+            return chunk
+
+    def holds(self, worker, id):
+        return id in self.out and self.out[id][0] == worker
+
+    def finish(self, worker, results, failures):
+        with self.lock:
+            for id, summary in results:
+                # A task that was handed out again can come back twice.
+                if id in self.results or id in self.failures:
+                    continue
+                self.out.pop(id, None)
+                if id in self.waiting:
+                    self.waiting.remove(id)
+                self.results[id] = summary
+                self.write({'type': 'result', 'id': id, 'summary': summary})
+
+            for id, error in failures:
+                if self.holds(worker, id):
+                    self.retry(id, error)
+
+            self.check_finished()
+
+    def release(self, worker, ids, reason):
+        # Tasks that were out with a worker that is gone.
+        with self.lock:
+            for id in ids:
+                if self.holds(worker, id):
+                    self.retry(id, reason)
+            self.check_finished()
+
+    def retry(self, id, error):
+        del self.out[id]
+        self.attempts[id] += 1
+        self.write({'type': 'attempt', 'id': id, 'error': error})
+
+        if self.attempts[id] < self.max_attempts:
+            print(f"Task {id} failed ({error}), trying again")
+            self.waiting.append(id)
+        else:
+            print(f"Task {id} failed {self.attempts[id]} times, giving up: {error}")
+            self.failures[id] = error
+            self.write({'type': 'failed', 'id': id, 'error': error})
+
+    def check_finished(self):
+        if not self.waiting and not self.out:
+            self.finished.set()
+
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    # One connected worker. It asks for work by sending what it has finished, which may be nothing; the
+    # answer is a chunk of tasks, a request to wait while other workers finish, or the end of the sweep.
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        worker = f"{self.client_address[0]}:{self.client_address[1]}"
+        holding = set()
+
+        try:
+            while True:
+                message = receive(self.rfile)
+                worker = message.get('worker', worker)
+
+                results = [(id, summary) for id, summary in message.get('results', [])]
+                failures = [(id, error) for id, error in message.get('failures', [])]
+                coordinator.finish(worker, results, failures)
+                holding -= {id for id, _ in results + failures}
+
+                if coordinator.done:
+                    send(self.wfile, {'type': 'done'})
+                    return
+
+                chunk = coordinator.next_chunk(worker)
+                holding |= {task['id'] for task in chunk}
+
+                if chunk:
+                    send(self.wfile, {'type': 'tasks', 'tasks': chunk})
+                else:
+                    send(self.wfile, {'type': 'wait', 'seconds': 0.5})
+
+        except (ConnectionError, OSError, json.JSONDecodeError):
+            pass
+
+        finally:
+            coordinator.release(worker, holding, f"lost connection to {worker}")
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, coordinator, host='127.0.0.1', port=0):
+        self.coordinator = coordinator
+        super().__init__((host, port), CoordinatorHandler)
+
+def run_worker(host, port, connect_timeout=30):
+    # Works through chunks until the coordinator says the sweep is done or goes away.
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    deadline = time.monotonic() + connect_timeout
+    while True:
+        try:
+            connection = socket.create_connection((host, port))
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+    with connection, connection.makefile('rwb') as stream:
+        results, failures = [], []
+        while True:
+            try:
+                send(stream, {'worker': worker, 'results': results, 'failures': failures})
+                message = receive(stream)
+            except (ConnectionError, OSError):
+                return
+
+            results, failures = [], []
+
+            if message['type'] == 'done':
+                return
+
+            if message['type'] == 'wait':
+                time.sleep(message['seconds'])
+                continue
+
+            for task in message['tasks']:
+                try:
+                    results.append((task['id'], run_task(task)))
+                except Exception as error:
+                    failures.append((task['id'], f"{type(error).__name__}: {error}"))
+
+def start_local_workers(count, port):
+    # Worker processes on this machine, started the same way they would be anywhere else.
+    return [
+        subprocess.Popen([sys.executable, '-m', 'modules.sweep', 'worker', '--host', '127.0.0.1', '--port', str(port)], cwd=os.getcwd())
+        for _ in range(count)
+    ]
+
+def serve(coordinator, host='127.0.0.1', port=0, workers=0):
+    # Runs the coordinator until every task is done or has failed, with `workers` local workers.
+    server = CoordinatorServer(coordinator, host, port)
+    port = server.server_address[1]
+    print(f"Coordinator listening on {host}:{port}, {len(coordinator.waiting)} tasks to go")
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    processes = start_local_workers(workers, port)
+    try:
+        coordinator.finished.wait()
+        for process in processes:
+            process.wait()
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        server.shutdown()
+        server.server_close()
+
+    return coordinator
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m modules.sweep', description='Run a parameter sweep over worker processes.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name in ('run', 'serve'):
+        command = commands.add_parser(name)
+        command.add_argument('sweep', nargs='?', default=None, help='JSON sweep file; may be left out when resuming')
+        command.add_argument('--journal', required=True)
+        command.add_argument('--output', default=None, help='JSON file for the results')
+        command.add_argument('--chunk', type=int, default=1, help='tasks handed out at a time')
+        command.add_argument('--max-attempts', type=int, default=3)
+        command.add_argument('--lease', type=float, default=None, help='seconds before an unfinished task is handed out again')
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=0)
+    commands.choices['run'].add_argument('--workers', type=int, default=os.cpu_count())
+
+    worker = commands.add_parser('worker')
+    worker.add_argument('--host', default='127.0.0.1')
+    worker.add_argument('--port', type=int, required=True)
+    worker.add_argument('--kernel-backend', default='auto', choices=['auto'] + sorted(kernels.BACKENDS))
+
+    args = parser.parse_args(arguments)
+
+    if args.command == 'worker':
+        kernels.use_backend(args.kernel_backend)
+        run_worker(args.host, args.port)
+        return
+
+    tasks = None
+    if args.sweep is not None:
+        with open(args.sweep) as sweep:
+            tasks = expand_tasks(json.load(sweep))
+
+    coordinator = Coordinator(tasks, args.journal, args.chunk, args.max_attempts, args.lease)
+    serve(coordinator, args.host, args.port, args.workers if args.command == 'run' else 0)
+
+    print(f"{len(coordinator.results)} tasks done, {len(coordinator.failures)} failed")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'tasks': [coordinator.tasks[id] for id in sorted(coordinator.tasks)],
+                'results': {id: coordinator.results[id] for id in sorted(coordinator.results)},
+                'failures': {id: coordinator.failures[id] for id in sorted(coordinator.failures)},
+            }, output, indent=4)
+
+if __name__ == '__main__':
+    main()
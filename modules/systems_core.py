@@ -56,6 +56,21 @@ def load_system(environment, system, grandparent_position, grandparent_velocity,
 
     bodies = []
 
+    # The orbits of all the planets around this parent at once
+    planets = [planet for planet in system.planets if not isinstance(planet, System)]
+    positions, velocities = spacemath.kep_to_cart(
+        const.G*parent.mass,
+        np.array([planet.a for planet in planets], dtype=np.float64),
+        np.array([planet.e for planet in planets], dtype=np.float64),
+        np.radians([planet.i for planet in planets]),
+        np.radians([planet.lon_AN for planet in planets]),
+        np.radians([planet.lon_Pe for planet in planets]),
+        np.radians([planet.ML for planet in planets]),
+        environment.time,
+        np.array([planet.Epoch for planet in planets], dtype=np.float64),
+    )
+    orbits = iter(zip(positions, velocities))
+
     for planet in system.planets:
         if isinstance(planet, System):
             # Sub-system
@@ -64,17 +79,7 @@ def load_system(environment, system, grandparent_position, grandparent_velocity,
 
         else:
             # Planet
-            body_position, body_velocity = spacemath.kep_to_cart(
-                const.G*parent.mass,
-                planet.a,
-                planet.e,
-                math.radians(planet.i),
-                math.radians(planet.lon_AN),
-                math.radians(planet.lon_Pe),
-                math.radians(planet.ML),
-                environment.time,
-                planet.Epoch,
-            )
+            body_position, body_velocity = next(orbits)
 
             #if 'moon' in planet.tags:
             #    planet.mass = 1
@@ -106,3 +111,24 @@ def load_system(environment, system, grandparent_position, grandparent_velocity,
     print(parent.name, momentum_sum/parent.mass)
 
     environment.object_dict[system.parent.name] = parent_body
+
+def add_belt(environment, parent, count, inner, outer, max_eccentricity=0.15, max_inclination=10, seed=None, color=None):
+    # Adds `count` test particles on random orbits around the named body, with semi-major axes between inner
+    # and outer (m), eccentricities up to max_eccentricity and inclinations up to max_inclination (degrees).
+    parent = environment.object_dict[parent]
+    rng = np.random.default_rng(seed)
+    mu = const.G*parent.mass
+
+    a = rng.uniform(inner, outer, count)
+    e = rng.uniform(0, max_eccentricity, count)
+    i = np.radians(rng.uniform(0, max_inclination, count))
+    lon_AN, arg_Pe, M = rng.uniform(0, 2*np.pi, (3, count))
+
+    lon_Pe = lon_AN + arg_Pe
+    positions, velocities = spacemath.kep_to_cart(mu, a, e, i, lon_AN, lon_Pe, lon_Pe + M, 0, 0)
+
+    environment.test_particles.add(positions + parent.position, velocities + parent.velocity)
+    if color is not None:
+        environment.test_particles.color = color
+
+    print(f"Added {count} test particles around {parent.name}")
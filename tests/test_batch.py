@@ -0,0 +1,16 @@
+import numpy as np
+
+from modules import batch
+from modules import systems
+
+def test_snapshots_keep_the_test_particles(tmp_path):
+    belt = {'parent': 'Sun', 'count': 200, 'inner': 3.1e11, 'outer': 4.9e11, 'seed': 0}
+    environment = batch.run(systems.solar_system, 10*3600, 3600, snapshot_every=5*3600, output=str(tmp_path), belt=belt)
+
+    with np.load(tmp_path / 'final.npz') as final:
+        np.testing.assert_array_equal(final['test_positions'], environment.test_particles.positions)
+        np.testing.assert_array_equal(final['test_velocities'], environment.test_particles.velocities)
+
+    for number in range(3):
+        with np.load(tmp_path / f"snapshot_{number:06d}.npz") as snapshot:
+            assert snapshot['test_positions'].shape == snapshot['test_velocities'].shape == (200, 3)
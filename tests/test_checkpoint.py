@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from modules import checkpoint
+from modules import systems
+from modules.batch import make_environment
+
+DT = 6*3600
+
+@pytest.mark.parametrize('integrator', ['euler', 'leapfrog', 'yoshida6', 'block', 'wh', 'nested', 'ias15'])
+def test_resume_is_bit_exact(tmp_path, integrator):
+    path = tmp_path / 'checkpoint.npz'
+    environment = make_environment(systems.solar_system, DT, integrator=integrator)
+    for _ in range(10):
+        environment.advance(DT)
+
+    checkpoint.save(environment, path)
+    for _ in range(10):
+        environment.advance(DT)
+
+    resumed = checkpoint.load(path)
+    assert type(resumed.integrator) is type(environment.integrator)
+    for _ in range(10):
+        resumed.advance(DT)
+
+    resumed.sync_state()
+    environment.sync_state()
+    assert resumed.time == environment.time
+    assert [body.name for body in resumed.state.bodies] == [body.name for body in environment.state.bodies]
+    np.testing.assert_array_equal(resumed.state.positions, environment.state.positions)
+    np.testing.assert_array_equal(resumed.state.velocities, environment.state.velocities)
+
+def test_checkpoints_hold_no_pickles(tmp_path):
+    path = tmp_path / 'checkpoint.npz'
+    environment = make_environment(systems.jupiter_system, DT, integrator='ias15', integrator_options={'epsilon': 1e-8})
+    environment.advance(DT)
+    checkpoint.save(environment, path)
+
+    # np.load refuses object arrays unless allow_pickle is given.
+    with np.load(path) as saved:
+        for name in saved.files:
+            saved[name]
+
+    assert checkpoint.load(path).integrator.epsilon == 1e-8
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from modules import collisions
+from modules import kernels
+from modules.ObjectClasses import Body
+from modules.environment import Environment
+
+def field(n=3000, seed=0):
+    # Rocks of very different sizes with a few planets among them, packed tightly enough for many contacts.
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(-3e8, 3e8, size=(n, 3))
+    radii = 10**rng.uniform(5, 7, n)
+    radii[:5] = 10**rng.uniform(7.5, 8, 5)
+    return positions, radii
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('softening', [0.0, 5e6])
+def test_contact_pairs_match_brute_force(seed, softening):
+    positions, radii = field(seed=seed)
+    expected = kernels.numpy_collision_pairs(positions, radii, softening)
+
+    assert len(expected)
+    np.testing.assert_array_equal(collisions.grid_contact_pairs(positions, radii, softening), expected)
+    np.testing.assert_array_equal(collisions.contact_pairs(positions, radii, softening), expected)
+
+@pytest.mark.parametrize('n', [0, 1, 17])
+def test_contact_pairs_of_few_bodies(n):
+    positions, radii = field(n=max(n, 5))
+    positions, radii = positions[:n], radii[:n]*30
+
+    expected = kernels.numpy_collision_pairs(positions, radii, 0.0)
+    np.testing.assert_array_equal(collisions.contact_pairs(positions, radii, 0.0), expected)
+    np.testing.assert_array_equal(collisions.grid_contact_pairs(positions, radii, 0.0), expected)
+
+def brute_force_impacts(old_positions, positions, radii, softening):
+    i, j = np.triu_indices(len(positions), 1)
+    start = old_positions[j] - old_positions[i]
+    motion = (positions[j] - old_positions[j]) - (positions[i] - old_positions[i])
+    limit = (radii[i] + radii[j])**2 - softening**2
+
+    a = np.einsum('ij,ij->i', motion, motion)
+    b = 2*np.einsum('ij,ij->i', start, motion)
+    c = np.einsum('ij,ij->i', start, start) - limit
+    with np.errstate(divide='ignore', invalid='ignore'):
+        times = np.where(c < 0, 0, (-b - np.sqrt(b**2 - 4*a*c)) / (2*a))
+
+    hit = (limit > 0) & (times >= 0) & (times <= 1)
+    return {(int(p), int(q)) for p, q in zip(i[hit], j[hit])}
+
+@pytest.mark.parametrize('seed', range(3))
+def test_impact_times_find_every_swept_contact(seed):
+    old_positions, radii = field(1500, seed)
+    positions = old_positions + np.random.default_rng(seed + 10).normal(size=old_positions.shape) * 1e7
+
+    pairs, times = collisions.impact_times(old_positions, positions, radii, 0.0)
+
+    assert len(pairs)
+    assert {tuple(pair) for pair in pairs.tolist()} == brute_force_impacts(old_positions, positions, radii, 0.0)
+    assert np.all(np.diff(times) >= 0)
+
+def test_merge_keeps_the_survivor_in_place_and_conserves_momentum():
+    environment = Environment('Test')
+    for name, mass, position, velocity in [
+        ('Large', 1e24, (0, 0, 0), (1, 0, 0)),
+        ('Small', 1e22, (5e6, 0, 0), (0, 100, 0)),
+        ('Smaller', 1e21, (0, 5e6, 0), (0, 0, -50)),
+        ('Far', 1e21, (1e9, 0, 0), (0, 0, 0)),
+    ]:
+        environment.object_dict[name] = Body(name, mass=mass, radius=4e6, position=position, velocity=velocity)
+    environment.sync_state()
+    state = environment.state
+    momentum = (state.masses[:, np.newaxis] * state.velocities).sum(0)
+
+    removed, new_bodies = collisions.resolve_collisions(environment)
+    for name in removed:
+        del environment.object_dict[name]
+    environment.sync_state()
+
+    assert sorted(removed) == ['Small', 'Smaller'] and not new_bodies
+    large = environment.object_dict['Large']
+    np.testing.assert_array_equal(large.position, [0, 0, 0])
+    assert large.mass == 1e24 + 1e22 + 1e21
+    np.testing.assert_allclose((state.masses[:, np.newaxis] * state.velocities).sum(0), momentum, rtol=1e-12)
+
+def test_contacts_from_the_force_pass_are_dropped_once_stale():
+    environment = Environment('Test')
+    environment.object_dict['A'] = Body('A', mass=1e24, radius=4e6, position=(0, 0, 0))
+    environment.object_dict['B'] = Body('B', mass=1e22, radius=4e6, position=(1e7, 0, 0))
+    environment.update_accelerations(6.674e-11)
+    state = environment.state
+
+    assert len(state.current_contacts(environment.softening)) == 0
+
+    # Only the radii change, as when a body shatters in place.
+    state.radii[:] = 6e6
+    assert state.current_contacts(environment.softening) is None
+
+    environment.update_accelerations(6.674e-11)
+    np.testing.assert_array_equal(state.current_contacts(environment.softening), [[0, 1]])
+    assert state.current_contacts(environment.softening + 1) is None
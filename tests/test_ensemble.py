@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from modules import systems
+from modules.batch import make_environment
+from modules.ensemble import Ensemble
+
+DT = 3600
+
+@pytest.mark.parametrize('integrator', ['leapfrog', 'yoshida4'])
+def test_unperturbed_ensemble_matches_environment(integrator):
+    environment = make_environment(systems.jupiter_system, DT, integrator=integrator)
+    ensemble = Ensemble.from_system(systems.jupiter_system, 4, scale=0, weights=environment.integrator.weights)
+
+    environment.sync_state()
+    assert ensemble.names == [body.name for body in environment.state.bodies]
+
+    ensemble.run(50*DT, DT, record_every=10*DT)
+    for _ in range(50):
+        environment.advance(DT)
+
+    for member in range(len(ensemble)):
+        np.testing.assert_allclose(ensemble.positions[member], environment.state.positions, rtol=1e-12, atol=1e-3)
+        np.testing.assert_allclose(ensemble.velocities[member], environment.state.velocities, rtol=1e-12, atol=1e-9)
+
+    # Copies of one system never drift apart.
+    assert len(ensemble.history) == 6
+    for _, divergences, _ in ensemble.history:
+        np.testing.assert_array_equal(divergences, 0)
+    np.testing.assert_array_equal(ensemble.separations(), 0)
+    assert np.isnan(ensemble.lyapunov_exponents()).all()
+
+def test_perturbed_members_diverge():
+    ensemble = Ensemble.from_system(systems.jupiter_system, 3, seed=0)
+    ensemble.run(50*DT, DT, record_every=10*DT)
+
+    divergences = ensemble.divergences()
+    assert divergences[0] == 0 and (divergences[1:] > 0).all()
+
+    exponents = ensemble.lyapunov_exponents()
+    assert np.isnan(exponents[0]) and np.isfinite(exponents[1:]).all()
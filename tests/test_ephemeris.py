@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from modules import systems
+from modules.batch import make_environment
+from modules.ephemeris import Ephemeris, build
+
+DT = 3600
+START = 1.6e9
+UNTIL = START + 40*86400
+
+@pytest.fixture(scope='module')
+def run():
+    # The ephemeris and the states of the run it was built from, at every step.
+    environment = make_environment(systems.jupiter_system, DT, START)
+    ephemeris = build(environment, UNTIL, DT, 8*86400, tolerance=1000, velocity_tolerance=0.1)
+
+    reference = make_environment(systems.jupiter_system, DT, START)
+    times, positions, velocities = [], [], []
+    while reference.time < UNTIL:
+        reference.advance(DT)
+        reference.sync_state()
+        times.append(reference.time)
+        positions.append(reference.state.positions.copy())
+        velocities.append(reference.state.velocities.copy())
+
+    names = [body.name for body in reference.state.bodies]
+    return ephemeris, names, np.array(times), np.array(positions), np.array(velocities)
+
+def test_state_is_within_tolerances(run):
+    ephemeris, names, times, positions, velocities = run
+    found_names, found_positions, found_velocities = ephemeris.state(times)
+
+    rows = [names.index(name) for name in found_names]
+    assert sorted(found_names) == sorted(names)
+    assert np.abs(found_positions - positions[:, rows]).max() <= 1000
+    assert np.abs(found_velocities - velocities[:, rows]).max() <= 0.1
+
+def test_state_of_times_matches_state_of_each_time(run):
+    ephemeris, _, times, _, _ = run
+    names, positions, velocities = ephemeris.state(times[::50])
+
+    for time, time_positions, time_velocities in zip(times[::50], positions, velocities):
+        time_names, expected_positions, expected_velocities = ephemeris.state(time)
+        assert time_names == names
+        np.testing.assert_array_equal(time_positions, expected_positions)
+        np.testing.assert_array_equal(time_velocities, expected_velocities)
+
+def test_save_and_load(run, tmp_path):
+    ephemeris = run[0]
+    ephemeris.save(tmp_path / 'ephemeris.npz')
+    loaded = Ephemeris.load(tmp_path / 'ephemeris.npz')
+
+    for found, expected in zip(loaded.state(START + 1234.5)[1:], ephemeris.state(START + 1234.5)[1:]):
+        np.testing.assert_array_equal(found, expected)
@@ -0,0 +1,55 @@
+import time
+
+import numpy as np
+import pytest
+
+from modules import kernels
+from modules import systems
+from modules.batch import make_environment
+
+SPAN = 30*86400
+
+def run(integrator, dt, **options):
+    # Positions after SPAN, and the wall time of all but the first step, which may compile kernels.
+    environment = make_environment(systems.solar_system, dt, integrator=integrator, integrator_options=options)
+    environment.advance(dt)
+
+    started = time.perf_counter()
+    while environment.time < SPAN - 1e-6:
+        environment.advance(dt)
+    elapsed = time.perf_counter() - started
+
+    environment.sync_state()
+    return environment.state.positions.copy(), elapsed
+
+needs_numba = pytest.mark.skipif(kernels.backend != 'numba', reason='the compiled block substeps need Numba')
+
+@needs_numba
+def test_block_timesteps_beat_leapfrog_at_equal_accuracy():
+    reference, _ = run('yoshida6', 450)
+
+    # Leapfrog has to take Io's step for everyone; the block steps give it to Io and its neighbours only.
+    block, block_time = run('block', 86400, eta=0.01)
+    leapfrog, leapfrog_time = run('leapfrog', 300)
+
+    block_error = np.linalg.norm(block - reference, axis=1).max()
+    leapfrog_error = np.linalg.norm(leapfrog - reference, axis=1).max()
+    assert block_error <= leapfrog_error
+    assert block_time*3 < leapfrog_time
+
+@needs_numba
+def test_compiled_block_substeps_match_numpy():
+    compiled = make_environment(systems.jupiter_system, 86400, integrator='block')
+    for _ in range(3):
+        compiled.advance(86400)
+
+    kernels.use_backend('numpy')
+    try:
+        plain = make_environment(systems.jupiter_system, 86400, integrator='block')
+        for _ in range(3):
+            plain.advance(86400)
+    finally:
+        kernels.use_backend('numba')
+
+    np.testing.assert_array_equal(compiled.integrator.levels, plain.integrator.levels)
+    np.testing.assert_allclose(compiled.state.positions, plain.state.positions, rtol=0, atol=1e-3)
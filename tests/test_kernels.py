@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from modules import kernels
+
+G = 6.674e-11
+
+needs_numba = pytest.mark.skipif('numba' not in kernels.BACKENDS, reason="Numba is not installed")
+
+def random_system(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    positions = rng.normal(size=(n, 3)) * 1e9
+    masses = rng.uniform(1e20, 1e25, n)
+    radii = rng.uniform(1e6, 1e8, n)
+    return positions, masses, radii
+
+def backend(name):
+    accelerations, accelerations_and_contacts, potential_energy, collision_pairs, _ = kernels.BACKENDS[name]
+    return accelerations, accelerations_and_contacts, potential_energy, collision_pairs
+
+@needs_numba
+@pytest.mark.parametrize('softening', [0.0, 1e7])
+def test_accelerations_match(softening):
+    positions, masses, _ = random_system()
+    expected = backend('numpy')[0](positions, positions, masses, G, softening)
+    result = backend('numba')[0](positions, positions, masses, G, softening)
+
+    # Only the order of the sums differs.
+    assert np.abs(result - expected).max() <= 1e-11 * np.abs(expected).max()
+
+@needs_numba
+def test_potential_energy_matches():
+    positions, masses, _ = random_system()
+    expected = backend('numpy')[2](positions, masses, G, 1e7)
+    result = backend('numba')[2](positions, masses, G, 1e7)
+
+    assert result == pytest.approx(expected, rel=1e-12)
+
+@needs_numba
+def test_collision_pairs_match():
+    positions, _, radii = random_system()
+    expected = backend('numpy')[3](positions, radii, 1e7)
+    result = backend('numba')[3](positions, radii, 1e7)
+
+    assert len(expected)
+    np.testing.assert_array_equal(result, expected)
+
+@needs_numba
+def test_accelerations_and_contacts_match():
+    positions, masses, radii = random_system()
+    expected_accelerations, expected_pairs = backend('numpy')[1](positions, masses, radii, G, 1e7)
+    accelerations, pairs = backend('numba')[1](positions, masses, radii, G, 1e7)
+
+    assert np.abs(accelerations - expected_accelerations).max() <= 1e-11 * np.abs(expected_accelerations).max()
+    np.testing.assert_array_equal(pairs, expected_pairs)
+
+def test_accelerations_and_contacts_agree_with_separate_kernels():
+    positions, masses, radii = random_system()
+    accelerations, pairs = kernels.accelerations_and_contacts(positions, masses, radii, G, 1e7)
+
+    np.testing.assert_array_equal(accelerations, kernels.accelerations(positions, positions, masses, G, 1e7))
+    np.testing.assert_array_equal(pairs, kernels.collision_pairs(positions, radii, 1e7))
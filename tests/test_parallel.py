@@ -0,0 +1,27 @@
+import gc
+import weakref
+
+import numpy as np
+
+from modules import kernels
+from modules.parallel import ParallelSolver
+
+G = 6.674e-11
+
+def test_parallel_solver_matches_kernels_and_is_freed_when_closed():
+    rng = np.random.default_rng(0)
+    positions = rng.normal(size=(500, 3)) * 1.5e11
+    masses = rng.random(500) * 1e24
+    targets = np.array([3, 7, 250, 499])
+
+    solver = ParallelSolver(2)
+    try:
+        np.testing.assert_allclose(solver.accelerations(positions, masses, G, 5000), kernels.accelerations(positions, positions, masses, G, 5000), rtol=1e-12)
+        np.testing.assert_allclose(solver.target_accelerations(targets, positions, masses, G, 5000), kernels.accelerations(positions[targets], positions, masses, G, 5000), rtol=1e-12)
+    finally:
+        solver.close()
+
+    reference = weakref.ref(solver)
+    del solver
+    gc.collect()
+    assert reference() is None
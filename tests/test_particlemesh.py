@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from modules.particlemesh import ParticleMeshSolver
+from modules.particles import direct_accelerations
+
+G = 6.674e-11
+
+@pytest.mark.parametrize('softening_cells', [0, 1, 3])
+def test_p3m_matches_direct_summation(softening_cells):
+    rng = np.random.default_rng(1)
+    positions = rng.normal(0, 1e9, (2000, 3))
+    masses = rng.uniform(1e20, 1e22, 2000)
+
+    solver = ParticleMeshSolver(grid=64, p3m=True)
+    softening = softening_cells * (positions.max(0) - positions.min(0)).max() / (solver.grid - 3)
+    expected = direct_accelerations(positions, masses, G, softening)
+    found = solver.accelerations(positions, masses, G, softening)
+
+    error = np.linalg.norm(found - expected, axis=1) / np.linalg.norm(expected, axis=1)
+    assert np.median(error) < 0.02
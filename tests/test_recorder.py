@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from modules import systems
+from modules.batch import make_environment
+from modules.environment import Environment
+from modules.recorder import Recorder, Recording
+from modules.replay import Replay
+
+DT = 3600
+
+def record_run(path, compress, steps=50, lose_at=30):
+    # Records every state of a run in chunks of 16 frames, losing Callisto part of the way, and returns
+    # the live states by time.
+    environment = make_environment(systems.jupiter_system, DT)
+    recorder = Recorder(path, chunk_frames=16, compress=compress)
+    live = {}
+
+    def keep():
+        environment.sync_state()
+        state = environment.state
+        live[environment.time] = ([body.name for body in state.bodies], state.positions.copy(), state.velocities.copy())
+        recorder.record(environment)
+
+    keep()
+    for step in range(1, steps + 1):
+        if step == lose_at:
+            del environment.object_dict['Callisto']
+        environment.advance(DT)
+        keep()
+
+    recorder.close()
+    assert recorder.error is None
+    return live
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_replay_seeks_to_the_recorded_states(tmp_path, compress):
+    live = record_run(str(tmp_path), compress)
+    times = sorted(live)
+
+    recording = Recording(str(tmp_path))
+    assert len(recording) == len(live)
+    assert (recording.start, recording.end) == (times[0], times[-1])
+    assert len(recording.tables) == 2
+    assert recording.names[-1] == 'Jupiter' and 'Callisto' in recording.names
+
+    replay = Replay(str(tmp_path), Environment('replay'))
+    state = replay.environment.state
+
+    # Mid-chunk, before and after Callisto is lost, and between two frames, which shows the nearer one.
+    for time in (times[20], times[40], times[7] + 0.3*DT, times[-1], times[0]):
+        replay.seek(time)
+        names, positions, velocities = live[times[int(np.argmin(np.abs(np.array(times) - time)))]]
+        assert [body.name for body in state.bodies] == names
+        np.testing.assert_array_equal(state.positions, positions)
+        np.testing.assert_array_equal(state.velocities, velocities)
+
+    trajectory_times, trajectory = recording.trajectory('Io', times[10], times[35])
+    np.testing.assert_array_equal(trajectory_times, times[10:36])
+    np.testing.assert_array_equal(trajectory, [live[time][1][live[time][0].index('Io')] for time in times[10:36]])
+
+def test_recording_goes_on_after_a_torn_index(tmp_path):
+    record_run(str(tmp_path), False, steps=20, lose_at=None)
+    with open(tmp_path / 'index.jsonl', 'a') as index:
+        index.write('{"type": "chu')
+
+    # A second run in the same directory starts after the first, at chunk numbers of its own.
+    record_run(str(tmp_path), False, steps=20, lose_at=None)
+    recording = Recording(str(tmp_path))
+
+    assert len(recording) == 42
+    assert [chunk['number'] for chunk in recording.chunks] == list(range(4))
+    assert len(recording.tables) == 2
+
+def test_replay_plays_by_wall_time(tmp_path, monkeypatch):
+    live = record_run(str(tmp_path), False, steps=20, lose_at=None)
+    times = sorted(live)
+    replay = Replay(str(tmp_path), Environment('replay'))
+
+    clock = [100.0]
+    monkeypatch.setattr('modules.replay.time.perf_counter', lambda: clock[0])
+
+    # However often it is called, the replay moves on by the wall time in between, and a long gap like a
+    # pause counts as a short one.
+    replay.play(DT)
+    for _ in range(50):
+        replay.play(DT)
+    assert replay.time == times[0]
+
+    for _ in range(40):
+        clock[0] += 0.05
+        replay.play(DT)
+    assert replay.time == pytest.approx(times[2])
+
+    clock[0] += 60
+    replay.play(DT)
+    assert replay.time == pytest.approx(times[2] + 0.1*DT)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from modules import spacemath
+
+MU = 1.32712440018e20
+
+def elements(e, n=200, seed=0):
+    # Random orbits of one eccentricity, clear of the equatorial and circular cases where angles are not defined.
+    rng = np.random.default_rng(seed)
+    a = 10**rng.uniform(10, 13, n)
+    i = rng.uniform(0.01, np.pi - 0.01, n)
+    lon_AN = rng.uniform(-np.pi, np.pi, n)
+    lon_Pe = rng.uniform(-np.pi, np.pi, n)
+    ML = rng.uniform(-np.pi, np.pi, n)
+    return a, np.full(n, e), i, lon_AN, lon_Pe, ML
+
+def wrapped(angles):
+    return np.remainder(angles + np.pi, 2*np.pi) - np.pi
+
+@pytest.mark.parametrize('e', [0.01, 0.3, 0.9, 0.99])
+def test_cart_to_kep_inverts_kep_to_cart(e):
+    a, e, i, lon_AN, lon_Pe, ML = elements(e)
+    positions, velocities = spacemath.kep_to_cart(MU, a, e, i, lon_AN, lon_Pe, ML, t=0, Epoch=0)
+    found = spacemath.cart_to_kep(MU, positions, velocities)
+
+    np.testing.assert_allclose(found[0], a, rtol=1e-9)
+    np.testing.assert_allclose(found[1], e, rtol=1e-9)
+    np.testing.assert_allclose(found[2], i, atol=1e-9)
+    for expected, angle in zip((lon_AN, lon_Pe, ML), found[3:]):
+        np.testing.assert_allclose(wrapped(angle - expected), 0, atol=1e-7)
+
+    # And back again to the same state
+    again = spacemath.kep_to_cart(MU, *found, t=0, Epoch=0)
+    np.testing.assert_allclose(again[0], positions, rtol=1e-9, atol=1e-9*np.abs(positions).max())
+    np.testing.assert_allclose(again[1], velocities, rtol=1e-9, atol=1e-9*np.abs(velocities).max())
+
+def test_cart_to_kep_of_equatorial_circular_orbit():
+    positions, velocities = spacemath.kep_to_cart(MU, 1.5e11, 0.0, 0.0, 0.0, 0.0, 0.7, t=0, Epoch=0)
+    a, e, i, lon_AN, lon_Pe, ML = spacemath.cart_to_kep(MU, positions, velocities)
+
+    np.testing.assert_allclose(a, 1.5e11, rtol=1e-12)
+    assert e < 1e-12 and i == 0 and lon_AN == 0 and lon_Pe == 0
+    np.testing.assert_allclose(ML, 0.7, atol=1e-12)
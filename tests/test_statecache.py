@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from modules import systems
+from modules.batch import make_environment
+from modules.statecache import StateCache
+
+DT = 3600
+
+def assert_same_state(environment, expected):
+    environment.sync_state()
+    expected.sync_state()
+    state, other = environment.state, expected.state
+    assert [body.name for body in state.bodies] == [body.name for body in other.bodies]
+    assert [body.color for body in state.bodies] == [body.color for body in other.bodies]
+    assert [body.tags for body in state.bodies] == [body.tags for body in other.bodies]
+    for field in ('positions', 'velocities', 'masses', 'radii'):
+        np.testing.assert_array_equal(getattr(state, field), getattr(other, field))
+
+@pytest.mark.parametrize('system', ['solar_system', 'jupiter_system'])
+def test_cache_hit_equals_fresh_load(tmp_path, capsys, system):
+    system = getattr(systems, system)
+    fresh = make_environment(system, DT, start_time=1e8)
+
+    stored = make_environment(system, DT, start_time=1e8, state_cache=str(tmp_path))
+    assert len(StateCache(str(tmp_path)).entries()) == 1
+    capsys.readouterr()
+    loaded = make_environment(system, DT, start_time=1e8, state_cache=str(tmp_path))
+    assert capsys.readouterr().out.startswith(f"Loaded {system.name} from")
+
+    assert_same_state(stored, fresh)
+    assert_same_state(loaded, fresh)
+
+    # And they go on the same way.
+    for _ in range(5):
+        fresh.advance(DT)
+        loaded.advance(DT)
+    assert_same_state(loaded, fresh)
+
+def test_other_start_time_is_a_new_entry(tmp_path):
+    make_environment(systems.solar_system, DT, start_time=0, state_cache=str(tmp_path))
+    later = make_environment(systems.solar_system, DT, start_time=1e8, state_cache=str(tmp_path))
+
+    assert len(StateCache(str(tmp_path)).entries()) == 2
+    assert_same_state(later, make_environment(systems.solar_system, DT, start_time=1e8))
@@ -0,0 +1,53 @@
+import json
+
+from modules import sweep
+
+SPEC = {
+    'base': {'system': 'jupiter_system', 'until': 20*3600, 'delta_time': 3600},
+    'grid': {'softening': [0, 5000], 'integrator': ['leapfrog', 'unknown']},
+}
+
+def journal_entries(path):
+    with open(path) as journal:
+        return [json.loads(line) for line in journal]
+
+def comparable(summary):
+    return {key: value for key, value in summary.items() if key != 'seconds'}
+
+def test_local_sweep_retries_failures_and_resumes(tmp_path):
+    tasks = sweep.expand_tasks(SPEC)
+    journal = str(tmp_path / 'sweep.journal')
+
+    coordinator = sweep.serve(sweep.Coordinator(tasks, journal, max_attempts=2), workers=2)
+
+    # The tasks with an unknown integrator fail on every attempt and are given up after the second.
+    good = [task['id'] for task in tasks if task['integrator'] == 'leapfrog']
+    bad = [task['id'] for task in tasks if task['integrator'] == 'unknown']
+    assert sorted(coordinator.results) == good
+    assert sorted(coordinator.failures) == bad
+    assert all('Unknown integrator' in coordinator.failures[id] for id in bad)
+
+    entries = journal_entries(journal)
+    for id in bad:
+        assert sum(entry['type'] == 'attempt' and entry['id'] == id for entry in entries) == 2
+    assert all(coordinator.results[id]['steps'] == 20 for id in good)
+
+    # Interrupted after the first result, while the next line was being written.
+    first = next(n for n, entry in enumerate(entries) if entry['type'] == 'result')
+    with open(journal, 'w') as file:
+        file.writelines(json.dumps(entry) + '\n' for entry in entries[:first + 1])
+        file.write('{"type": "res')
+
+    resumed = sweep.Coordinator(tasks, journal, max_attempts=2)
+    assert list(resumed.results) == [entries[first]['id']]
+    assert len(resumed.waiting) == len(tasks) - 1
+    sweep.serve(resumed, workers=2)
+
+    assert sorted(resumed.results) == good
+    assert sorted(resumed.failures) == bad
+    for id in good:
+        assert comparable(resumed.results[id]) == comparable(coordinator.results[id])
+
+    # Every line of the journal is whole again, and resuming a finished sweep has nothing left to do.
+    journal_entries(journal)
+    assert sweep.Coordinator(None, journal).done